@@ -0,0 +1,149 @@
+# 🔽 📮 返信のまとめ投稿（com.atproto.repo.applyWrites）
+# 返信を少しためてから1回のapplyWritesでまとめて書き込む → 書き込みの往復とリポジトリのコミットがまとめた件数ぶん減る
+# ・max_batch件たまるか、最初の1件からlinger秒たったら送る（poll()を呼ぶか、add()のついでに判定）
+# ・結果は書き込み順に返るので、投稿ごとの結果をキー（返信先URI）に戻してon_resultに渡す
+# ・applyWritesはまとめて成功か失敗なので、失敗したら1件ずつ投稿し直して、悪い1件で他を巻き込まない
+# ・1回の書き込みごとにon_flushを呼ぶ（replied/履歴の保存はここで1回だけ）
+# ・rkeyを指定した投稿は、失敗してもそのrkeyのレコードが既にあれば投稿済みとして扱う（再実行での二重投稿防止）
+import logging
+import os
+import random
+import time
+from datetime import datetime, timezone
+
+from atproto import models
+
+BATCH_MAX_SIZE = int(os.environ.get("REPLY_BATCH_SIZE", "10"))  # PDSの上限は200件
+BATCH_LINGER = float(os.environ.get("REPLY_BATCH_LINGER", "5"))  # 秒
+POST_COLLECTION = "app.bsky.feed.post"
+TID_ALPHABET = "234567abcdefghijklmnopqrstuvwxyz"
+
+def new_tid():
+    # レコードキー用のTID（マイクロ秒のUNIX時刻53bit＋クロックID10bitを base32-sortable で13文字）
+    value = (int(time.time() * 1_000_000) << 10) | random.getrandbits(10)
+    return "".join(TID_ALPHABET[(value >> (5 * i)) & 31] for i in reversed(range(13)))
+
+def reply_record(text, reply_ref=None, langs=None):
+    return models.AppBskyFeedPost.Record(
+        text=text,
+        created_at=datetime.now(timezone.utc).isoformat(),
+        reply=reply_ref,
+        langs=langs,
+    )
+
+def reply_ref_to_dict(reply_ref):
+    # 作業キューに保存できる形（{"root": {"uri", "cid"}, "parent": {...}}）
+    if reply_ref is None:
+        return None
+    return {key: {"uri": str(ref.uri), "cid": str(ref.cid)} for key, ref in (("root", reply_ref.root), ("parent", reply_ref.parent))}
+
+def reply_ref_from_dict(data):
+    if not data:
+        return None
+    return models.AppBskyFeedPost.ReplyRef(
+        root=models.ComAtprotoRepoStrongRef.Main(**data["root"]),
+        parent=models.ComAtprotoRepoStrongRef.Main(**data["parent"]),
+    )
+
+class BatchPoster:
+    def __init__(self, client, on_result, on_flush=None, max_batch=BATCH_MAX_SIZE, linger=BATCH_LINGER):
+        # on_result(key, 作成した投稿のURI or None, context, error or None)
+        # on_flush(その回の [(key, uri, context, error), ...])
+        self.client = client
+        self.on_result = on_result
+        self.on_flush = on_flush
+        self.max_batch = max(1, min(int(max_batch), 200))
+        self.linger = linger
+        self.pending = []
+        self.first_added_at = None
+        self.stats = {"posts": 0, "writes": 0, "fallbacks": 0, "failed": 0, "existing": 0}
+
+    def add(self, key, record, context=None, rkey=None):
+        self.pending.append((key, record, context, rkey))
+        if self.first_added_at is None:
+            self.first_added_at = time.time()
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        else:
+            self.poll()
+
+    def poll(self):
+        if self.pending and time.time() - self.first_added_at >= self.linger:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return []
+        batch, self.pending, self.first_added_at = self.pending, [], None
+        # 同じrkey（＝同じ返信先を2回キューに入れた）の書き込みがあるとapplyWrites全体が弾かれるので、
+        # 2件目以降は書き込まずに1件目の結果を返す
+        unique, duplicates, first_index = [], [], {}
+        for entry in batch:
+            key, _, _, rkey = entry
+            ids = [("key", key)] + ([("rkey", rkey)] if rkey is not None else [])
+            seen = next((first_index[i] for i in ids if i in first_index), None)
+            if seen is not None:
+                duplicates.append((entry, seen))
+                continue
+            for i in ids:
+                first_index[i] = len(unique)
+            unique.append(entry)
+        if duplicates:
+            logging.warning(f"⚠️ 同じ返信先・rkeyの投稿 {len(duplicates)}件をまとめ投稿から外しました")
+        try:
+            results = self._apply(unique)
+        except Exception as e:
+            logging.error(f"❌ まとめ投稿エラー: {type(e).__name__}: {e}（{len(unique)}件）→ 1件ずつ投稿します")
+            self.stats["fallbacks"] += 1
+            results = [self._post_one(key, record, context, rkey) for key, record, context, rkey in unique]
+        for (key, _, context, _), seen in duplicates:
+            _, uri, _, error = results[seen]
+            results.append((key, uri, context, error))
+        for key, uri, context, error in results:
+            if error is not None:
+                self.stats["failed"] += 1
+            self.on_result(key, uri, context, error)
+        if self.on_flush:
+            self.on_flush(results)
+        return results
+
+    def _apply(self, batch):
+        writes = [models.ComAtprotoRepoApplyWrites.Create(collection=POST_COLLECTION, value=record, rkey=rkey)
+                  for _, record, _, rkey in batch]
+        response = self.client.com.atproto.repo.apply_writes(
+            models.ComAtprotoRepoApplyWrites.Data(repo=self.client.me.did, writes=writes)
+        )
+        self.stats["writes"] += 1
+        self.stats["posts"] += len(batch)
+        created = list(getattr(response, "results", None) or [])
+        if len(created) != len(batch):
+            # 古いPDSはresultsを返さない → 書き込み自体は成功しているのでURIなしで成功扱い
+            logging.warning(f"⚠️ applyWritesの結果が{len(created)}/{len(batch)}件: URIなしで成功扱い")
+            created = [None] * len(batch)
+        return [(key, getattr(result, "uri", None), context, None) for (key, _, context, _), result in zip(batch, created)]
+
+    def _post_one(self, key, record, context, rkey=None):
+        try:
+            response = self.client.app.bsky.feed.post.create(self.client.me.did, record, rkey=rkey)
+            self.stats["writes"] += 1
+            self.stats["posts"] += 1
+            return key, response.uri, context, None
+        except Exception as e:
+            if rkey and self._exists(rkey):
+                logging.info(f"⏭️ 投稿済み（rkey {rkey}）→ {key}")
+                self.stats["existing"] += 1
+                return key, f"at://{self.client.me.did}/{POST_COLLECTION}/{rkey}", context, None
+            return key, None, context, e
+
+    def _exists(self, rkey):
+        try:
+            self.client.app.bsky.feed.post.get(self.client.me.did, rkey)
+            return True
+        except Exception:
+            return False
+
+    def stats_message(self):
+        writes = self.stats["writes"]
+        ratio = self.stats["posts"] / writes if writes else 0.0
+        return (f"📊 まとめ投稿: {self.stats['posts']}件を{writes}回の書き込みで投稿（平均 {ratio:.1f}件/回）, "
+                f"1件ずつに切り替え {self.stats['fallbacks']}回, 投稿済みだった {self.stats['existing']}件, 失敗 {self.stats['failed']}件")
@@ -0,0 +1,133 @@
+# 🔽 ⏳ 締め切りを意識したスケジューラ
+# ジョブの残り時間（RUN_DEADLINE = 締め切りのUNIX時刻、またはRUN_BUDGET = 今からの秒数）と、
+# 最近の実測（種類ごとの所要時間の指数移動平均＋ばらつき）から、終わらせられる作業だけ始める
+# ・作業は優先度順（優先ワードの投稿 → メンション → タイムライン）
+# ・見積もりが残り時間に収まらない作業は始めずに残す（deferred）→ 次の実行で続き
+# ・実測はrun_metrics.jsonに保存して次の実行の見積もりに使う
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+RUN_DEADLINE = os.environ.get("RUN_DEADLINE")  # 例: ワークフロー開始時に $(date +%s)+540
+RUN_BUDGET = os.environ.get("RUN_BUDGET")  # 秒
+RUN_METRICS_FILE = os.environ.get("RUN_METRICS_FILE", "run_metrics.json")
+SAFETY_MARGIN = float(os.environ.get("RUN_SAFETY_MARGIN", "30"))  # 後片付け（保存・コミット）用に残す秒数
+METRICS_ALPHA = 0.3  # 指数移動平均の重み（新しい実測）
+
+PRIORITY_URGENT = 0  # 優先ワードを含む投稿
+PRIORITY_MENTION = 1  # 自分へのメンション・リプ
+PRIORITY_TIMELINE = 2
+
+# 実測が無いときの見積もり（秒）
+DEFAULT_COSTS = {
+    "model_load": 90.0,
+    "image": 2.0,  # ふわもこBotの画像解析（1投稿）
+    "fuwamoko_reply": 10.0,  # ふわもこBotの返信生成（1投稿）
+    "mention_reply": 20.0,  # 返信Botの返信生成（1通知）
+}
+
+def default_deadline():
+    if RUN_DEADLINE:
+        return float(RUN_DEADLINE)
+    if RUN_BUDGET:
+        return time.time() + float(RUN_BUDGET)
+    return None
+
+class DeadlineScheduler:
+    def __init__(self, deadline="env", metrics_file=RUN_METRICS_FILE, margin=SAFETY_MARGIN):
+        # deadline=None なら締め切りなし（ストリーム等）。並べ替えと実測だけ行う
+        self.deadline = default_deadline() if deadline == "env" else deadline
+        self.metrics_file = metrics_file
+        self.margin = margin
+        self.metrics = {}  # 種類 → {"mean": 秒, "dev": ばらつき, "count": 件数}
+        self.deferred = []
+        self.load()
+        if self.deadline is not None:
+            logging.info(f"⏳ 残り時間: {self.remaining():.0f}秒（後片付け用 {self.margin:.0f}秒を含む）")
+
+    def remaining(self):
+        if self.deadline is None:
+            return float("inf")
+        return self.deadline - time.time()
+
+    def estimate(self, kind, count=1):
+        # 平均＋ばらつき2つ分（少し多めに見積もって途中で切られないようにする）
+        metric = self.metrics.get(kind)
+        if metric is None:
+            return DEFAULT_COSTS.get(kind, 10.0) * count
+        return (metric["mean"] + 2 * metric["dev"]) * count
+
+    def fits(self, kind, count=1, extra=0.0):
+        return self.remaining() - self.margin >= self.estimate(kind, count) + extra
+
+    def record(self, kind, seconds, count=1):
+        per_item = seconds / max(1, count)
+        metric = self.metrics.get(kind)
+        if metric is None:
+            self.metrics[kind] = {"mean": per_item, "dev": per_item / 2, "count": count}
+            return
+        error = abs(per_item - metric["mean"])
+        metric["mean"] += METRICS_ALPHA * (per_item - metric["mean"])
+        metric["dev"] += METRICS_ALPHA * (error - metric["dev"])
+        metric["count"] += count
+
+    @contextmanager
+    def measure(self, kind, count=1):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(kind, time.time() - start, count)
+
+    def select(self, items, kinds, priority=None, extra=0.0):
+        # 優先度順に、見積もりの合計が残り時間に収まるところまで選ぶ（残りはdeferredへ）
+        # kinds: 1件あたりにかかる作業の種類（例: ("image", "fuwamoko_reply")）
+        ordered = sorted(items, key=priority) if priority else list(items)
+        per_item = sum(self.estimate(kind) for kind in kinds)
+        budget = self.remaining() - self.margin - extra
+        if per_item <= 0 or budget == float("inf"):
+            return ordered
+        count = max(0, min(len(ordered), int(budget // per_item)))
+        if count < len(ordered):
+            self.defer(ordered[count:], f"見積もり {per_item:.1f}秒/件, 残り {budget:.0f}秒")
+        return ordered[:count]
+
+    def run(self, items, kind, priority=None):
+        # 1件ずつ、始める前に間に合うか確認し、かかった時間を記録する
+        ordered = sorted(items, key=priority) if priority else list(items)
+        for i, item in enumerate(ordered):
+            if not self.fits(kind):
+                self.defer(ordered[i:], f"見積もり {self.estimate(kind):.1f}秒, 残り {self.remaining() - self.margin:.0f}秒")
+                return
+            with self.measure(kind):
+                yield item
+
+    def defer(self, items, reason):
+        self.deferred.extend(items)
+        logging.warning(f"⏳ 時間切れ見込み: {len(items)}件を次回に回します（{reason}）")
+
+    def load(self):
+        if not os.path.exists(self.metrics_file):
+            return
+        try:
+            with open(self.metrics_file, "r", encoding="utf-8") as f:
+                self.metrics = json.load(f)
+        except Exception as e:
+            logging.error(f"❌ 実測読み込みエラー: {type(e).__name__}: {e}")
+            self.metrics = {}
+
+    def save(self):
+        temp_file = self.metrics_file + ".tmp"
+        try:
+            with open(temp_file, "w", encoding="utf-8") as f:
+                json.dump(self.metrics, f, ensure_ascii=False)
+            os.replace(temp_file, self.metrics_file)
+        except Exception as e:
+            logging.error(f"❌ 実測保存エラー: {type(e).__name__}: {e}")
+
+    def summary(self):
+        estimates = ", ".join(f"{kind} {metric['mean']:.1f}秒" for kind, metric in sorted(self.metrics.items()))
+        remaining = "締め切りなし" if self.deadline is None else f"残り {self.remaining():.0f}秒"
+        return f"⏳ スケジューラ: {remaining}, 次回に回した作業 {len(self.deferred)}件, 平均所要 [{estimates}]"
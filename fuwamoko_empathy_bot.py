@@ -1,46 +1,77 @@
 # 🔽 📦 Pythonの標準ライブラリ
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import os
+import sys
 import time
 import random
-import requests
-from io import BytesIO
 import filelock
 import re
 import logging
-import cv2
 import numpy as np
-from urllib.parse import quote, unquote
-from PIL import Image, UnidentifiedImageError, ImageFile
-from copy import deepcopy
 import json
+import hashlib
+from types import MappingProxyType, SimpleNamespace
 
 # 🔽 🌱 外部ライブラリ
 from dotenv import load_dotenv
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from collections import Counter
+from transformers import LogitsProcessorList
 import torch
 
 # 🔽 📡 atproto関連
 from atproto import Client, models
 
-# ロギング設定
-logging.basicConfig(filename='debug.log', level=logging.DEBUG, format='%(asctime)s %(message)s', encoding='utf-8')
-logging.getLogger().addHandler(logging.StreamHandler())
+# 🔽 📝 履歴ストア
+from fuwamoko_history import FuwamokoHistory, parse_timestamp
 
-# PILのエラー抑制
-ImageFile.LOAD_TRUNCATED_IMAGES = True
+# 🔽 🖼️ 画像解析
+from fuwamoko_image import analyze_images, download_images, is_fluffy_by_color
 
-# 🔽 🧠 Transformers用設定
+# 🔽 🏷️ タグ判定
+from tag_engine import TagEngine
+
+# 🔽 🚫 NGワード制約付きデコード
+from ng_decoding import NGWordsLogitsProcessor
+
+# 🔽 🧠 共有モデル（multi_bot_runnerから動かすときは他のBotと同じインスタンス）
+from model_registry import get_model, get_ng_vocabulary, loaded_models
+
+# 🔽 🔎 検索型返信（テンプレで足りる投稿はモデルを呼ばない）
+from reply_retrieval import get_reply_index, pool_entries
+
+# 🔽 🗃️ 返信キャッシュ（短い単語入力は前に生成した返信を順番に使い回す）
+from reply_cache import get_reply_cache
+
+# 🔽 🌐 言語判定（本文の文字種で判定、決めきれないときだけプロフィール）
+from lang_detect import detect_text_language
+
+# 🔽 🌊 ストリーミング（--stream でタイムラインのポーリングの代わりにJetstreamから受け取る）
+from jetstream import run_stream, event_uri, event_record, has_image_embed
+STREAM_CURSOR_FILE = "fuwamoko_stream_cursor.json"
+STREAM_FOLLOW_REFRESH = 3600  # ストリーム中にフォロー一覧を差分同期する間隔（秒）
+
+# 🔽 🤝 複数ランナーでの分担（LEASE_STOREを設定したときだけ。著者DIDで担当を分け、返信はURIのリースで1回だけ）
+from lease_store import get_work_claimer
+
+# 🔽 📮 返信はためてapplyWritesでまとめて投稿
+from batch_poster import BatchPoster, new_tid, reply_record, reply_ref_from_dict, reply_ref_to_dict
+
+# 🔽 📒 画像の判定結果・生成した返信を作業キューに残し、キャンセル・タイムアウト後の実行で続きから再開
+from work_queue import get_work_queue
+
+# 🔽 ⏳ ジョブの残り時間（RUN_DEADLINE）に収まる分だけ、優先度順に処理する
+from deadline_scheduler import DeadlineScheduler, PRIORITY_URGENT, PRIORITY_MENTION, PRIORITY_TIMELINE
+
+# ロギング設定（debug.log + コンソール、書き込みは別スレッド）
+# 画像解析ワーカー（forkserver）が__mp_main__としてimportしたときはリスナースレッドを立てない
+from fuwamoko_logging import setup_logging, benchmark_logging
+if __name__ == "__main__":
+    setup_logging()
+uri_log = logging.getLogger("fuwamoko.uri")
+filter_log = logging.getLogger("fuwamoko.filter")
+
+# 🔽 🧠 Transformers用設定（読み込みは最初の返信生成時）
 MODEL_NAME = "cyberagent/open-calm-small"
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, cache_dir=".cache")
-model = AutoModelForCausalLM.from_pretrained(
-    MODEL_NAME,
-    cache_dir=".cache",
-    torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-    device_map="auto"
-)
-tokenizer.pad_token = tokenizer.eos_token
+MODEL_CACHE_DIR = ".cache"
 
 # 環境変数読み込み
 load_dotenv()
@@ -48,11 +79,29 @@ HANDLE = os.environ.get("HANDLE")
 APP_PASSWORD = os.environ.get("APP_PASSWORD")
 SESSION_FILE = "session_string.txt"
 FUWAMOKO_FILE = "fuwamoko_empathy_uris.txt"
+FUWAMOKO_BINARY_FILE = "fuwamoko_empathy_uris.bin"
 FUWAMOKO_LOCK = "fuwamoko_empathy_uris.lock"
+FUWAMOKO_HISTORY_FORMAT = os.environ.get("FUWAMOKO_HISTORY_FORMAT", "text")  # "text" または "binary"
+# タイムラインで遡る期間。これより古い投稿は処理せず、履歴からも期限切れで消す
+TIMELINE_LOOKBACK = timedelta(days=int(os.environ.get("FUWAMOKO_LOOKBACK_DAYS", "7")))
 
 # 🔽 テンプレ保護（チャッピー憲章）
+# テンプレは読み込み時にtuple/読み取り専用dictへ凍結する（実行中は書き換え不可）
 LOCK_TEMPLATES = True
-ORIGINAL_TEMPLATES = {
+
+def freeze_templates(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze_templates(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_templates(item) for item in value)
+    return value
+
+def template_hash(templates):
+    # 内容のSHA-256（キー順・list/tupleの違いに依存しない）
+    encoded = json.dumps(templates, ensure_ascii=False, sort_keys=True, default=dict)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+ORIGINAL_TEMPLATES = freeze_templates({
     "NORMAL_TEMPLATES_JP": [
         "うんうん、かわいいね！癒されたよ🐾💖",
         "よかったね〜！ふわふわだね🌸🧸",
@@ -107,7 +156,20 @@ ORIGINAL_TEMPLATES = {
         "oc": ["Your OC is precious… 🥺✨", "They have such a unique and magical world of their own 💖"],
         "fanart": ["Your interpretation is genius! 🙌", "I can feel your love for the original work ✨"]
     }
-}
+})
+TEMPLATES_HASH = template_hash(ORIGINAL_TEMPLATES)
+# 任意: デプロイ時に期待するハッシュを固定する
+EXPECTED_TEMPLATES_HASH = os.environ.get("FUWAMOKO_TEMPLATES_HASH")
+
+NORMAL_TEMPLATES_JP = ORIGINAL_TEMPLATES["NORMAL_TEMPLATES_JP"]
+SHONBORI_TEMPLATES_JP = ORIGINAL_TEMPLATES["SHONBORI_TEMPLATES_JP"]
+MOGUMOGU_TEMPLATES_JP = ORIGINAL_TEMPLATES["MOGUMOGU_TEMPLATES_JP"]
+NORMAL_TEMPLATES_EN = ORIGINAL_TEMPLATES["NORMAL_TEMPLATES_EN"]
+MOGUMOGU_TEMPLATES_EN = ORIGINAL_TEMPLATES["MOGUMOGU_TEMPLATES_EN"]
+COSMETICS_TEMPLATES_JP = ORIGINAL_TEMPLATES["COSMETICS_TEMPLATES_JP"]
+COSMETICS_TEMPLATES_EN = ORIGINAL_TEMPLATES["COSMETICS_TEMPLATES_EN"]
+CHARACTER_TEMPLATES_JP = ORIGINAL_TEMPLATES["CHARACTER_TEMPLATES_JP"]
+CHARACTER_TEMPLATES_EN = ORIGINAL_TEMPLATES["CHARACTER_TEMPLATES_EN"]
 
 # 🔽 グローバル辞書初期化
 try:
@@ -157,6 +219,29 @@ except KeyError:
 # 優先順位
 PRIORITY_ORDER = ["二次創作", "一次創作", "アニメ", "漫画", "イラスト"]
 
+SUSPICIOUS_KEYWORDS = [
+    "#グラビアアイドル", "#メンズエステ", "#名古屋メンエス", "#風俗", "#ご予約", "#DMで",
+    "マシュマロ", "性感", "体", "谷間", "胸元", "ランジェリー", "リピ様", "リンク"
+]
+AMBIGUOUS_WORDS = ["髪の毛", "オーラ", "トーク", "補正"]  # 中間ケース（髪やオーラ）
+
+# 🔽 🏷️ 全キーワード辞書を1つのオートマトンにまとめる（投稿テキストは1回だけ走査）
+# character:* / cosmetic:* は返信テンプレ選択用
+TAG_ENGINE = TagEngine({
+    **globals()["EMOTION_TAGS"],
+    **{f"character:{char_type}": words for char_type, words in globals()["SAFE_CHARACTER"].items()},
+    **{f"cosmetic:{cosmetic}": [cosmetic] for cosmetic in COSMETICS_TEMPLATES_JP},
+    "general": globals()["GENERAL_TAGS"],
+    "high_risk": globals()["HIGH_RISK_WORDS"],
+    "suspicious": SUSPICIOUS_KEYWORDS,
+    "neutral_ambiguous": AMBIGUOUS_WORDS,
+    "priority": ["@mirinchuuu"],
+})
+
+def scan_tags(text, lowered=False):
+    # {タグ: [(開始位置, 一致した語), ...]}
+    return TAG_ENGINE.scan(text, lowered)
+
 # テンプレ監査ログ
 TEMPLATE_AUDIT_LOG = "template_audit_log.txt"
 
@@ -173,24 +258,23 @@ def audit_templates_changes(old, new):
     except Exception as e:
         logging.error(f"❌ テンプレ監査エラー: {type(e).__name__}: {e}")
 
-def check_template_integrity(templates):
+def check_template_integrity():
+    # 起動時に1回だけ: 読み込み時のハッシュ・固定ハッシュと照合する
     if not LOCK_TEMPLATES:
         logging.warning("⚠️ LOCK_TEMPLATES無効、改変リスク")
         return False
-    for key in ORIGINAL_TEMPLATES:
-        if templates.get(key) != ORIGINAL_TEMPLATES[key]:
-            logging.error(f"⚠️ {key} 改変検出、復元推奨")
-            return False
+    current_hash = template_hash(ORIGINAL_TEMPLATES)
+    if current_hash != TEMPLATES_HASH:
+        logging.error(f"⚠️ テンプレ改変検出: {TEMPLATES_HASH[:12]} → {current_hash[:12]}")
+        audit_templates_changes(TEMPLATES_HASH, current_hash)
+        return False
+    if EXPECTED_TEMPLATES_HASH and current_hash != EXPECTED_TEMPLATES_HASH:
+        logging.error(f"⚠️ テンプレが固定ハッシュと不一致: {EXPECTED_TEMPLATES_HASH[:12]} → {current_hash[:12]}")
+        audit_templates_changes(EXPECTED_TEMPLATES_HASH, current_hash)
+        return False
+    logging.info(f"✅ テンプレ整合性OK: {current_hash[:12]}")
     return True
 
-def auto_revert_templates(templates):
-    if LOCK_TEMPLATES:
-        for key in ORIGINAL_TEMPLATES:
-            templates[key] = deepcopy(ORIGINAL_TEMPLATES[key])
-        logging.info("✅ テンプレ復元完了")
-        return templates
-    return templates
-
 fuwamoko_tone_map = [
     ("ありがとうございます", "ありがと🐰💓"),
     ("ありがとう", "ありがと♪"),
@@ -207,67 +291,6 @@ def apply_fuwamoko_tone(reply):
     reply = re.sub(r'(🐰💓)\.', r'\1', reply)  # 句点と絵文字の異常修正
     return reply
 
-def is_fluffy_color(r, g, b, bright_colors):
-    logging.debug(f"🧪 色判定: RGB=({r}, {g}, {b})")
-    hsv = cv2.cvtColor(np.array([[[r, g, b]]], dtype=np.uint8), cv2.COLOR_RGB2HSV)[0][0]
-    h, s, v = hsv
-    logging.debug(f"HSV=({h}, {s}, {v})")
-
-    # 食品色範囲（ハム/卵/おにぎり/豆腐、桃花除外）
-    if ((150 <= r <= 200 and 150 <= g <= 200 and 150 <= b <= 200) or  # ハム/卵
-        (220 <= r <= 250 and 220 <= g <= 250 and 210 <= b <= 230) or  # おにぎり
-        (230 <= r <= 255 and 200 <= g <= 230 and 130 <= b <= 160) or  # 豆腐
-        (r == 255 and g == 255 and b == 255)):                       # 純白
-        logging.debug("食品色（ハム/卵/おにぎり/豆腐/純白）検出、ふわもことみなさない")
-        return False
-
-    # 白系（明るさv > 130、単色閾値10）
-    if r > 180 and g > 180 and b > 180 and v > 130:
-        if bright_colors and len(bright_colors) > 0:
-            colors = np.array(bright_colors)
-            if np.std(colors, axis=0).max() < 10:
-                logging.debug("単色白系、ふわもことみなさない")
-                return False
-        logging.debug("白系検出（明るさOK、ピンク寄り含む）")
-        return True
-
-    # ピンク系（桃花優先）
-    if (r > 200 and g < 170 and b > 170 and v > 130) or \
-       (220 <= r <= 240 and 220 <= g <= 240 and 230 <= b <= 250):  # #232, 236, 247 対応
-        logging.debug("ピンク系検出（桃花優先、明るさOK）")
-        return True
-
-    # クリーム色
-    if r > 220 and g > 210 and b > 170 and v > 130:
-        logging.debug("クリーム色検出（広め）")
-        return True
-
-    # パステルパープル
-    if (r > 220 and g > 210 and b > 240 and abs(r - b) < 60 and v > 130) or \
-       (220 <= h <= 300 and s < 50 and v > 130):  # #F6DAF6, #E9DAF9 対応
-        logging.debug("パステルパープル検出（明るさOK）")
-        return True
-
-    # 白灰ピンク系
-    if r > 200 and g > 180 and b > 200 and v > 130:
-        logging.debug("ふわもこ白灰ピンク検出（桃花対応）")
-        return True
-
-    # 白灰系
-    if 200 <= r <= 255 and 200 <= g <= 240 and 200 <= b <= 255 and abs(r - g) < 30 and abs(r - b) < 30 and v > 130:
-        logging.debug("白灰ふわもこカラー（柔らか系）")
-        return True
-
-    if 200 <= h <= 300 and s < 80 and v > 130:
-        logging.debug("パステル系紫～ピンク検出（明るさOK）")
-        return True
-
-    if 190 <= h <= 260 and s < 100 and v > 130:
-        logging.debug("夜空パステル紫検出（広め、明るさOK）")
-        return True
-
-    return False
-
 def clean_output(text):
     text = re.sub(r'[\r\n]+', ' ', text)
     text = re.sub(r'\s{2,}', ' ', text)
@@ -280,41 +303,98 @@ def clean_output(text):
     text = re.sub(r'[。、！？]{2,}', lambda m: m.group(0)[0], text)
     return text.strip()
 
-def open_calm_reply(image_url, text="", context="ふわもこ共感", lang="ja"):
-    NG_WORDS = globals()["EMOTION_TAGS"].get("nsfw_ng", [])
-    NG_PHRASES = [
-        r"(?:投稿|ユーザー|例文|マスクット|マスケット|フォーラム|返事|会話|共感)",
-        r"(?:癒し系のふわもこマスコット|投稿内容に対して)",
-        r"[■#]{2,}",
-        r"!{5,}", r"\?{5,}", r"[!？]{5,}",
-        r"(?:(ふわ|もこ|もち|ぽこ)\1{3,})",
-        r"[♪~]{2,}",
-        r"(#\w+){3,}",
-        r"^[^\w\s]+$", r"(\w+\s*,){3,}", r"[\*:\.]{2,}"
-    ]
-    SEASONAL_WORDS_BLACKLIST = ["寒い", "あったまろ", "凍える", "冷たい"]
-
-    templates = deepcopy(ORIGINAL_TEMPLATES)
-    if not check_template_integrity(templates):
-        templates = auto_revert_templates(templates)
-    audit_templates_changes(ORIGINAL_TEMPLATES, templates)
-
-    NORMAL_TEMPLATES_JP = templates["NORMAL_TEMPLATES_JP"]
-    SHONBORI_TEMPLATES_JP = templates["SHONBORI_TEMPLATES_JP"]
-    MOGUMOGU_TEMPLATES_JP = templates["MOGUMOGU_TEMPLATES_JP"]
-    NORMAL_TEMPLATES_EN = templates["NORMAL_TEMPLATES_EN"]
-    MOGUMOGU_TEMPLATES_EN = templates["MOGUMOGU_TEMPLATES_EN"]
-    COSMETICS_TEMPLATES_JP = templates["COSMETICS_TEMPLATES_JP"]
-    COSMETICS_TEMPLATES_EN = templates["COSMETICS_TEMPLATES_EN"]
-    CHARACTER_TEMPLATES_JP = templates["CHARACTER_TEMPLATES_JP"]
-    CHARACTER_TEMPLATES_EN = templates["CHARACTER_TEMPLATES_EN"]
-
-    detected_tags = []
-    for tag, words in globals()["EMOTION_TAGS"].items():
-        if any(word in text.lower() for word in words):
-            detected_tags.append(tag)
-
-    if "food_ng" in detected_tags or any(word.lower() in text.lower() for word in NG_WORDS):
+# 🔽 出力チェック用の正規表現（起動時に1回だけコンパイル）
+NG_REPLY_WORDS = ["投稿", "ユーザー", "例文", "マスクット", "マスケット", "フォーラム", "返事", "会話", "共感"]
+NG_REPLY_PHRASES = ["癒し系のふわもこマスコット", "投稿内容に対して"]
+SEASONAL_WORDS_BLACKLIST = ["寒い", "あったまろ", "凍える", "冷たい"]
+NG_PHRASES = [
+    "(?:" + "|".join(NG_REPLY_WORDS) + ")",
+    "(?:" + "|".join(NG_REPLY_PHRASES) + ")",
+    r"[■#]{2,}",
+    r"!{5,}", r"\?{5,}", r"[!？]{5,}",
+    r"(?:(?P<repeat>ふわ|もこ|もち|ぽこ)(?P=repeat){3,})",  # 結合しても崩れないよう名前付きグループで後方参照
+    r"[♪~]{2,}",
+    r"(?:#\w+){3,}",
+    r"^[^\w\s]+$", r"(?:\w+\s*,){3,}", r"[\*:\.]{2,}"
+]
+NG_PHRASE_PATTERN = re.compile("|".join(f"(?:{phrase})" for phrase in NG_PHRASES))
+SEASONAL_WORDS_PATTERN = re.compile("|".join(SEASONAL_WORDS_BLACKLIST))
+SENTENCE_PATTERN = re.compile(r'(です|ます|ね|よ|だ|る|た|に|を|が|は)')
+ONOMATOPOEIA_ONLY_PATTERN = re.compile(r'[ぁ-んー゛゜。、\s「」！？]+')
+REPLY_EMOJI_PATTERN = re.compile(r"[🌸💕🐾☁️🐰✨♡]")
+
+# 生成中にNGワードを出させない（NG_DECODING=0で従来どおり生成後チェックのみ）
+NG_DECODING = os.environ.get("NG_DECODING", "1") == "1"
+generation_stats = {"generated": 0, "rejected": 0, "retrieved": 0}
+# テキストがテンプレに十分近ければ生成しない（FUWAMOKO_RETRIEVAL=0で常に生成）
+FUWAMOKO_RETRIEVAL = os.environ.get("FUWAMOKO_RETRIEVAL", "1") == "1"
+
+def get_ng_logits_processor(prompt_length):
+    if not NG_DECODING:
+        return LogitsProcessorList()
+    ng_vocabulary = get_ng_vocabulary(
+        MODEL_NAME,
+        NG_REPLY_WORDS + NG_REPLY_PHRASES + SEASONAL_WORDS_BLACKLIST + globals()["EMOTION_TAGS"]["nsfw_ng"]
+    )
+    return LogitsProcessorList([NGWordsLogitsProcessor(ng_vocabulary, prompt_length)])
+
+def reject_reply(reason):
+    generation_stats["rejected"] += 1
+    logging.warning(reason)
+
+def template_entries(lang):
+    if lang == "ja":
+        entries = pool_entries("normal", NORMAL_TEMPLATES_JP) + pool_entries("shonbori", SHONBORI_TEMPLATES_JP)
+        grouped = {**{f"cosmetic:{k}": v for k, v in COSMETICS_TEMPLATES_JP.items()},
+                   **{f"character:{k}": v for k, v in CHARACTER_TEMPLATES_JP.items()}}
+    else:
+        entries = pool_entries("normal", NORMAL_TEMPLATES_EN)
+        grouped = {**{f"cosmetic:{k}": v for k, v in COSMETICS_TEMPLATES_EN.items()},
+                   **{f"character:{k}": v for k, v in CHARACTER_TEMPLATES_EN.items()}}
+    for group, templates in grouped.items():
+        entries += pool_entries(group, templates)
+    return entries
+
+# 言語 → 返信インデックス。テンプレはimport時に固定されるので、候補の組み立てとキーのハッシュは言語ごとに1回だけ
+template_indexes = {}
+
+def template_index(lang):
+    lang = "ja" if lang == "ja" else "en"
+    if lang not in template_indexes:
+        template_indexes[lang] = get_reply_index(f"fuwamoko_{lang}", template_entries(lang))
+    return template_indexes[lang]
+
+def retrieve_template(text, lang):
+    if not FUWAMOKO_RETRIEVAL or not text.strip():
+        return None
+    try:
+        match = template_index(lang).best_match(text)
+    except Exception as e:
+        logging.error(f"❌ テンプレ検索エラー: {type(e).__name__}: {e}")
+        return None
+    if match is None:
+        return None
+    reply, score, group = match
+    generation_stats["retrieved"] += 1
+    logging.info(f"🔎 テンプレで返信: {reply}（{group}, 類似度 {score:.2f}）")
+    return reply
+
+def log_generation_stats():
+    if generation_stats["retrieved"]:
+        logging.info(f"📊 テンプレ検索で返信: {generation_stats['retrieved']}件（AI生成なし）")
+    generated = generation_stats["generated"]
+    if generated:
+        rejected = generation_stats["rejected"]
+        logging.info(f"📊 AI生成: {generated}件, 不採用 {rejected}件（{rejected / generated:.0%}）, NG制約デコード: {'有効' if NG_DECODING else '無効'}")
+
+def open_calm_reply(image_url, text="", context="ふわもこ共感", lang="ja", tags=None):
+    if tags is None:
+        tags = scan_tags(text)
+    fallback_templates = NORMAL_TEMPLATES_JP if lang == "ja" else NORMAL_TEMPLATES_EN
+
+    detected_tags = [tag for tag in globals()["EMOTION_TAGS"] if tag in tags]
+
+    if "food_ng" in detected_tags or "nsfw_ng" in detected_tags:
         logging.debug(f"🍽️ NGワード/食事検出: {text[:40]}")
         return random.choice(MOGUMOGU_TEMPLATES_JP) if lang == "ja" else random.choice(MOGUMOGU_TEMPLATES_EN)
     elif "shonbori" in detected_tags:
@@ -322,25 +402,35 @@ def open_calm_reply(image_url, text="", context="ふわもこ共感", lang="ja")
     elif "safe_cosmetics" in detected_tags:
         if lang == "ja":
             for cosmetic, templates in COSMETICS_TEMPLATES_JP.items():
-                if cosmetic in text.lower():
+                if f"cosmetic:{cosmetic}" in tags:
                     return random.choice(templates)
         else:
             for cosmetic, templates in COSMETICS_TEMPLATES_EN.items():
-                if any(word in text.lower() for word in globals()["EMOTION_TAGS"]["safe_cosmetics"]):
+                if "safe_cosmetics" in tags:
                     return random.choice(templates)
     elif any(tag in detected_tags for tag in globals()["SAFE_CHARACTER"]):
         if lang == "ja":
             for char_type, templates in CHARACTER_TEMPLATES_JP.items():
-                if any(word in text.lower() for word in globals()["SAFE_CHARACTER"][char_type]):
+                if f"character:{char_type}" in tags:
                     return random.choice(templates)
         else:
             for char_type, templates in CHARACTER_TEMPLATES_EN.items():
-                if any(word in text.lower() for word in globals()["SAFE_CHARACTER"][char_type]):
+                if f"character:{char_type}" in tags:
                     return random.choice(templates)
-    elif any(word in text.lower() for word in globals()["GENERAL_TAGS"]):
-        return random.choice(NORMAL_TEMPLATES_JP) if lang == "ja" else random.choice(NORMAL_TEMPLATES_EN)
+    elif "general" in tags:
+        return random.choice(fallback_templates)
+
+    retrieved = retrieve_template(text, lang)
+    if retrieved:
+        return retrieved
 
     # 単語入力対応
+    short_text = text.strip() if len(text.strip()) <= 4 else None
+    if short_text:
+        cached = get_reply_cache().get(short_text, "fuwamoko", lang)
+        if cached:
+            logging.info(f"🗃️ キャッシュから返信: {cached}")
+            return cached
     if len(text.strip()) <= 4:
         suffixes = [
             "って癒されるよね〜",
@@ -365,6 +455,7 @@ def open_calm_reply(image_url, text="", context="ふわもこ共感", lang="ja")
     )
     logging.debug(f"🧪 プロンプト確認: {prompt}")
 
+    model, tokenizer = get_model(MODEL_NAME, MODEL_CACHE_DIR)
     inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=150).to(model.device)
     try:
         outputs = model.generate(
@@ -375,8 +466,10 @@ def open_calm_reply(image_url, text="", context="ふわもこ共感", lang="ja")
             temperature=0.6,
             top_k=30,
             top_p=0.9,
-            no_repeat_ngram_size=3
+            no_repeat_ngram_size=3,
+            logits_processor=get_ng_logits_processor(inputs["input_ids"].shape[1])
         )
+        generation_stats["generated"] += 1
         raw_reply = tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
         logging.debug(f"🧸 Raw AI出力（生データ）: {raw_reply}")
         logging.debug(f"🧸 AI出力（クリーン後）: {clean_output(raw_reply)}")
@@ -385,37 +478,39 @@ def open_calm_reply(image_url, text="", context="ふわもこ共感", lang="ja")
         reply = apply_fuwamoko_tone(reply)
 
         if not reply or len(reply) < 5:
-            logging.warning(f"⏭️ SKIP: 空または短すぎ: len={len(reply)}, テキスト: {reply[:60]}, 理由: 生成失敗")
-            return random.choice(NORMAL_TEMPLATES_JP) if lang == "ja" else random.choice(NORMAL_TEMPLATES_EN)
+            reject_reply(f"⏭️ SKIP: 空または短すぎ: len={len(reply)}, テキスト: {reply[:60]}, 理由: 生成失敗")
+            return random.choice(fallback_templates)
 
-        if not re.search(r'(です|ます|ね|よ|だ|る|た|に|を|が|は)', reply) or re.fullmatch(r'[ぁ-んー゛゜。、\s「」！？]+', reply):
-            logging.warning(f"⏭️ SKIP: 文章不成立: テキスト: {reply[:60]}, 理由: 文法不十分または擬音語のみ")
-            return random.choice(NORMAL_TEMPLATES_JP) if lang == "ja" else random.choice(NORMAL_TEMPLATES_EN)
+        if not SENTENCE_PATTERN.search(reply) or ONOMATOPOEIA_ONLY_PATTERN.fullmatch(reply):
+            reject_reply(f"⏭️ SKIP: 文章不成立: テキスト: {reply[:60]}, 理由: 文法不十分または擬音語のみ")
+            return random.choice(fallback_templates)
 
         if len(reply) < 10 or len(reply) > 70:
-            logging.warning(f"⏭️ SKIP: 長さ不適切: len={len(reply)}, テキスト: {reply[:60]}, 理由: 長さ超過/不足")
-            return random.choice(NORMAL_TEMPLATES_JP) if lang == "ja" else random.choice(NORMAL_TEMPLATES_EN)
+            reject_reply(f"⏭️ SKIP: 長さ不適切: len={len(reply)}, テキスト: {reply[:60]}, 理由: 長さ超過/不足")
+            return random.choice(fallback_templates)
 
-        for bad in NG_PHRASES:
-            if re.search(bad, reply):
-                logging.warning(f"⏭️ SKIP: NGフレーズ検出: {bad}, テキスト: {reply[:60]}, 理由: NGフレーズ")
-                return random.choice(NORMAL_TEMPLATES_JP) if lang == "ja" else random.choice(NORMAL_TEMPLATES_EN)
+        bad = NG_PHRASE_PATTERN.search(reply)
+        if bad:
+            reject_reply(f"⏭️ SKIP: NGフレーズ検出: {bad.group(0)}, テキスト: {reply[:60]}, 理由: NGフレーズ")
+            return random.choice(fallback_templates)
 
-        if any(word in reply for word in SEASONAL_WORDS_BLACKLIST):
-            logging.warning("⏭️ SKIP: 季節不一致: 寒さ表現あり")
+        if SEASONAL_WORDS_PATTERN.search(reply):
+            reject_reply("⏭️ SKIP: 季節不一致: 寒さ表現あり")
             return random.choice(NORMAL_TEMPLATES_JP)
 
         if reply.count("もふもふ") > 1:
             reply = reply.replace("もふもふ", "ふわふわ", 1)
 
-        if not re.search(r"[🌸💕🐾☁️🐰✨♡]", reply):
+        if not REPLY_EMOJI_PATTERN.search(reply):
             reply += " " + random.choice(["🐰", "🌸", "💕"])
 
+        if short_text:
+            get_reply_cache().put(short_text, reply, "fuwamoko", lang)
         logging.info(f"🦊 AI生成成功: {reply}, 長さ: {len(reply)}")
         return reply
     except Exception as e:
         logging.error(f"❌ AI生成エラー: {type(e).__name__}: {e}")
-        return random.choice(NORMAL_TEMPLATES_JP) if lang == "ja" else random.choice(NORMAL_TEMPLATES_EN)
+        return random.choice(fallback_templates)
 
 def extract_valid_cid(ref):
     try:
@@ -428,215 +523,202 @@ def extract_valid_cid(ref):
         logging.error(f"❌ CID抽出エラー: {type(e).__name__}: {e}")
         return None
 
-def check_skin_ratio(img_pil_obj):
+# 🔽 🤝 フォローグラフ（自分のフォロワー/フォローを全件同期してディスクに保存）
+FOLLOW_GRAPH_FILE = "follow_graph.json"
+FOLLOW_GRAPH_FULL_SYNC_INTERVAL = int(os.environ.get("FOLLOW_GRAPH_FULL_SYNC_INTERVAL", str(24 * 3600)))
+follow_graph = {"followers": set(), "follows": set(), "full_synced_at": 0.0, "refreshed_at": 0.0}
+
+def load_follow_graph():
+    if not os.path.exists(FOLLOW_GRAPH_FILE):
+        return follow_graph
     try:
-        if img_pil_obj is None:
-            logging.debug("画像データ無効 (PIL ImageオブジェクトがNone)")
-            return 0.0
-
-        img_pil_obj = img_pil_obj.convert("RGB")
-        img_np = cv2.cvtColor(np.array(img_pil_obj), cv2.COLOR_RGB2BGR)
-        if img_np is None or img_np.size == 0:
-            logging.error("❌ 画像データ無効")
-            return 0.0
-
-        hsv_img = cv2.cvtColor(img_np, cv2.COLOR_BGR2HSV)
-        lower = np.array([5, 50, 70], dtype=np.uint8)
-        upper = np.array([20, 150, 240], dtype=np.uint8)
-        mask = cv2.inRange(hsv_img, lower, upper)
-        skin_colors = img_np[mask > 0]
-
-        if skin_colors.size > 0:
-            avg_color = np.mean(skin_colors, axis=0)
-            logging.debug(f"平均肌色: BGR={avg_color}")
-            if np.mean(avg_color) > 220:
-                logging.debug("→ 明るすぎるので肌色ではなく白とみなす")
-                return 0.0
-
-        skin_area = np.sum(mask > 0)
-        total_area = img_np.shape[0] * img_np.shape[1]
-        skin_ratio = skin_area / total_area if total_area > 0 else 0.0
-        logging.debug(f"肌色比率: {skin_ratio:.2%}")
-        return skin_ratio
+        with open(FOLLOW_GRAPH_FILE, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        follow_graph["followers"] = set(snapshot.get("followers", []))
+        follow_graph["follows"] = set(snapshot.get("follows", []))
+        follow_graph["full_synced_at"] = snapshot.get("full_synced_at", 0.0)
+        follow_graph["refreshed_at"] = snapshot.get("refreshed_at", 0.0)
+        logging.info(f"🟢 フォローグラフ読み込み: フォロワー {len(follow_graph['followers'])}件, フォロー {len(follow_graph['follows'])}件")
     except Exception as e:
-        logging.error(f"❌ 肌色解析エラー: {type(e).__name__}: {e}")
-        return 0.0
+        logging.error(f"❌ フォローグラフ読み込みエラー: {type(e).__name__}: {e}")
+    return follow_graph
 
-def is_mutual_follow(client, handle):
+def save_follow_graph():
+    temp_file = FOLLOW_GRAPH_FILE + ".tmp"
     try:
-        their_followers = {f.handle for f in client.get_followers(actor=handle, limit=100).followers}
-        my_followers = {f.handle for f in client.get_followers(actor=HANDLE, limit=100).followers}
-        return handle in my_followers and HANDLE in their_followers
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                "followers": sorted(follow_graph["followers"]),
+                "follows": sorted(follow_graph["follows"]),
+                "full_synced_at": follow_graph["full_synced_at"],
+                "refreshed_at": follow_graph["refreshed_at"],
+            }, f)
+        os.replace(temp_file, FOLLOW_GRAPH_FILE)
     except Exception as e:
-        logging.error(f"❌ 相互フォロー判定エラー: {type(e).__name__}: {e}")
-        return False
-
-def download_image_from_blob(cid, client, did=None):
-    if not cid or not re.match(r'^baf[a-z0-9]{40,60}$', cid):
-        logging.error(f"❌ 無効なCID: {cid}")
-        return None
-
-    if client and did:
-        try:
-            blob = client.get_blob(cid=cid, did=did)
-            img_data = BytesIO(blob.data)
-            img = Image.open(img_data)
-            img.load()
-            logging.info(f"🟢 Blob画像形式={img.format}, サイズ={img.size}")
-            return img
-        except Exception as e:
-            logging.error(f"❌ Blob APIエラー: {type(e).__name__}: {e}")
-
-    did_safe = unquote(did) if did else None
-    cdn_urls = [
-        f"https://cdn.bsky.app/img/feed_thumbnail/plain/{quote(did_safe)}/{quote(cid)}@jpeg" if did_safe else None,
-        f"https://cdn.bsky.app/img/feed_fullsize/plain/{quote(did_safe)}/{quote(cid)}@jpeg" if did_safe else None
-    ]
-    headers = {"User-Agent": "Mozilla/5.0"}
-
-    for url in [u for u in cdn_urls if u]:
-        try:
-            response = requests.get(url, headers=headers, timeout=10, stream=True)
-            response.raise_for_status()
-            img_data = BytesIO(response.content)
-            img = Image.open(img_data)
-            img.load()
-            logging.info(f"🟢 画像形式={img.format}, サイズ={img.size}")
-            return img
-        except Exception as e:
-            logging.error(f"❌ CDN取得失敗: {type(e).__name__}: {e}, url={url}")
-            continue
-
-    logging.error("❌ 画像取得失敗")
-    return None
-
-def process_image(image_data, text="", client=None, post=None):
-    if not hasattr(image_data, 'image') or not hasattr(image_data.image, 'ref'):
-        logging.debug("画像データ構造異常")
-        return False
-
-    cid = extract_valid_cid(image_data.image.ref)
-    if not cid:
-        return False
-
+        logging.error(f"❌ フォローグラフ保存エラー: {type(e).__name__}: {e}")
+
+def fetch_follow_list(fetch, field, actor, known=None):
+    # cursorで全ページ取得。knownを渡すと既知DIDだけのページで打ち切る（新しい順なので差分同期になる）
+    dids = []
+    cursor = None
+    while True:
+        response = fetch(actor=actor, cursor=cursor, limit=100)
+        page = [profile.did for profile in getattr(response, field)]
+        dids.extend(page)
+        cursor = response.cursor
+        if not cursor or not page or (known is not None and all(did in known for did in page)):
+            return dids
+
+def sync_follow_graph(client):
+    me = client.me.did
+    full = time.time() - follow_graph["full_synced_at"] > FOLLOW_GRAPH_FULL_SYNC_INTERVAL
     try:
-        author_did = post.post.author.did if post and hasattr(post, 'post') else None
-        img = download_image_from_blob(cid, client, did=author_did)
-        if img is None:
-            logging.warning("⏭️ スキップ: 画像取得失敗（ログは上記）")
-            return False
-
-# モデルロード（グローバルスコープに追加）
-fuwamoko_model = torch.jit.load("fuwamoko_model.pt").to("cuda")  # GitHub Actions用にCPUで
-
-def process_image(image_data, text="", client=None, post=None):
-    if not hasattr(image_data, 'image') or not hasattr(image_data.image, 'ref'):
-        logging.debug("画像データ構造異常")
-        return False
-
-    cid = extract_valid_cid(image_data.image.ref)
-    if not cid:
-        return False
+        # 両方取れてから反映する（途中で失敗しても前回のグラフが残る）
+        synced = {}
+        for field, fetch in (("followers", client.get_followers), ("follows", client.get_follows)):
+            if full:
+                synced[field] = set(fetch_follow_list(fetch, field, me))
+            else:
+                synced[field] = follow_graph[field] | set(fetch_follow_list(fetch, field, me, known=follow_graph[field]))
+        follow_graph.update(synced)
+        now = time.time()
+        follow_graph["refreshed_at"] = now
+        if full:
+            follow_graph["full_synced_at"] = now
+        logging.info(f"🟢 フォローグラフ{'全件' if full else '差分'}同期: フォロワー {len(follow_graph['followers'])}件, フォロー {len(follow_graph['follows'])}件")
+        save_follow_graph()
+    except Exception as e:
+        logging.error(f"❌ フォローグラフ同期エラー: {type(e).__name__}: {e}")
 
+def is_mutual_follow(client, did, viewer=None):
     try:
-        author_did = post.post.author.did if post and hasattr(post, 'post') else None
-        img = download_image_from_blob(cid, client, did=author_did)
-        if img is None:
-            logging.warning("⏭️ スキップ: 画像取得失敗（ログは上記）")
-            return False
-
-        # PyTorch用にリサイズと前処理
-        transform = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
-        img_tensor = transform(img).unsqueeze(0).to("cuda")
-
-        # 推論
-        with torch.no_grad():
-            output = fuwamoko_model(img_tensor)
-            _, predicted = torch.max(output, 1)
-            category = ["other", "food", "fuwamoko"][predicted.item()]
-            logging.debug(f"🧪 PyTorch推論結果: {category}")
-
-        # 色検知も併用（バックアップ）
-        resized_img = img.resize((64, 64))
-        hsv_img = cv2.cvtColor(np.array(resized_img), cv2.COLOR_RGB2HSV)
-        bright_colors = [(r, g, b) for (r, g, b), (_, s, v) in zip(resized_img.getdata(), hsv_img.reshape(-1, 3)) if v > 130]
-        color_counts = Counter(bright_colors)
-        top_colors = color_counts.most_common(5)
-        logging.debug(f"トップ5カラー（明度フィルター後）: {[(c[0], c[1]) for c in top_colors]}")
-
-        fluffy_count = 0
-        bright_color_count = 0
-        food_color_count = 0
-        for color, _ in top_colors:
-            r, g, b = color
-            if is_fluffy_color(r, g, b, bright_colors):
-                fluffy_count += 1
-            if r > 180 and g > 180 and b > 180:
-                bright_color_count += 1
-            if ((150 <= r <= 200 and 150 <= g <= 200 and 150 <= b <= 200) or  # ハム/卵
-                (220 <= r <= 250 and 220 <= g <= 250 and 210 <= b <= 230) or  # おにぎり
-                (230 <= r <= 255 and 200 <= g <= 230 and 130 <= b <= 160) or  # 豆腐
-                (r == 255 and g == 255 and b == 255)):                       # 純白
-                food_color_count += 1
-        logging.debug(f"ふわもこ色カウント: {fluffy_count}, 明るい色数: {bright_color_count}, 食品色数: {food_color_count}")
-
-        skin_ratio = check_skin_ratio(img)
-        food_ratio = food_color_count / 5 if top_colors else 0.0
-        logging.debug(f"肌色比率: {skin_ratio:.2%}, 食品色比率: {food_ratio:.2%}, ふわもこカラー数: {fluffy_count}")
-
-        # 最終判定
-        if category == "fuwamoko" or (fluffy_count >= 2 and food_ratio <= 0.2 and skin_ratio < 0.5):
-            logging.info("🟢 ふわもこ色検出またはPyTorch判定成功")
-            return True
-        elif category == "food" or food_ratio > 0.2:
-            logging.warning(f"⏭️ スキップ: 食品色比率 {food_ratio:.2%} > 20% または PyTorch判定")
-            return False
-        else:
-            logging.warning("⏭️ スキップ: 色条件不足またはPyTorch判定")
-            return False
-
-        check_text = text.lower()
-        try:
-            if any(word in check_text for word in globals()["HIGH_RISK_WORDS"]):
-                if skin_ratio < 0.4 and fluffy_count >= 2:
-                    logging.info("🟢 高リスクだが条件OK")
-                    return True
-                else:
-                    logging.warning("⏭️ スキップ: 高リスク＋条件NG")
-                    return False
-            if any(word in check_text for word in globals()["EMOTION_TAGS"]["nsfw_ng"]):
-                logging.warning("⏭️ スキップ: NSFW関連検出")
-                return False
-        except KeyError as e:
-            logging.error(f"❌ グローバル辞書エラー: {type(e).__name__}: {e}")
-            return False
-
+        # タイムラインの著者ビューにある関係情報が最優先（ネットワーク不要）
+        if viewer is not None and hasattr(viewer, 'following') and hasattr(viewer, 'followed_by'):
+            return bool(viewer.following) and bool(viewer.followed_by)
+        # 同期済みのフォローグラフ
+        if follow_graph["refreshed_at"]:
+            return did in follow_graph["followers"] and did in follow_graph["follows"]
+        # どちらも無いときだけネットワーク
+        viewer = client.get_profile(actor=did).viewer
+        return bool(viewer and viewer.following and viewer.followed_by)
     except Exception as e:
-        logging.error(f"❌ 画像処理エラー: {type(e).__name__}: {e} (cid={cid}, uri={getattr(post, 'uri', 'unknown')})")
+        logging.error(f"❌ 相互フォロー判定エラー: {type(e).__name__}: {e}")
         return False
-        
-def is_quoted_repost(post):
-    try:
-        actual_post = post.post if hasattr(post, 'post') else post
-        record = getattr(actual_post, 'record', None)
-        if record and hasattr(record, 'embed') and record.embed:
-            embed = record.embed
-            logging.debug(f"引用リポストチェック: {embed}")
-            if hasattr(embed, 'record') and embed.record:
-                logging.debug("引用リポスト検出（record）")
-                return True
-            elif hasattr(embed, 'record') and hasattr(embed.record, 'record') and embed.record.record:
-                logging.debug("引用リポスト検出（recordWithMedia）")
-                return True
+
+# 🔽 🧸 ふわもこ画像分類器（TorchScript）
+FUWAMOKO_MODEL_FILE = "fuwamoko_model.pt"
+FUWAMOKO_CATEGORIES = ["other", "food", "fuwamoko"]
+CLASSIFIER_BATCH_SIZE = int(os.environ.get("CLASSIFIER_BATCH_SIZE", "16"))
+fuwamoko_model = None
+classifier_device = None
+
+# ImageNet正規化（torchvisionのToTensor+Normalize相当）
+CLASSIFIER_MEAN = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+CLASSIFIER_STD = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+def load_fuwamoko_model():
+    # GPUがあればGPU、なければCPU（GitHub ActionsはCPU）
+    global fuwamoko_model, classifier_device
+    if fuwamoko_model is None:
+        classifier_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        if not os.path.exists(FUWAMOKO_MODEL_FILE):
+            logging.warning(f"⚠️ 分類器なし: {FUWAMOKO_MODEL_FILE}、色判定のみで続行")
+            return None, classifier_device
+        fuwamoko_model = torch.jit.load(FUWAMOKO_MODEL_FILE, map_location=classifier_device).eval()
+        logging.info(f"🟢 分類器読み込み完了: device={classifier_device}")
+    return fuwamoko_model, classifier_device
+
+def to_classifier_batch(pixels_list, device):
+    # uint8のまま転送してからデバイス側で正規化（HWC → NCHW）
+    batch = torch.from_numpy(np.stack(pixels_list)).to(device)
+    batch = batch.permute(0, 3, 1, 2).float().div_(255.0)
+    return (batch - CLASSIFIER_MEAN.to(device)) / CLASSIFIER_STD.to(device)
+
+def classify_images(pixels_list, batch_size=CLASSIFIER_BATCH_SIZE):
+    # 1バッチ1回のforwardで、画像ごとの確率（other/food/fuwamoko）を返す
+    model, device = load_fuwamoko_model()
+    if model is None or not pixels_list:
+        return [None] * len(pixels_list)
+    probabilities = []
+    with torch.inference_mode():
+        for start in range(0, len(pixels_list), batch_size):
+            batch = to_classifier_batch(pixels_list[start:start + batch_size], device)
+            probabilities.extend(torch.softmax(model(batch), dim=1).cpu().numpy())
+    return probabilities
+
+def judge_image(features, probs=None):
+    category = FUWAMOKO_CATEGORIES[int(np.argmax(probs))] if probs is not None else None
+    if category:
+        logging.debug("🧪 PyTorch推論結果: %s (確率=%s)", category, np.round(probs, 3).tolist())
+    food_ratio = features["food_ratio"]
+
+    # 最終判定
+    if category == "fuwamoko" or is_fluffy_by_color(features):
+        logging.info("🟢 ふわもこ色検出またはPyTorch判定成功")
+        return True
+    elif category == "food" or food_ratio > 0.2:
+        logging.warning(f"⏭️ スキップ: 食品色比率 {food_ratio:.2%} > 20% または PyTorch判定")
         return False
-    except Exception as e:
-        logging.error(f"❌ 引用リポストチェックエラー: {type(e).__name__}: {e}")
+    else:
+        logging.warning("⏭️ スキップ: 色条件不足またはPyTorch判定")
         return False
 
+def iter_image_jobs(candidates):
+    # タイムライン上の全候補画像を (key, 投稿者DID, CID) にする
+    for ci, candidate in enumerate(candidates):
+        for i, image_data in enumerate(candidate.image_refs):
+            if not hasattr(image_data, 'image') or not hasattr(image_data.image, 'ref'):
+                logging.debug("画像データ構造異常")
+                continue
+            cid = extract_valid_cid(image_data.image.ref)
+            if cid:
+                yield (ci, i), candidate.author_did, cid
+
+def analyze_candidates(candidates, client, workers=None):
+    # タイムライン全体の候補画像をワーカープールで解析し、まとめて分類器にかける
+    start = time.perf_counter()
+    # ネットワークはメインプロセス（スレッドで並列取得）、取れた画像から順に解析ワーカーへ流す
+    jobs = list(iter_image_jobs(candidates))
+    print(f"🦊 画像取得開始: {len(jobs)} 枚（候補 {len(candidates)} 件）")
+    downloads = download_images(jobs, fallback=lambda cid, did: client.get_blob(cid=cid, did=did).data)
+    features_by_key = analyze_images(downloads, workers=workers)
+
+    pending = []
+    for ci, candidate in enumerate(candidates):
+        candidate.image_features = [features_by_key.get((ci, i)) for i in range(len(candidate.image_refs))]
+        # 色判定だけでふわもこ確定する画像は分類器に回さない（安い前段フィルター）
+        pending.extend(f for f in candidate.image_features if f is not None and "pixels" in f)
+
+    for features, probs in zip(pending, classify_images([f["pixels"] for f in pending])):
+        features["probs"] = probs
+
+    for candidate in candidates:
+        verdicts = [judge_image(f, f.get("probs")) for f in candidate.image_features if f is not None]
+        candidate.is_fuwamoko = any(verdicts)
+    record_stage("画像解析", time.perf_counter() - start, checked=len(candidates),
+                 rejected=sum(1 for c in candidates if not c.is_fuwamoko))
+    return candidates
+
+def benchmark_classifier(batch_sizes=(1, 2, 4, 8, 16, 32, 64), n_images=128, repeats=3):
+    # CPU/GPUでのバッチサイズ別スループット（画像/秒）
+    model, device = load_fuwamoko_model()
+    if model is None:
+        print(f"❌ 分類器がないためベンチマーク不可: {FUWAMOKO_MODEL_FILE}")
+        return {}
+    rng = np.random.default_rng(0)
+    pixels_list = list(rng.integers(0, 256, size=(n_images, 224, 224, 3), dtype=np.uint8))
+    classify_images(pixels_list[:batch_sizes[0]], batch_size=batch_sizes[0])  # ウォームアップ
+    results = {}
+    for batch_size in batch_sizes:
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            classify_images(pixels_list, batch_size=batch_size)
+            best = min(best, time.perf_counter() - start)
+        results[batch_size] = n_images / best
+        print(f"📊 batch_size={batch_size:>2}: {results[batch_size]:.1f} 画像/秒 (device={device})")
+    return results
+
 def load_reposted_uris():
     REPOSTED_FILE = "reposted_uris.txt"
     if os.path.exists(REPOSTED_FILE):
@@ -650,10 +732,78 @@ def load_reposted_uris():
             return set()
     return set()
 
-def detect_language(client, handle):
+# 🔽 👤 プロフィールキャッシュ（DIDごと、TTL付き、ディスクにスナップショット）
+PROFILE_CACHE_FILE = "profile_cache.json"
+PROFILE_CACHE_TTL = int(os.environ.get("PROFILE_CACHE_TTL", str(6 * 3600)))
+PROFILE_BATCH_SIZE = 25  # app.bsky.actor.getProfilesの上限
+profile_cache = {}
+
+def load_profile_cache():
+    global profile_cache
+    profile_cache = {}
+    if not os.path.exists(PROFILE_CACHE_FILE):
+        return profile_cache
+    try:
+        with open(PROFILE_CACHE_FILE, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        now = time.time()
+        profile_cache = {did: p for did, p in snapshot.items() if now - p.get("fetched_at", 0) < PROFILE_CACHE_TTL}
+        logging.info(f"🟢 プロフィールキャッシュ読み込み: {len(profile_cache)}/{len(snapshot)}件（期限内）")
+    except Exception as e:
+        logging.error(f"❌ プロフィールキャッシュ読み込みエラー: {type(e).__name__}: {e}")
+    return profile_cache
+
+def save_profile_cache():
+    temp_file = PROFILE_CACHE_FILE + ".tmp"
+    try:
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(profile_cache, f, ensure_ascii=False)
+        os.replace(temp_file, PROFILE_CACHE_FILE)
+    except Exception as e:
+        logging.error(f"❌ プロフィールキャッシュ保存エラー: {type(e).__name__}: {e}")
+
+def cache_profile(profile):
+    profile_cache[profile.did] = {
+        "handle": profile.handle,
+        "display_name": getattr(profile, "display_name", None) or "",
+        "description": getattr(profile, "description", None) or "",
+        "fetched_at": time.time(),
+    }
+
+def is_profile_fresh(did):
+    cached = profile_cache.get(did)
+    return cached is not None and time.time() - cached["fetched_at"] < PROFILE_CACHE_TTL
+
+def prefetch_profiles(client, actors):
+    # キャッシュにない/期限切れのDIDだけgetProfilesで25件ずつまとめて取得
+    missing = [did for did in dict.fromkeys(actors) if did and not is_profile_fresh(did)]
+    for start in range(0, len(missing), PROFILE_BATCH_SIZE):
+        batch = missing[start:start + PROFILE_BATCH_SIZE]
+        try:
+            for profile in client.get_profiles(actors=batch).profiles:
+                cache_profile(profile)
+        except Exception as e:
+            logging.error(f"❌ プロフィール一括取得エラー: {type(e).__name__}: {e} ({len(batch)}件)")
+    if missing:
+        logging.info(f"🟢 プロフィール取得: {len(missing)}件（キャッシュ済み {len(profile_cache)}件）")
+
+def get_cached_profile(client, did):
+    if not is_profile_fresh(did):
+        prefetch_profiles(client, [did])
+    return profile_cache.get(did, {})
+
+def detect_language(client, did, profile=None, text="", langs=None):
+    # 本文 → 投稿のlangs → プロフィールの順（本文とlangsで決まればネットワークを使わない）
+    lang = detect_text_language(text)
+    if lang:
+        return lang
+    for post_lang in langs or []:
+        if post_lang.lower().startswith(("ja", "en")):
+            return post_lang[:2].lower()
     try:
-        profile = client.get_profile(actor=handle)
-        bio = profile.display_name.lower() + " " + getattr(profile, "description", "").lower()
+        if profile is None:
+            profile = get_cached_profile(client, did)
+        bio = profile.get("display_name", "").lower() + " " + profile.get("description", "").lower()
         if any(kw in bio for kw in ["日本語", "日本", "にほん", "japanese", "jp"]):
             return "ja"
         elif any(kw in bio for kw in ["english", "us", "uk", "en"]):
@@ -663,16 +813,134 @@ def detect_language(client, handle):
         logging.error(f"❌ 言語判定エラー: {type(e).__name__}: {e}")
         return "ja"
 
-def is_priority_post(text):
-    return "@mirinchuuu" in text.lower()
+def is_priority_post(text, tags=None):
+    if tags is None:
+        tags = scan_tags(text)
+    return "priority" in tags
+
+def is_reply_to_self(ctx, client=None):
+    # セルフリプ判定: フィードのreply情報 → 親URIのDID → （どちらも無いときだけ）スレッド取得
+    reply = getattr(ctx.record, "reply", None)
+    if not reply or not hasattr(reply, 'parent') or not hasattr(reply.parent, 'uri'):
+        return False
+    author_did = ctx.author_did
+
+    parent_author = getattr(getattr(getattr(ctx.post_data, 'reply', None), 'parent', None), 'author', None)
+    if parent_author is not None:
+        return parent_author.did == author_did
 
-def is_reply_to_self(post):
-    reply = getattr(post.record, "reply", None) if hasattr(post, 'record') else None
-    if reply and hasattr(reply, 'parent') and hasattr(reply.parent, 'uri'):
-        return reply.parent.uri == post.post.uri
+    parent_uri = str(reply.parent.uri)
+    if parent_uri.startswith("at://did:"):
+        return parent_uri.split('/')[2] == author_did
+
+    if client:
+        try:
+            thread = client.get_post_thread(uri=ctx.uri, depth=0, parent_height=1).thread
+            parent = getattr(thread, 'parent', None)
+            return bool(parent and hasattr(parent, 'post') and parent.post.author.did == author_did)
+        except Exception as e:
+            logging.error(f"❌ スレッド取得エラー: {type(e).__name__}: {e} (URI: {ctx.uri})")
     return False
 
-fuwamoko_uris = {}
+HYDRATE_BATCH_SIZE = 25  # app.bsky.feed.getPostsの上限
+
+def hydrate_feed(client, feed):
+    # タイムラインのビューをそのまま使い、レコードが欠けている投稿だけgetPostsでまとめて補完
+    missing = [item for item in feed if getattr(item.post, 'record', None) is None]
+    if not missing:
+        return feed
+    uris = [str(item.post.uri) for item in missing]
+    hydrated = {}
+    for start in range(0, len(uris), HYDRATE_BATCH_SIZE):
+        try:
+            for post_view in client.get_posts(uris=uris[start:start + HYDRATE_BATCH_SIZE]).posts:
+                hydrated[str(post_view.uri)] = post_view
+        except Exception as e:
+            logging.error(f"❌ 投稿取得エラー: {type(e).__name__}: {e} ({len(uris[start:start + HYDRATE_BATCH_SIZE])}件)")
+    for item in missing:
+        if str(item.post.uri) in hydrated:
+            item.post = hydrated[str(item.post.uri)]
+    logging.info(f"🟢 投稿補完: {len(hydrated)}/{len(missing)}件")
+    return [item for item in feed if getattr(item.post, 'record', None) is not None]
+
+# 🔽 ⏱️ タイムラインの既読位置（アカウントごと）
+# watermark: 前回までに処理したタイムラインの一番新しい時刻。毎回ここまでだけ遡る
+# gaps: ページ上限で遡りきれなかった区間（続きのカーソルと、どこまで遡るか）。次回以降に続きから埋める
+TIMELINE_STATE_FILE = "timeline_state.json"
+TIMELINE_PAGE_SIZE = 50
+TIMELINE_MAX_PAGES = int(os.environ.get("FUWAMOKO_TIMELINE_MAX_PAGES", "10"))  # 1回の実行で読むページ数の上限
+
+def load_timeline_state(account):
+    if not os.path.exists(TIMELINE_STATE_FILE):
+        return {}
+    try:
+        with open(TIMELINE_STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f).get(account, {})
+    except Exception as e:
+        logging.error(f"❌ タイムライン既読位置読み込みエラー: {type(e).__name__}: {e}")
+        return {}
+
+def save_timeline_state(account, state):
+    snapshot = {}
+    temp_file = TIMELINE_STATE_FILE + ".tmp"
+    try:
+        if os.path.exists(TIMELINE_STATE_FILE):
+            with open(TIMELINE_STATE_FILE, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        snapshot[account] = state
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(temp_file, TIMELINE_STATE_FILE)
+    except Exception as e:
+        logging.error(f"❌ タイムライン既読位置保存エラー: {type(e).__name__}: {e}")
+
+def feed_item_time(item):
+    # タイムライン上の位置はリポストならリポストされた時刻
+    reason = getattr(item, 'reason', None)
+    value = getattr(reason, 'indexed_at', None) or item.post.indexed_at
+    timestamp = parse_timestamp(value)
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
+
+def fetch_timeline_pages(client, until, cursor=None, max_pages=TIMELINE_MAX_PAGES):
+    # untilより新しい投稿を、untilに届くかページ上限までさかのぼる
+    # 戻り値: (投稿, 続きのカーソル（届いた・最後まで読んだならNone）, 使ったページ数)
+    items = []
+    for page in range(max_pages):
+        response = client.get_timeline(limit=TIMELINE_PAGE_SIZE, cursor=cursor)
+        fresh = [item for item in response.feed if feed_item_time(item) >= until]
+        items.extend(fresh)
+        cursor = response.cursor
+        if len(fresh) < len(response.feed) or not cursor:
+            return items, None, page + 1
+    return items, cursor, max_pages
+
+def fetch_new_timeline(client, state):
+    # 前回の続きだけ取得する。戻り値: (投稿, 処理後に保存する既読位置)
+    cutoff = datetime.now(timezone.utc) - TIMELINE_LOOKBACK
+    watermark = max(parse_timestamp(state["watermark"]), cutoff) if state.get("watermark") else cutoff
+    items, gap_cursor, pages = fetch_timeline_pages(client, watermark)
+    # 前回時間切れで回した投稿（既読位置より前なので、URIで取り直す）。取れなかった分は次回も持ち越す
+    deferred, failed_uris = fetch_feed_by_uris(client, state.get("deferred", []))
+    gaps = []
+    if gap_cursor:
+        # 忙しい時間帯: 前回の位置まで届かなかった → 次回ここから続きを読む
+        gaps.append({"cursor": gap_cursor, "until": watermark.isoformat()})
+    for gap in state.get("gaps", []):
+        until = parse_timestamp(gap["until"])
+        if until < cutoff:
+            until = cutoff
+        if pages >= TIMELINE_MAX_PAGES:
+            gaps.append({"cursor": gap["cursor"], "until": until.isoformat()})
+            continue
+        more, cursor, used = fetch_timeline_pages(client, until, gap["cursor"], TIMELINE_MAX_PAGES - pages)
+        items.extend(more)
+        pages += used
+        if cursor:
+            gaps.append({"cursor": cursor, "until": until.isoformat()})
+    newest = max([feed_item_time(item) for item in items] + [watermark])
+    logging.info(f"🟢 タイムライン取得: {len(items)}件（{pages}ページ, 既読位置 {watermark.isoformat()}, 未読区間 {len(gaps)}件, 前回の残り {len(deferred)}件）")
+    return deferred + items, {"watermark": newest.isoformat(), "gaps": gaps, "deferred": failed_uris}
+
 
 def normalize_uri(uri):
     try:
@@ -681,7 +949,7 @@ def normalize_uri(uri):
         parts = uri.split('/')
         if len(parts) >= 5:
             normalized = f"at://{parts[2]}/{parts[3]}/{parts[4]}"
-            logging.debug(f"🦊 URI正規化: {uri} -> {normalized}")
+            uri_log.debug("🦊 URI正規化: %s -> %s", uri, normalized)
             return normalized
         logging.warning(f"⏭️ URI正規化失敗: 不正な形式: {uri}")
         return uri
@@ -689,109 +957,42 @@ def normalize_uri(uri):
         logging.error(f"❌ URI正規化エラー: {type(e).__name__}: {e}")
         return uri
 
-def validate_fuwamoko_file():
-    if not os.path.exists(FUWAMOKO_FILE):
-        logging.info("🟢 ふわもこ履歴ファイルが存在しません。新規作成します。")
-        with open(FUWAMOKO_FILE, 'w', encoding='utf-8') as f:
-            f.write("")
-        return True
-    try:
-        with open(FUWAMOKO_FILE, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            for line in lines:
-                clean_line = line.strip()
-                if not clean_line:
-                    continue
-                if not re.match(r'^at://[^|]+\|\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}(?:\d{3})?\+\d{2}:\d{2}$', clean_line):
-                    logging.error(f"❌ 無効な履歴行: {repr(clean_line)}")
-                    return False
-        return True
-    except Exception as e:
-        logging.error(f"❌ 履歴ファイル検証エラー: {type(e).__name__}: {e}")
-        return False
-
-def repair_fuwamoko_file():
-    temp_file = FUWAMOKO_FILE + ".tmp"
-    valid_lines = []
-    if os.path.exists(FUWAMOKO_FILE):
-        try:
-            with open(FUWAMOKO_FILE, 'r', encoding='utf-8') as f:
-                for line in f:
-                    clean_line = line.strip()
-                    if not clean_line:
-                        continue
-                    if re.match(r'^at://[^|]+\|\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}(?:\d{3})?\+\d{2}:\d{2}$', clean_line):
-                        valid_lines.append(line)
-                    else:
-                        logging.warning(f"⏭️ 破損行スキップ: {repr(clean_line)}")
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                f.writelines(valid_lines)
-            os.replace(temp_file, FUWAMOKO_FILE)
-            logging.info(f"🟢 履歴ファイル修復完了: {len(valid_lines)}件保持")
-        except Exception as e:
-            logging.error(f"❌ 履歴ファイル修復エラー: {type(e).__name__}: {e}")
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
-    else:
-        with open(FUWAMOKO_FILE, 'w', encoding='utf-8') as f:
-            f.write("")
-        logging.info("🟢 新規履歴ファイル作成")
+# 履歴はストアのインデックスが正（保存のたびにファイルを読み直さない）
+if FUWAMOKO_HISTORY_FORMAT == "binary":
+    fuwamoko_history = FuwamokoHistory(FUWAMOKO_BINARY_FILE, FUWAMOKO_LOCK, normalize=normalize_uri,
+                                       retention=TIMELINE_LOOKBACK, fmt="binary", legacy_path=FUWAMOKO_FILE)
+else:
+    fuwamoko_history = FuwamokoHistory(FUWAMOKO_FILE, FUWAMOKO_LOCK, normalize=normalize_uri,
+                                       retention=TIMELINE_LOOKBACK)
+fuwamoko_uris = fuwamoko_history.index
 
 def load_fuwamoko_uris():
-    global fuwamoko_uris
-    fuwamoko_uris.clear()
-    if not validate_fuwamoko_file():
-        logging.warning("⚠️ 履歴ファイル破損。修復を試みます。")
-        repair_fuwamoko_file()
     try:
-        with open(FUWAMOKO_FILE, 'r', encoding='utf-8') as f:
-            content = f.read()
-            logging.info(f"🟢 ふわもこ履歴サイズ: {len(content)} bytes")
-            if content.strip():
-                for line in content.splitlines():
-                    if line.strip():
-                        try:
-                            uri, timestamp = line.strip().split("|", 1)
-                            normalized_uri = normalize_uri(uri)
-                            fuwamoko_uris[normalized_uri] = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
-                            logging.debug(f"🦊 履歴読み込み: {normalized_uri}")
-                        except ValueError as e:
-                            logging.warning(f"⏭️ 破損行スキップ: {repr(line.strip())}: {e}")
-                            continue
-            logging.info(f"🟢 ふわもこURI読み込み: {len(fuwamoko_uris)}件")
+        fuwamoko_history.load()
     except Exception as e:
         logging.error(f"❌ 履歴読み込みエラー: {type(e).__name__}: {e}")
         fuwamoko_uris.clear()
 
 def save_fuwamoko_uri(uri, indexed_at):
-    global fuwamoko_uris
     normalized_uri = normalize_uri(uri)
-    lock = filelock.FileLock(FUWAMOKO_LOCK, timeout=5.0)
     try:
-        with lock:
-            logging.debug(f"🦊 ロック取得: {FUWAMOKO_LOCK}")
-            if normalized_uri in fuwamoko_uris and (datetime.now(timezone.utc) - fuwamoko_uris[normalized_uri]).total_seconds() < 24 * 3600:
-                logging.debug(f"⏭️ スキップ: 24時間以内: {normalized_uri}")
-                return
-            if isinstance(indexed_at, str):
-                indexed_at = datetime.fromisoformat(indexed_at.replace("Z", "+00:00"))
-            with open(FUWAMOKO_FILE, 'a', encoding='utf-8') as f:
-                f.write(f"{normalized_uri}|{indexed_at.isoformat()}\n")
-            fuwamoko_uris[normalized_uri] = indexed_at
-            logging.info(f"🟢 履歴保存: {normalized_uri}")
-            with open(FUWAMOKO_FILE, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                last_line = lines[-1].strip() if lines else ""
-                if last_line.startswith(normalized_uri):
-                    logging.debug(f"🦊 履歴ファイル確認: 最後の行={last_line}")
-                else:
-                    logging.error(f"❌ 履歴保存失敗: 最後の行={last_line}")
-            load_fuwamoko_uris()
+        if normalized_uri in fuwamoko_uris and (datetime.now(timezone.utc) - fuwamoko_uris[normalized_uri]).total_seconds() < 24 * 3600:
+            uri_log.debug("⏭️ スキップ: 24時間以内: %s", normalized_uri)
+            return
+        fuwamoko_history.add(normalized_uri, indexed_at)
+        logging.info(f"🟢 履歴保存: {normalized_uri}")
     except filelock.Timeout:
         logging.error(f"❌ ファイルロックタイムアウト: {FUWAMOKO_LOCK}")
     except Exception as e:
         logging.error(f"❌ 履歴保存エラー: {type(e).__name__}: {e}")
 
+def close_fuwamoko_history():
+    try:
+        fuwamoko_history.close()
+        fuwamoko_history.maybe_compact()
+    except Exception as e:
+        logging.error(f"❌ 履歴クローズエラー: {type(e).__name__}: {e}")
+
 def load_session_string():
     try:
         if os.path.exists(SESSION_FILE):
@@ -809,210 +1010,467 @@ def save_session_string(session_str):
     except Exception as e:
         logging.error(f"❌ セッション保存エラー: {type(e).__name__}: {e}")
 
-def has_image(post):
-    try:
-        actual_post = post.post if hasattr(post, 'post') else post
-        if not hasattr(actual_post, 'record') or not hasattr(actual_post.record, 'embed'):
-            return False
-        embed = actual_post.record.embed
-        return (
-            (hasattr(embed, 'images') and embed.images) or
-            (hasattr(embed, 'record') and hasattr(embed.record, 'embed') and hasattr(embed.record.embed, 'images') and embed.record.embed.images) or
-            (getattr(embed, '$type', '') == 'app.bsky.embed.recordWithMedia' and hasattr(embed, 'media') and hasattr(embed.media, 'images') and embed.media.images)
-        )
-    except Exception as e:
-        logging.error(f"❌ 画像チェックエラー: {type(e).__name__}: {e}")
-        return False
-        
-def classify_text_emotion(text):
-    text = text.lower()
+def classify_text_emotion(text, tags=None):
+    if tags is None:
+        tags = scan_tags(text)
     # NG系最優先
     for tag in ["nsfw_ng", "food_ng"]:
-        for word in globals()["EMOTION_TAGS"].get(tag, []):
-            if word in text:
-                logging.debug(f"⚠️ '{word}' 検出 → NGタグ: {tag}")
-                return tag
+        if tag in tags:
+            filter_log.debug("⚠️ '%s' 検出 → NGタグ: %s", tags[tag][0][1], tag)
+            return tag
     # 中間ケース（髪やオーラ）
-    if any(word in text for word in ["髪の毛", "オーラ", "トーク", "補正"]):
-        logging.debug("△ 中間ケース検出: 髪/オーラ/トーク関連")
+    if "neutral_ambiguous" in tags:
+        filter_log.debug("△ 中間ケース検出: 髪/オーラ/トーク関連")
         return "neutral_ambiguous"  # 中間判定
     # 通常タグ
-    for tag, words in globals()["EMOTION_TAGS"].items():
+    for tag in globals()["EMOTION_TAGS"]:
         if tag.endswith("_ng") or tag == "neutral_ambiguous":
             continue
-        for word in words:
-            if word in text:
-                logging.debug(f"✅ '{word}' 検出 → タグ: {tag}")
-                return tag
+        if tag in tags:
+            filter_log.debug("✅ '%s' 検出 → タグ: %s", tags[tag][0][1], tag)
+            return tag
     return "neutral"
     
-def is_suspicious_context(text, bio=""):
-    suspicious_keywords = [
-        "#グラビアアイドル", "#メンズエステ", "#名古屋メンエス", "#風俗", "#ご予約", "#DMで",
-        "マシュマロ", "性感", "体", "谷間", "胸元", "ランジェリー", "リピ様", "リンク"
-    ]
-    text = text.lower()
-    bio = bio.lower()
-    return any(kw in text or kw in bio for kw in suspicious_keywords)
-
-def process_post(post_data, client, fuwamoko_uris, reposted_uris):
+def is_suspicious_context(text, bio="", tags=None):
+    if tags is None:
+        tags = scan_tags(text)
+    return "suspicious" in tags or (bool(bio) and "suspicious" in scan_tags(bio))
+
+# 🔽 📦 投稿コンテキスト（atprotoモデルから1回だけ取り出し、フィルター・画像解析・返信で使い回す）
+def classify_embed(embed):
+    # (種類, 画像リスト)。種類: None / "images" / "record"（引用） / "recordWithMedia" / "other"
+    if not embed:
+        return None, []
+    images = getattr(embed, 'images', None)
+    if images:
+        return "images", list(images)
+    quoted = getattr(embed, 'record', None)
+    media = getattr(embed, 'media', None)
+    if quoted and media is not None:
+        return "recordWithMedia", list(getattr(media, 'images', None) or [])
+    if quoted:
+        return "record", list(getattr(getattr(quoted, 'embed', None), 'images', None) or [])
+    return "other", []
+
+class PostContext:
+    __slots__ = ("post_data", "post", "record", "uri", "normalized_uri", "rkey", "cid",
+                 "author_did", "author_handle", "author_viewer", "indexed_at",
+                 "text", "text_lower", "tags", "embed_kind", "image_refs", "is_reply",
+                 "profile", "lang", "image_features", "is_fuwamoko")
+
+    def __init__(self, post_data):
+        post = post_data.post if hasattr(post_data, 'post') else post_data
+        record = post.record
+        author = post.author
+        self.post_data = post_data
+        self.post = post
+        self.record = record
+        self.uri = str(post.uri)
+        self.normalized_uri = normalize_uri(self.uri)
+        self.rkey = self.uri.rsplit('/', 1)[-1]
+        self.cid = post.cid
+        self.author_did = author.did
+        self.author_handle = author.handle
+        self.author_viewer = getattr(author, 'viewer', None)
+        self.indexed_at = post.indexed_at
+        self.text = getattr(record, 'text', '') or ''
+        self.text_lower = self.text.lower()
+        self.tags = scan_tags(self.text_lower, lowered=True)
+        self.embed_kind, self.image_refs = classify_embed(getattr(record, 'embed', None))
+        self.is_reply = getattr(record, 'reply', None) is not None
+        self.profile = None  # 必要になった時点でキャッシュから
+        self.lang = None
+        self.image_features = []
+        self.is_fuwamoko = False
+
+    @property
+    def is_quote(self):
+        return self.embed_kind in ("record", "recordWithMedia")
+
+# 🔽 🚦 フィルターパイプライン（安い順に実行して、最初に落ちた段階で打ち切る）
+RANDOM_SKIP_RATE = 0.5
+
+def is_recent_post(ctx, run):
+    # 履歴の保持期間より古い投稿（古い投稿のリポストなど）は重複判定できないので扱わない
+    return parse_timestamp(ctx.indexed_at) >= datetime.now(timezone.utc) - TIMELINE_LOOKBACK
+
+def is_allowed_reply(ctx, run):
+    return not ctx.is_reply or is_priority_post(ctx.text, ctx.tags) or is_reply_to_self(ctx, run["client"])
+
+def is_clean_context(ctx, run):
+    ctx.profile = get_cached_profile(run["client"], ctx.author_did)
+    return not is_suspicious_context(ctx.text, ctx.profile.get("description", ""), ctx.tags)
+
+def is_ok_emotion(ctx, run):
+    emotion = classify_text_emotion(ctx.text, ctx.tags)
+    return not (emotion.endswith("_ng") or emotion == "neutral_ambiguous")
+
+def passes_random_sampling(ctx, run):
+    # 返信するかどうかのランダム判定（画像解析の前に半分を落とす）
+    return random.random() <= 1 - RANDOM_SKIP_RATE
+
+# cost: 相対コスト（dict参照=1、属性チェック=2、文字列走査=5、ネットワークの可能性あり=10）、同じコストは記述順
+# save: 落ちたときに履歴へ保存するか（次回以降も再判定しない）
+# ランダムは安いが落ちると保存するので、保存しない段階より後に回す（相互になった後などに再判定できるように）
+FILTER_STAGES = sorted([
+    {"name": "既存投稿", "cost": 1, "save": False, "check": lambda ctx, run: ctx.normalized_uri not in run["fuwamoko_uris"]},
+    {"name": "自分の投稿", "cost": 1, "save": False, "check": lambda ctx, run: ctx.author_handle != HANDLE},
+    {"name": "再投稿済み", "cost": 1, "save": False, "check": lambda ctx, run: ctx.rkey not in run["reposted_uris"]},
+    {"name": "古い投稿", "cost": 1, "save": False, "check": is_recent_post},
+    {"name": "画像なし", "cost": 2, "save": False, "check": lambda ctx, run: bool(ctx.image_refs)},
+    {"name": "引用リポスト", "cost": 2, "save": False, "check": lambda ctx, run: not ctx.is_quote},
+    {"name": "疑わしい文脈", "cost": 5, "save": True, "check": is_clean_context},
+    {"name": "NGまたは中間判定", "cost": 5, "save": True, "check": is_ok_emotion},
+    {"name": "リプライ（非@mirinchuuu/非自己）", "cost": 10, "save": False, "check": is_allowed_reply},
+    {"name": "非相互フォロー", "cost": 10, "save": False,
+     "check": lambda ctx, run: is_mutual_follow(run["client"], ctx.author_did, ctx.author_viewer)},
+    {"name": "ランダム（50%）", "cost": 11, "save": True, "check": passes_random_sampling},
+], key=lambda stage: stage["cost"])
+
+filter_stats = {}
+
+def record_stage(name, seconds, rejected, checked=1):
+    stats = filter_stats.setdefault(name, {"checked": 0, "rejected": 0, "seconds": 0.0})
+    stats["checked"] += checked
+    stats["rejected"] += rejected
+    stats["seconds"] += seconds
+
+def log_filter_stats():
+    for name, stats in filter_stats.items():
+        logging.info(f"📊 フィルター[{name}]: 判定 {stats['checked']}件, 除外 {stats['rejected']}件, {stats['seconds'] * 1000:.1f}ms")
+
+def process_post(post_data, run):
+    # run: 実行中ずっと共通の状態 {"client", "fuwamoko_uris", "reposted_uris"}
+    ctx = None
     try:
-        actual_post = post_data.post if hasattr(post_data, 'post') else post_data
-        uri = str(actual_post.uri)
-        post_id = uri.split('/')[-1]
-        text = getattr(actual_post.record, 'text', '') if hasattr(actual_post.record, 'text') else ''
-        bio = getattr(client.get_profile(actor=actual_post.author.handle), 'description', '')
-
-        # 文脈チェック
-        if is_suspicious_context(text, bio):
-            logging.info(f"⏭️ スキップ: 疑わしい文脈検出: {text[:40]} ({post_id})")
-            save_fuwamoko_uri(uri, actual_post.indexed_at)
-            return False
-
-        emotion = classify_text_emotion(text)
-        if emotion.endswith("_ng") or emotion == "neutral_ambiguous":
-            logging.info(f"⏭️ スキップ: NGまたは中間判定（{emotion}）: {text[:40]} ({post_id})")
-            save_fuwamoko_uri(uri, actual_post.indexed_at)
-            return False
+        ctx = PostContext(post_data)
+        for stage in FILTER_STAGES:
+            start = time.perf_counter()
+            passed = stage["check"](ctx, run)
+            record_stage(stage["name"], time.perf_counter() - start, rejected=int(not passed))
+            if not passed:
+                print(f"⏭️ スキップ: {stage['name']}: {ctx.text[:20]} ({ctx.rkey})")
+                filter_log.debug("スキップ: %s: %s", stage["name"], ctx.rkey)
+                if stage["save"]:
+                    save_fuwamoko_uri(ctx.uri, ctx.indexed_at)
+                return False
 
-        is_reply = hasattr(actual_post.record, 'reply') and actual_post.record.reply is not None
-        if is_reply and not (is_priority_post(text) or is_reply_to_self(post_data)):
-            print(f"⏭️ スキップ: リプライ（非@mirinchuuu/非自己）: {text[:20]} ({post_id})")
-            logging.debug(f"スキップ: リプライ: {post_id}")
-            return False
+        print(f"🦊 POST処理開始: @{ctx.author_handle} ({ctx.rkey})")
+        logging.info(f"🟢 POST処理開始: @{ctx.author_handle} ({ctx.rkey})")
 
-        print(f"🦊 POST処理開始: @{actual_post.author.handle} ({post_id})")
-        logging.info(f"🟢 POST処理開始: @{actual_post.author.handle} ({post_id})")
-        normalized_uri = normalize_uri(uri)
-        if normalized_uri in fuwamoko_uris:
-            print(f"⏭️ スキップ: 既存投稿: {post_id}")
-            logging.debug(f"スキップ: 既存投稿: {post_id}")
-            return False
-        if actual_post.author.handle == HANDLE:
-            print(f"⏭️ スキップ: 自分の投稿: {post_id}")
-            logging.debug(f"スキップ: 自分の投稿: {post_id}")
-            return False
-        if is_quoted_repost(post_data):
-            print(f"⏭️ スキップ: 引用リポスト: {post_id}")
-            logging.debug(f"スキップ: 引用リポスト: {post_id}")
-            return False
-        if post_id in reposted_uris:
-            print(f"⏭️ スキップ: 再投稿済み: {post_id}")
-            logging.debug(f"スキップ: 再投稿済み: {post_id}")
+        # 画像解析はタイムライン全体でまとめて行う（analyze_candidates）
+        return ctx
+    except Exception as e:
+        if ctx is None:
+            print(f"❌ 投稿処理エラー: {type(e).__name__}: {e}")
+            logging.error(f"❌ 投稿処理エラー: {type(e).__name__}: {e}")
             return False
+        print(f"❌ 投稿処理エラー: {type(e).__name__}: {e} ({ctx.rkey}, uri={ctx.uri})")
+        logging.error(f"❌ 投稿処理エラー: {type(e).__name__}: {e} ({ctx.rkey}, uri={ctx.uri})")
+        save_fuwamoko_uri(ctx.uri, ctx.indexed_at)
+        return False
 
-        author = actual_post.author.handle
-        indexed_at = actual_post.indexed_at
+def work_queue_name():
+    return f"fuwamoko:{HANDLE}"
 
-        if not has_image(post_data):
-            print(f"⏭️ スキップ: 画像なし: {post_id}")
-            logging.debug(f"スキップ: 画像なし: {post_id}")
+def on_reply_posted(uri, reply_uri, candidate, error):
+    # まとめ投稿の結果（1件ごと）。失敗しても従来どおり処理済みにして再挑戦しない
+    queue = get_work_queue()
+    post_id = candidate.rkey
+    if error is not None:
+        print(f"❌ 返信処理エラー: {type(error).__name__}: {error} ({post_id}, uri={uri}, cid={candidate.cid})")
+        logging.error(f"❌ 返信処理エラー: {type(error).__name__}: {error} ({post_id}, uri={uri}, cid={candidate.cid})")
+    else:
+        print(f"✅ SUCCESS: 返信成功: @{candidate.author_handle} ({post_id})")
+        logging.info(f"🟢 返信成功: @{candidate.author_handle} ({post_id}) → {reply_uri}")
+        queue.advance(work_queue_name(), uri, "posted", reply_uri=reply_uri)
+    save_fuwamoko_uri(uri, candidate.indexed_at)
+    queue.advance(work_queue_name(), uri, "persisted")
+    get_work_claimer().done(uri)
+
+def resume_queued_replies(client):
+    # 前回の実行で投稿・生成まで終わっていた返信を、生成し直さずに保存・投稿する
+    # （生成時に決めたrkeyで投稿するので、前回実は投稿できていた分は投稿済みとして扱われる）
+    queue = get_work_queue()
+    name = work_queue_name()
+    claimer = get_work_claimer()
+    for uri, payload in queue.items(name, "posted"):
+        save_fuwamoko_uri(uri, payload.get("indexed_at"))
+        queue.advance(name, uri, "persisted")
+        claimer.done(uri)
+    poster = BatchPoster(client, on_reply_posted)
+    for uri, payload in queue.items(name, "generated"):
+        if normalize_uri(uri) in fuwamoko_uris:
+            queue.advance(name, uri, "persisted")
+            continue
+        if not claimer.claim(uri):
+            continue
+        context = SimpleNamespace(rkey=payload["post_id"], cid=payload["cid"],
+                                  author_handle=payload["author_handle"], indexed_at=payload["indexed_at"])
+        print(f"📒 前回の続きから返信: @{context.author_handle}: {payload['text']} ({context.rkey})")
+        record = reply_record(payload["text"], reply_ref_from_dict(payload["reply"]), payload["langs"])
+        poster.add(uri, record, context, rkey=payload["reply_rkey"])
+        queue.stats["resumed"] += 1
+    poster.flush()
+
+def reply_to_candidate(candidate, client, poster):
+    claimer = get_work_claimer()
+    uri = candidate.uri
+    post_id = candidate.rkey
+    author = candidate.author_handle
+    indexed_at = candidate.indexed_at
+    try:
+        if not candidate.is_fuwamoko:
+            print(f"⏭️ スキップ: ふわもこ画像でない: {post_id}")
+            logging.warning(f"⏭️ スキップ: ふわもこ画像でない: {post_id}")
+            save_fuwamoko_uri(uri, indexed_at)
             return False
-
-        image_data_list = []
-        embed = getattr(actual_post.record, 'embed', None)
-        if embed:
-            if hasattr(embed, 'images') and embed.images:
-                image_data_list.extend(embed.images)
-            elif hasattr(embed, 'record') and hasattr(embed.record, 'embed') and hasattr(embed.record.embed, 'images'):
-                image_data_list.extend(embed.record.embed.images)
-            elif getattr(embed, '$type', '') == 'app.bsky.embed.recordWithMedia' and hasattr(embed, 'media') and hasattr(embed.media, 'images'):
-                image_data_list.extend(embed.media.images)
-
-        if not is_mutual_follow(client, author):
-            print(f"⏭️ スキップ: 非相互フォロー: @{author} ({post_id})")
-            logging.debug(f"スキップ: 非相互フォロー: @{author} ({post_id})")
+        if not claimer.claim(uri):
+            print(f"⏭️ スキップ: 他のランナーが返信中/返信済み: {post_id}")
+            logging.info(f"⏭️ スキップ: 他のランナーが返信中/返信済み: {post_id}")
             return False
-
-        for i, image_data in enumerate(image_data_list):
-            try:
-                print(f"🦊 画像処理開始: {i+1}/{len(image_data_list)} ({post_id})")
-                logging.debug(f"画像処理開始: {i+1}/{len(image_data_list)} ({post_id})")
-                if process_image(image_data, text, client=client, post=post_data):
-                    if random.random() > 0.5:
-                        print(f"⏭️ スキップ: ランダム（50%）: {post_id}")
-                        logging.debug(f"スキップ: ランダム: {post_id}")
-                        save_fuwamoko_uri(uri, indexed_at)
-                        return False
-                    lang = detect_language(client, author)
-                    reply_text = open_calm_reply("", text, lang=lang)
-                    if not reply_text:
-                        print(f"⏭️ スキップ: 返信生成失敗: {post_id}")
-                        logging.debug(f"スキップ: 返信生成失敗: {post_id}")
-                        save_fuwamoko_uri(uri, indexed_at)
-                        return False
-                    root_ref = models.ComAtprotoRepoStrongRef.Main(
-                        uri=uri,
-                        cid=actual_post.cid
-                    )
-                    parent_ref = models.ComAtprotoRepoStrongRef.Main(
-                        uri=uri,
-                        cid=actual_post.cid
-                    )
-                    reply_ref = models.AppBskyFeedPost.ReplyRef(
-                        root=root_ref,
-                        parent=parent_ref
-                    )
-                    print(f"🦊 返信送信: @{author}: {reply_text} ({post_id})")
-                    logging.debug(f"返信送信: @{author}: {reply_text} ({post_id})")
-                    client.send_post(text=reply_text, reply_to=reply_ref)
-                    save_fuwamoko_uri(uri, indexed_at)
-                    print(f"✅ SUCCESS: 返信成功: @{author} ({post_id})")
-                    logging.info(f"🟢 返信成功: @{author} ({post_id})")
-                    return True
-                else:
-                    print(f"⏭️ スキップ: ふわもこ画像でない: {post_id} (画像 {i+1})")
-                    logging.warning(f"⏭️ スキップ: ふわもこ画像でない: {post_id} (画像 {i+1})")
-                    save_fuwamoko_uri(uri, indexed_at)
-                    return False
-            except Exception as e:
-                print(f"❌ 画像処理エラー: {type(e).__name__}: {e} ({post_id}, uri={uri}, cid={actual_post.cid})")
-                logging.error(f"❌ 画像処理エラー: {type(e).__name__}: {e} ({post_id}, uri={uri}, cid={actual_post.cid})")
-                save_fuwamoko_uri(uri, indexed_at)
-                return False
+        queue = get_work_queue()
+        stage, payload = queue.get(work_queue_name(), uri)
+        if stage == "generated":
+            # 前回生成済み（投稿前に止まった）→ 同じ返信・同じrkeyで投稿し直す
+            reply_text, reply_rkey = payload["text"], payload["reply_rkey"]
+            candidate.lang = payload["langs"][0]
+            queue.stats["resumed"] += 1
+        else:
+            candidate.lang = detect_language(client, candidate.author_did, candidate.profile,
+                                             candidate.text, getattr(candidate.record, "langs", None))
+            reply_text = open_calm_reply("", candidate.text, lang=candidate.lang, tags=candidate.tags)
+            reply_rkey = new_tid()
+        if not reply_text:
+            print(f"⏭️ スキップ: 返信生成失敗: {post_id}")
+            logging.debug(f"スキップ: 返信生成失敗: {post_id}")
+            save_fuwamoko_uri(uri, indexed_at)
+            claimer.done(uri)
+            return False
+        root_ref = models.ComAtprotoRepoStrongRef.Main(
+            uri=uri,
+            cid=candidate.cid
+        )
+        parent_ref = models.ComAtprotoRepoStrongRef.Main(
+            uri=uri,
+            cid=candidate.cid
+        )
+        reply_ref = models.AppBskyFeedPost.ReplyRef(
+            root=root_ref,
+            parent=parent_ref
+        )
+        if stage != "generated":
+            queue.advance(work_queue_name(), uri, "generated", text=reply_text, reply_rkey=reply_rkey,
+                          langs=[candidate.lang], reply=reply_ref_to_dict(reply_ref), post_id=post_id,
+                          cid=candidate.cid, author_handle=author, indexed_at=indexed_at)
+        print(f"🦊 返信送信: @{author}: {reply_text} ({post_id})")
+        logging.debug(f"返信送信: @{author}: {reply_text} ({post_id})")
+        # 送信・保存はまとめ投稿の結果（on_reply_posted）で
+        poster.add(uri, reply_record(reply_text, reply_ref, [candidate.lang]), candidate, rkey=reply_rkey)
+        return True
     except Exception as e:
-        print(f"❌ 投稿処理エラー: {type(e).__name__}: {e} ({post_id}, uri={uri})")
-        logging.error(f"❌ 投稿処理エラー: {type(e).__name__}: {e} ({post_id}, uri={uri})")
+        print(f"❌ 返信処理エラー: {type(e).__name__}: {e} ({post_id}, uri={uri}, cid={candidate.cid})")
+        logging.error(f"❌ 返信処理エラー: {type(e).__name__}: {e} ({post_id}, uri={uri}, cid={candidate.cid})")
         save_fuwamoko_uri(uri, indexed_at)
+        claimer.done(uri)
         return False
 
+def login_client():
+    client = Client()
+    session_str = load_session_string()
+    if session_str:
+        client.login(session_string=session_str)
+        print(f"🚀✨ START: ふわもこBot起動（セッション再利用）")
+        logging.info("🟢 Bot起動: セッション再利用")
+    else:
+        client.login(HANDLE, APP_PASSWORD)
+        session_str = client.export_session_string()
+        save_session_string(session_str)
+        print(f"🚀✨ START: ふわもこBot起動（新規セッション）")
+        logging.info("🟢 Bot起動: 新規セッション")
+
+    print(f"🦊 INFO: Bot稼働中: {HANDLE}")
+    logging.info(f"🟢 Bot稼働中: {HANDLE}")
+    return client
+
+def start_run(client, deadline="env"):
+    # 同じプロセスで何度も実行する（multi_bot_runner）ので、統計は実行ごとに数え直す
+    filter_stats.clear()
+    generation_stats.update(dict.fromkeys(generation_stats, 0))
+    load_fuwamoko_uris()
+    reposted_uris = load_reposted_uris()
+    load_follow_graph()
+    sync_follow_graph(client)
+    load_profile_cache()
+    get_work_claimer().join()
+    return {"client": client, "fuwamoko_uris": fuwamoko_uris, "reposted_uris": reposted_uris,
+            "scheduler": DeadlineScheduler(deadline)}
+
+def candidate_priority(ctx, my_did):
+    # 優先ワード → 自分へのメンション・リプ → その他タイムライン
+    if is_priority_post(ctx.text, ctx.tags):
+        return PRIORITY_URGENT
+    parent_uri = str(getattr(getattr(getattr(ctx.record, 'reply', None), 'parent', None), 'uri', ""))
+    if f"@{HANDLE}" in ctx.text or parent_uri.startswith(f"at://{my_did}/"):
+        return PRIORITY_MENTION
+    return PRIORITY_TIMELINE
+
+def process_feed(feed, run):
+    # タイムライン1回分／ストリームの1バッチ分をパイプラインに通す
+    client = run["client"]
+    scheduler = run["scheduler"]
+    # 他のランナーの担当（著者DIDで分ける）はプロフィール取得・画像解析の前に外す
+    claimer = get_work_claimer()
+    feed = [item for item in feed if claimer.owns(item.post.author.did)]
+    # 同じ投稿が元投稿＋リポストで2回来ても1回だけ通す（履歴保存は返信後なので、ここで弾かないと二重返信になる）
+    seen_uris = set()
+    unique_feed = []
+    for item in feed:
+        normalized_uri = normalize_uri(str(item.post.uri))
+        if normalized_uri in seen_uris:
+            continue
+        seen_uris.add(normalized_uri)
+        unique_feed.append(item)
+    feed = unique_feed
+    # 既存投稿・自分の投稿はパイプラインの最初で落ちるので、それ以外の著者だけ先読み
+    prefetch_profiles(client, [item.post.author.did for item in feed
+                               if normalize_uri(str(item.post.uri)) not in fuwamoko_uris and item.post.author.handle != HANDLE])
+    candidates = []
+    for post in sorted(feed, key=lambda x: x.post.indexed_at, reverse=True):
+        candidate = process_post(post, run)
+        if candidate:
+            candidates.append(candidate)
+
+    # 残り時間で画像解析＋返信まで終わる件数だけ、優先度順に選ぶ（モデル未読み込みならその時間も見込む）
+    my_did = client.me.did
+    model_load = 0.0 if MODEL_NAME in loaded_models() else scheduler.estimate("model_load")
+    candidates = scheduler.select(candidates, ("image", "fuwamoko_reply"),
+                                  priority=lambda c: candidate_priority(c, my_did), extra=model_load)
+    # 前回判定済みの投稿は画像を取り直さない
+    queue = get_work_queue()
+    to_analyze = []
+    for candidate in candidates:
+        _, payload = queue.get(work_queue_name(), candidate.uri)
+        if "is_fuwamoko" in payload:
+            candidate.is_fuwamoko = payload["is_fuwamoko"]
+            queue.stats["resumed"] += 1
+        else:
+            to_analyze.append(candidate)
+    print(f"🦊 画像解析: 候補 {len(candidates)} 件（判定済み {len(candidates) - len(to_analyze)} 件）")
+    if to_analyze:
+        with scheduler.measure("image", len(to_analyze)):
+            analyze_candidates(to_analyze, client)
+        for candidate in to_analyze:
+            queue.advance(work_queue_name(), candidate.uri, "filtered", is_fuwamoko=candidate.is_fuwamoko)
+    fuwamoko = [candidate for candidate in candidates if candidate.is_fuwamoko]
+    if fuwamoko and MODEL_NAME not in loaded_models():
+        if scheduler.fits("model_load", extra=scheduler.estimate("fuwamoko_reply")):
+            with scheduler.measure("model_load"):
+                get_model(MODEL_NAME, MODEL_CACHE_DIR)
+        else:
+            scheduler.defer(fuwamoko, "モデル読み込みが間に合わない")
+            fuwamoko = []
+    poster = BatchPoster(client, on_reply_posted)
+    for candidate in candidates:
+        if not candidate.is_fuwamoko:
+            reply_to_candidate(candidate, client, poster)
+    for candidate in scheduler.run(fuwamoko, "fuwamoko_reply"):
+        reply_to_candidate(candidate, client, poster)
+    poster.flush()
+    if poster.stats["posts"]:
+        logging.info(poster.stats_message())
+    save_profile_cache()
+
+def finish_run(run):
+    run["scheduler"].save()
+    logging.info(run["scheduler"].summary())
+    log_filter_stats()
+    log_generation_stats()
+    reply_cache = get_reply_cache()
+    reply_cache.save()
+    logging.info(reply_cache.stats_message())
+    logging.info(get_work_queue().stats_message(work_queue_name()))
+
 def run_once():
     try:
-        client = Client()
-        session_str = load_session_string()
-        if session_str:
-            client.login(session_string=session_str)
-            print(f"🚀✨ START: ふわもこBot起動（セッション再利用）")
-            logging.info("🟢 Bot起動: セッション再利用")
-        else:
-            client.login(HANDLE, APP_PASSWORD)
-            session_str = client.export_session_string()
-            save_session_string(session_str)
-            print(f"🚀✨ START: ふわもこBot起動（新規セッション）")
-            logging.info("🟢 Bot起動: 新規セッション")
-
-        print(f"🦊 INFO: Bot稼働中: {HANDLE}")
-        logging.info(f"🟢 Bot稼働中: {HANDLE}")
-        load_fuwamoko_uris()
-        reposted_uris = load_reposted_uris()
-
-        timeline = client.get_timeline(limit=50)
-        feed = timeline.feed
-        for post in sorted(feed, key=lambda x: x.post.indexed_at, reverse=True):
-            try:
-                thread_response = client.get_post_thread(uri=str(post.post.uri), depth=2)
-                process_post(thread_response.thread, client, fuwamoko_uris, reposted_uris)
-            except Exception as e:
-                print(f"❌ スレッド取得エラー: {type(e).__name__}: {e} (URI: {post.post.uri})")
-                logging.error(f"❌ スレッド取得エラー: {type(e).__name__}: {e} (URI: {post.post.uri})")
-            time.sleep(1.0)
+        client = login_client()
+        run = start_run(client)
+        resume_queued_replies(client)
+        feed, timeline_state = fetch_new_timeline(client, load_timeline_state(HANDLE))
+        process_feed(hydrate_feed(client, feed), run)
+        # 処理し終えてから既読位置を進める（途中で落ちたら次回同じ範囲をやり直す）
+        # 時間切れで回した投稿は既読位置とは別に覚えておく
+        timeline_state["deferred"] += [candidate.uri for candidate in run["scheduler"].deferred]
+        save_timeline_state(HANDLE, timeline_state)
+        finish_run(run)
     except Exception as e:
         print(f"❌ Bot実行エラー: {type(e).__name__}: {e}")
         logging.error(f"❌ Bot実行エラー: {type(e).__name__}: {e}")
+    finally:
+        close_fuwamoko_history()
+        get_work_claimer().leave()
+
+def fetch_stream_posts(client, events):
+    # ストリームのイベントはレコードだけなので、getPostsでタイムラインと同じ形（FeedViewPost）にする
+    # 取れなかったらバッチごと失敗させる → run_streamがカーソルを進めずに再試行する
+    feed, failed_uris = fetch_feed_by_uris(client, [event_uri(event) for event in events])
+    if failed_uris:
+        raise RuntimeError(f"投稿取得に失敗: {len(failed_uris)}件")
+    return feed
+
+def fetch_feed_by_uris(client, uris):
+    # 戻り値: (取れた投稿, 取得に失敗したURI)
+    feed = []
+    failed_uris = []
+    for start in range(0, len(uris), HYDRATE_BATCH_SIZE):
+        chunk = uris[start:start + HYDRATE_BATCH_SIZE]
+        try:
+            for post_view in client.get_posts(uris=chunk).posts:
+                feed.append(models.AppBskyFeedDefs.FeedViewPost(post=post_view))
+        except Exception as e:
+            logging.error(f"❌ 投稿取得エラー: {type(e).__name__}: {e} ({len(chunk)}件)")
+            failed_uris.extend(chunk)
+    return feed, failed_uris
+
+def run_stream_mode(**stream_options):
+    # フォロー中アカウントの画像付き投稿を受け取り続け、届いた分ずつ処理する（Ctrl+Cで停止）
+    try:
+        client = login_client()
+        run = start_run(client, deadline=None)  # 常駐なので締め切りなし（優先度順と実測のみ）
+        resume_queued_replies(client)
+        my_did = client.me.did
+
+        def is_target(event):
+            return event["did"] != my_did and event["did"] in follow_graph["follows"] and has_image_embed(event_record(event))
+
+        def handle(events):
+            logging.info(f"🌊 ストリーム: {len(events)}件受信")
+            if time.time() - follow_graph["refreshed_at"] > STREAM_FOLLOW_REFRESH:
+                sync_follow_graph(client)
+                # 常駐中も保持期間を過ぎた履歴を外し、無効レコードが増えたらファイルを詰める
+                fuwamoko_history.maybe_compact()
+            process_feed(fetch_stream_posts(client, events), run)
+
+        run_stream(handle, is_target, STREAM_CURSOR_FILE, **stream_options)
+        finish_run(run)
+    except Exception as e:
+        print(f"❌ Bot実行エラー: {type(e).__name__}: {e}")
+        logging.error(f"❌ Bot実行エラー: {type(e).__name__}: {e}")
+    finally:
+        close_fuwamoko_history()
+        get_work_claimer().leave()
 
 if __name__ == "__main__":
     try:
         load_dotenv()
-        run_once()
+        check_template_integrity()
+        if "--bench-classifier" in sys.argv:
+            benchmark_classifier()
+        elif "--bench-logging" in sys.argv:
+            benchmark_logging()
+        elif "--stream" in sys.argv:
+            run_stream_mode()
+        else:
+            run_once()
     except Exception as e:
         logging.error(f"❌ Bot起動エラー: {type(e).__name__}: {e}")
\ No newline at end of file
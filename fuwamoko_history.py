@@ -0,0 +1,361 @@
+# 🔽 📝 ふわもこ履歴ストア（追記専用ファイル + メモリ上のハッシュインデックス）
+# テキスト形式は従来どおり1行1件の「URI|indexed_at(ISO8601)」
+# バイナリ形式はDIDをインターンし、rkeyとタイムスタンプを固定長で持つ
+import logging
+import os
+import struct
+from datetime import datetime, timezone
+
+import filelock
+
+POST_COLLECTION = "app.bsky.feed.post"
+
+log = logging.getLogger("fuwamoko.history")
+
+def parse_timestamp(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+
+class TextHistoryCodec:
+    def reset(self):
+        pass
+
+    def encode(self, uri, indexed_at):
+        return f"{uri}|{indexed_at.isoformat()}\n".encode("utf-8")
+
+    def decode(self, data):
+        # (URI, indexed_at) または (None, 破損内容) のリストと、最後の完全なレコードの終端を返す
+        end = data.rfind(b"\n") + 1
+        records = []
+        for raw in data[:end].decode("utf-8", errors="replace").splitlines():
+            line = raw.strip()
+            if not line:
+                continue
+            uri, sep, timestamp = line.partition("|")
+            try:
+                if not sep or not uri.startswith("at://"):
+                    raise ValueError("形式不正")
+                records.append((uri, parse_timestamp(timestamp)))
+            except ValueError as e:
+                records.append((None, f"{repr(line)}: {e}"))
+        return records, end
+
+class TruncatedRecord(Exception):
+    pass
+
+class BinaryHistoryCodec:
+    # D: DID定義（u16長さ + DID）→ 出現順にIDを振る
+    # E: 投稿エントリ（u32 DID ID + rkey 13バイト + UTCマイクロ秒 i64）
+    # U: それ以外のURI（u16長さ + URI + UTCマイクロ秒 i64）
+    DID = struct.Struct("<H")
+    ENTRY = struct.Struct("<I13sq")
+    URI = struct.Struct("<H")
+    MICROS = struct.Struct("<q")
+    EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    MAX_MICROS = 4102444800 * 1_000_000  # 2100-01-01
+    RESYNC_RECORDS = 8
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.did_ids = {}
+        self.dids = []
+
+    def _micros(self, indexed_at):
+        if indexed_at.tzinfo is None:
+            indexed_at = indexed_at.replace(tzinfo=timezone.utc)
+        delta = indexed_at - self.EPOCH
+        return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+    def encode(self, uri, indexed_at):
+        micros = self._micros(indexed_at)
+        parts = uri[len("at://"):].split("/")
+        if len(parts) == 3 and parts[1] == POST_COLLECTION and len(parts[2]) == 13 and parts[2].isascii():
+            did, _, rkey = parts
+            out = b""
+            if did not in self.did_ids:
+                encoded_did = did.encode("utf-8")
+                out += b"D" + self.DID.pack(len(encoded_did)) + encoded_did
+                self.did_ids[did] = len(self.dids)
+                self.dids.append(did)
+            return out + b"E" + self.ENTRY.pack(self.did_ids[did], rkey.encode("ascii"), micros)
+        encoded_uri = uri.encode("utf-8")
+        return b"U" + self.URI.pack(len(encoded_uri)) + encoded_uri + self.MICROS.pack(micros)
+
+    def _parse(self, data, pos, dids):
+        # posの1レコードを読む → (次の位置, (URI, indexed_at) またはDID定義ならNone)
+        # データが足りない（書きかけの末尾）ならTruncatedRecord、中身がおかしければValueError
+        tag = data[pos:pos + 1]
+        if tag == b"D":
+            start = pos + 1 + self.DID.size
+            if start > len(data):
+                raise TruncatedRecord()
+            (length,) = self.DID.unpack_from(data, pos + 1)
+            if start + length > len(data):
+                raise TruncatedRecord()
+            did = data[start:start + length].decode("utf-8")
+            if not did.startswith("did:"):
+                raise ValueError(f"DIDが不正: {repr(did[:40])}")
+            dids.append(did)
+            return start + length, None
+        if tag == b"E":
+            end = pos + 1 + self.ENTRY.size
+            if end > len(data):
+                raise TruncatedRecord()
+            did_id, rkey, micros = self.ENTRY.unpack_from(data, pos + 1)
+            if did_id >= len(dids):
+                raise ValueError(f"未定義のDID ID {did_id}")
+            rkey = rkey.decode("ascii")
+            if not rkey.isalnum():
+                raise ValueError(f"rkeyが不正: {repr(rkey)}")
+            return end, (f"at://{dids[did_id]}/{POST_COLLECTION}/{rkey}", self._datetime(micros))
+        if tag == b"U":
+            start = pos + 1 + self.URI.size
+            if start > len(data):
+                raise TruncatedRecord()
+            (length,) = self.URI.unpack_from(data, pos + 1)
+            if start + length + self.MICROS.size > len(data):
+                raise TruncatedRecord()
+            uri = data[start:start + length].decode("utf-8")
+            if not uri.startswith("at://"):
+                raise ValueError(f"URIが不正: {repr(uri[:40])}")
+            (micros,) = self.MICROS.unpack_from(data, start + length)
+            return start + length + self.MICROS.size, (uri, self._datetime(micros))
+        raise ValueError(f"不明なタグ {repr(tag)}")
+
+    def _datetime(self, micros):
+        if not 0 <= micros < self.MAX_MICROS:
+            raise ValueError(f"タイムスタンプが不正: {micros}")
+        return datetime.fromtimestamp(micros // 1_000_000, tz=timezone.utc).replace(microsecond=micros % 1_000_000)
+
+    def _resync(self, data, pos):
+        # 壊れたレコードの先で、続くRESYNC_RECORDS件（または末尾まで）が正しく読める位置を探す
+        for candidate in range(pos, len(data)):
+            if data[candidate:candidate + 1] not in (b"D", b"E", b"U"):
+                continue
+            dids = list(self.dids)
+            next_pos = candidate
+            try:
+                for _ in range(self.RESYNC_RECORDS):
+                    if next_pos >= len(data):
+                        break
+                    next_pos, _ = self._parse(data, next_pos, dids)
+            except TruncatedRecord:
+                pass
+            except ValueError:
+                continue
+            return candidate
+        return None
+
+    def decode(self, data):
+        # 途中の破損レコードは (None, 内容) にして読み飛ばし、続きから読み直す
+        # 返す終端は最後の完全なレコードの後ろ（それ以降は書きかけの末尾だけ）
+        self.reset()
+        records = []
+        pos = 0
+        while pos < len(data):
+            try:
+                pos, record = self._parse(data, pos, self.dids)
+            except TruncatedRecord:
+                break
+            except ValueError as e:
+                resync = self._resync(data, pos + 1)
+                if resync is None:
+                    # 後ろに読めるレコードが無い → 末尾のゴミ（書きかけ）として扱う
+                    records.append((None, f"{e} (offset={pos}, 以降 {len(data) - pos}バイト読めず)"))
+                    break
+                records.append((None, f"{e} (offset={pos}, {resync - pos}バイト読み飛ばし)"))
+                pos = resync
+                continue
+            if record is not None:
+                records.append(record)
+        for did_id, did in enumerate(self.dids):
+            self.did_ids.setdefault(did, did_id)
+        return records, pos
+
+class FuwamokoHistory:
+    def __init__(self, path, lock_path, normalize=None, retention=None, fmt="text", legacy_path=None,
+                 fsync_every=16, compact_dead_ratio=0.5, compact_min_lines=64):
+        self.path = path
+        self.lock = filelock.FileLock(lock_path, timeout=5.0)
+        self.normalize = normalize or (lambda uri: uri)
+        self.retention = retention  # timedelta（Noneなら無期限）
+        self.codec = BinaryHistoryCodec() if fmt == "binary" else TextHistoryCodec()
+        self.legacy_path = legacy_path  # バイナリ移行元のテキスト履歴
+        self.fsync_every = fsync_every
+        self.compact_dead_ratio = compact_dead_ratio
+        self.compact_min_lines = compact_min_lines
+        self.index = {}  # 正規化URI → indexed_at（こちらが正、ファイルは永続化用）
+        self._file = None
+        self._lines = 0  # ファイル上のレコード数（重複・破損・期限切れを含む）
+        self._dead = 0   # インデックスに反映されていないレコード数
+        self._unsynced = 0
+
+    def __contains__(self, uri):
+        return uri in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, uri, default=None):
+        return self.index.get(uri, default)
+
+    def cutoff(self):
+        return datetime.now(timezone.utc) - self.retention if self.retention else None
+
+    def load(self):
+        # 起動時に1回だけ読み込む（以降の保存でファイルを読み直さない）
+        self.close()
+        self.index.clear()
+        self.codec.reset()
+        self._lines = 0
+        self._dead = 0
+        if not os.path.exists(self.path):
+            if self.legacy_path and os.path.exists(self.legacy_path):
+                return self._migrate_legacy()
+            logging.info("🟢 ふわもこ履歴ファイルが存在しません。新規作成します。")
+            open(self.path, 'wb').close()
+            return self.index
+
+        try:
+            with self.lock:
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+                records, end = self.codec.decode(data)
+                self._recover_tail(data, end)
+        except filelock.Timeout:
+            logging.error(f"❌ ファイルロックタイムアウト: {self.lock.lock_file}")
+            return self.index
+        logging.info(f"🟢 ふわもこ履歴サイズ: {end} bytes")
+
+        expired = self._index_records(records)
+        logging.info(f"🟢 ふわもこURI読み込み: {len(self.index)}件（ファイル {self._lines}件, 無効 {self._dead}件, うち期限切れ {expired}件）")
+        corrupted = sum(1 for uri, _ in records if uri is None)
+        if corrupted:
+            # 壊れたレコードを読み飛ばした位置から追記を続けないよう、読めた分で書き直す
+            logging.warning(f"⚠️ 履歴ファイルの破損レコード {corrupted}件を読み飛ばしました → 書き直します")
+            self.compact()
+        else:
+            self.maybe_compact()
+        return self.index
+
+    def _index_records(self, records):
+        cutoff = self.cutoff()
+        expired = 0
+        for uri, value in records:
+            self._lines += 1
+            if uri is None:
+                log.warning("⏭️ 破損行スキップ: %s", value)
+                continue
+            normalized_uri = self.normalize(uri)
+            if cutoff and value < cutoff:
+                # 古いエントリは読み込まない（前の行があれば消す）
+                self.index.pop(normalized_uri, None)
+                expired += 1
+                continue
+            self.index[normalized_uri] = value
+        # インデックスに残らなかったレコード（重複・破損・期限切れ）は1件1回だけ無効として数える
+        self._dead = self._lines - len(self.index)
+        return expired
+
+    def _migrate_legacy(self):
+        with open(self.legacy_path, 'rb') as f:
+            records, _ = TextHistoryCodec().decode(f.read())
+        self._index_records(records)
+        logging.info(f"🟢 テキスト履歴からバイナリ形式へ移行: {self.legacy_path} → {self.path}（{len(self.index)}件）")
+        self.compact()
+        return self.index
+
+    def _recover_tail(self, data, end):
+        # 追記中のクラッシュで壊れるのは末尾のレコードだけ → 最後の完全なレコードまで切り詰める
+        # （途中の破損はdecodeが読み飛ばすので、ここで切られるのは後ろに読めるレコードが無い末尾だけ）
+        if end < len(data):
+            logging.warning(f"⚠️ 履歴ファイル末尾の書きかけレコードを除去: {repr(data[end:][:80])}")
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+        return self._file
+
+    def add(self, uri, indexed_at):
+        # O(1)追記: 1件書いてOSに渡す。fsyncはfsync_every件ごとにまとめる
+        indexed_at = parse_timestamp(indexed_at)
+        with self.lock:
+            f = self._open()
+            f.write(self.codec.encode(uri, indexed_at))
+            f.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every:
+                self._sync()
+        if uri in self.index:
+            self._dead += 1
+        self.index[uri] = indexed_at
+        self._lines += 1
+
+    def expire(self):
+        # 保持期間より古いエントリをインデックスから外す（ファイルはコンパクション時に詰める）
+        cutoff = self.cutoff()
+        if not cutoff:
+            return 0
+        expired = [uri for uri, indexed_at in self.index.items() if indexed_at < cutoff]
+        for uri in expired:
+            del self.index[uri]
+        self._dead += len(expired)
+        if expired:
+            logging.info(f"🟢 履歴期限切れ: {len(expired)}件")
+        return len(expired)
+
+    def _sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def dead_ratio(self):
+        return self._dead / self._lines if self._lines else 0.0
+
+    def maybe_compact(self):
+        self.expire()
+        if self._lines >= self.compact_min_lines and self.dead_ratio() > self.compact_dead_ratio:
+            self.compact()
+
+    def compact(self):
+        # インデックスからファイルを書き直す（一時ファイル → fsync → 置き換え）
+        temp_file = self.path + ".tmp"
+        try:
+            with self.lock:
+                self._sync()
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                # 新しいファイル用のDID表で書き出し、置き換えに成功してから切り替える
+                codec = type(self.codec)()
+                with open(temp_file, 'wb') as f:
+                    f.write(b"".join(codec.encode(uri, indexed_at) for uri, indexed_at in self.index.items()))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_file, self.path)
+                self.codec = codec
+            logging.info(f"🟢 履歴コンパクション完了: {self._lines}件 → {len(self.index)}件")
+            self._lines = len(self.index)
+            self._dead = 0
+        except Exception as e:
+            logging.error(f"❌ 履歴コンパクションエラー: {type(e).__name__}: {e}")
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    def close(self):
+        if self._file is None:
+            return
+        try:
+            self.sync()
+        finally:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,291 @@
+# 🔽 🖼️ ふわもこ画像解析（デコード〜特徴抽出）
+# 画像は1回だけ縮小デコードして、RGB/HSVバッファを色判定・肌色判定・分類器入力で共有する
+import logging
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from io import BytesIO
+from urllib.parse import quote, unquote
+
+import cv2
+import numpy as np
+import requests
+from PIL import Image, ImageFile
+from requests.adapters import HTTPAdapter
+
+from fuwamoko_logging import setup_worker_logging
+
+# 画像1枚ごと・色ごとのDEBUGは量が多いので専用カテゴリ（LOG_LEVELS / LOG_SAMPLINGで調整）
+log = logging.getLogger("fuwamoko.image")
+
+# PILのエラー抑制
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+# 解析サイズ（分類器入力 / 色解析）
+CLASSIFIER_SIZE = 224
+COLOR_SIZE = 64
+
+# 画像解析ワーカー数（0/1ならプロセスプールを使わずメインプロセスで解析）
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", os.cpu_count() or 1))
+
+# 画像ダウンロード（CDNは差し替え可能: ローカルのスタブサーバーでテストする用）
+CDN_BASE_URL = os.environ.get("FUWAMOKO_CDN_BASE_URL", "https://cdn.bsky.app")
+DOWNLOAD_CONCURRENCY = int(os.environ.get("IMAGE_DOWNLOAD_CONCURRENCY", "8"))
+DOWNLOAD_TIMEOUT = (3.05, 10)  # (接続, 読み込み)
+
+# 肌色範囲（OpenCV HSV）
+SKIN_LOWER = np.array([5, 50, 70], dtype=np.uint8)
+SKIN_UPPER = np.array([20, 150, 240], dtype=np.uint8)
+
+def is_food_color(r, g, b):
+    # 食品色範囲（ハム/卵/おにぎり/豆腐、桃花除外）
+    return ((150 <= r <= 200 and 150 <= g <= 200 and 150 <= b <= 200) or  # ハム/卵
+            (220 <= r <= 250 and 220 <= g <= 250 and 210 <= b <= 230) or  # おにぎり
+            (230 <= r <= 255 and 200 <= g <= 230 and 130 <= b <= 160) or  # 豆腐
+            (r == 255 and g == 255 and b == 255))                        # 純白
+
+def is_fluffy_color(r, g, b, bright_colors, hsv=None):
+    log.debug("🧪 色判定: RGB=(%d, %d, %d)", r, g, b)
+    if hsv is None:
+        hsv = cv2.cvtColor(np.array([[[r, g, b]]], dtype=np.uint8), cv2.COLOR_RGB2HSV)[0][0]
+    h, s, v = (int(x) for x in hsv)
+    log.debug("HSV=(%d, %d, %d)", h, s, v)
+
+    if is_food_color(r, g, b):
+        log.debug("食品色（ハム/卵/おにぎり/豆腐/純白）検出、ふわもことみなさない")
+        return False
+
+    # 白系（明るさv > 130、単色閾値10）
+    if r > 180 and g > 180 and b > 180 and v > 130:
+        if bright_colors is not None and len(bright_colors) > 0:
+            colors = np.asarray(bright_colors)
+            if np.std(colors, axis=0).max() < 10:
+                log.debug("単色白系、ふわもことみなさない")
+                return False
+        log.debug("白系検出（明るさOK、ピンク寄り含む）")
+        return True
+
+    # ピンク系（桃花優先）
+    if (r > 200 and g < 170 and b > 170 and v > 130) or \
+       (220 <= r <= 240 and 220 <= g <= 240 and 230 <= b <= 250):  # #232, 236, 247 対応
+        log.debug("ピンク系検出（桃花優先、明るさOK）")
+        return True
+
+    # クリーム色
+    if r > 220 and g > 210 and b > 170 and v > 130:
+        log.debug("クリーム色検出（広め）")
+        return True
+
+    # パステルパープル
+    if (r > 220 and g > 210 and b > 240 and abs(r - b) < 60 and v > 130) or \
+       (220 <= h <= 300 and s < 50 and v > 130):  # #F6DAF6, #E9DAF9 対応
+        log.debug("パステルパープル検出（明るさOK）")
+        return True
+
+    # 白灰ピンク系
+    if r > 200 and g > 180 and b > 200 and v > 130:
+        log.debug("ふわもこ白灰ピンク検出（桃花対応）")
+        return True
+
+    # 白灰系
+    if 200 <= r <= 255 and 200 <= g <= 240 and 200 <= b <= 255 and abs(r - g) < 30 and abs(r - b) < 30 and v > 130:
+        log.debug("白灰ふわもこカラー（柔らか系）")
+        return True
+
+    if 200 <= h <= 300 and s < 80 and v > 130:
+        log.debug("パステル系紫～ピンク検出（明るさOK）")
+        return True
+
+    if 190 <= h <= 260 and s < 100 and v > 130:
+        log.debug("夜空パステル紫検出（広め、明るさOK）")
+        return True
+
+    return False
+
+def check_skin_ratio(rgb, hsv):
+    try:
+        if rgb is None or rgb.size == 0:
+            logging.error("❌ 画像データ無効")
+            return 0.0
+
+        mask = cv2.inRange(hsv, SKIN_LOWER, SKIN_UPPER) > 0
+        skin_area = int(np.count_nonzero(mask))
+
+        if skin_area > 0:
+            avg_color = rgb[mask].mean(axis=0)
+            log.debug("平均肌色: RGB=%s", avg_color)
+            if np.mean(avg_color) > 220:
+                log.debug("→ 明るすぎるので肌色ではなく白とみなす")
+                return 0.0
+
+        total_area = rgb.shape[0] * rgb.shape[1]
+        skin_ratio = skin_area / total_area if total_area > 0 else 0.0
+        log.debug("肌色比率: %.2f%%", skin_ratio * 100)
+        return skin_ratio
+    except Exception as e:
+        logging.error(f"❌ 肌色解析エラー: {type(e).__name__}: {e}")
+        return 0.0
+
+def decode_image(data, size=CLASSIFIER_SIZE):
+    # JPEGはdraftでlibjpegに1/2〜1/8スケールで直接デコードさせる（フル解像度を展開しない）
+    img = Image.open(BytesIO(data))
+    original_size, image_format = img.size, img.format
+    img.draft("RGB", (size, size))
+    img = img.convert("RGB")
+    log.debug("🟢 画像形式=%s, サイズ=%s → デコード=%s", image_format or 'unknown', original_size, img.size)
+    if img.size != (size, size):
+        img = img.resize((size, size), Image.BILINEAR)
+    return np.asarray(img, dtype=np.uint8), original_size
+
+def analyze_colors(rgb, hsv):
+    # 明度フィルター後のトップ5カラーでふわもこ/食品判定
+    bright = hsv[..., 2].reshape(-1) > 130
+    bright_colors = rgb.reshape(-1, 3)[bright]
+    bright_hsv = hsv.reshape(-1, 3)[bright]
+    if len(bright_colors) == 0:
+        return 0, 0, 0.0
+
+    colors, first_index, counts = np.unique(bright_colors, axis=0, return_index=True, return_counts=True)
+    top = np.argsort(-counts, kind="stable")[:5]
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("トップ5カラー（明度フィルター後）: %s", [(tuple(int(c) for c in colors[i]), int(counts[i])) for i in top])
+
+    fluffy_count = 0
+    bright_color_count = 0
+    food_color_count = 0
+    for i in top:
+        r, g, b = (int(c) for c in colors[i])
+        if is_fluffy_color(r, g, b, bright_colors, hsv=bright_hsv[first_index[i]]):
+            fluffy_count += 1
+        if r > 180 and g > 180 and b > 180:
+            bright_color_count += 1
+        if is_food_color(r, g, b):
+            food_color_count += 1
+    log.debug("ふわもこ色カウント: %d, 明るい色数: %d, 食品色数: %d", fluffy_count, bright_color_count, food_color_count)
+    return fluffy_count, bright_color_count, food_color_count / 5
+
+def extract_image_features(data):
+    # 1回のデコードで色判定・肌色判定・分類器入力をまとめて作る
+    rgb, original_size = decode_image(data, CLASSIFIER_SIZE)
+    hsv = cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)
+
+    small_rgb = cv2.resize(rgb, (COLOR_SIZE, COLOR_SIZE), interpolation=cv2.INTER_AREA)
+    small_hsv = cv2.cvtColor(small_rgb, cv2.COLOR_RGB2HSV)
+    fluffy_count, bright_color_count, food_ratio = analyze_colors(small_rgb, small_hsv)
+
+    skin_ratio = check_skin_ratio(rgb, hsv)
+    log.debug("肌色比率: %.2f%%, 食品色比率: %.2f%%, ふわもこカラー数: %d", skin_ratio * 100, food_ratio * 100, fluffy_count)
+    return {
+        "original_size": original_size,
+        "fluffy_count": fluffy_count,
+        "bright_color_count": bright_color_count,
+        "food_ratio": food_ratio,
+        "skin_ratio": skin_ratio,
+        "pixels": rgb,
+    }
+
+def create_http_session(pool_size=DOWNLOAD_CONCURRENCY):
+    # keep-aliveで接続を使い回す（同時接続数 = pool_size）
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = "Mozilla/5.0"
+    return session
+
+def cdn_image_urls(did, cid, base_url=CDN_BASE_URL):
+    # 解析は224pxなので、小さいサムネイルを優先
+    did_safe = quote(unquote(did))
+    return [
+        f"{base_url}/img/feed_thumbnail/plain/{did_safe}/{quote(cid)}@jpeg",
+        f"{base_url}/img/feed_fullsize/plain/{did_safe}/{quote(cid)}@jpeg",
+    ]
+
+def fetch_image_bytes(session, did, cid, base_url=CDN_BASE_URL, fallback=None):
+    if not cid or not re.match(r'^baf[a-z0-9]{40,60}$', cid):
+        logging.error(f"❌ 無効なCID: {cid}")
+        return None
+
+    for url in cdn_image_urls(did, cid, base_url) if did else []:
+        try:
+            response = session.get(url, timeout=DOWNLOAD_TIMEOUT)
+            response.raise_for_status()
+            img = Image.open(BytesIO(response.content))  # ヘッダーだけ確認（デコードは解析時に縮小して行う）
+            log.info("🟢 画像形式=%s, サイズ=%s", img.format, img.size)
+            return response.content
+        except Exception as e:
+            logging.error(f"❌ CDN取得失敗: {type(e).__name__}: {e}, url={url}")
+
+    if fallback and did:
+        try:
+            data = fallback(cid, did)
+            img = Image.open(BytesIO(data))
+            log.info("🟢 Blob画像形式=%s, サイズ=%s", img.format, img.size)
+            return data
+        except Exception as e:
+            logging.error(f"❌ Blob APIエラー: {type(e).__name__}: {e}")
+
+    logging.error(f"❌ 画像取得失敗: cid={cid}")
+    return None
+
+def download_images(jobs, session=None, concurrency=DOWNLOAD_CONCURRENCY, base_url=CDN_BASE_URL, fallback=None):
+    # jobs: (key, did, cid) のイテラブル。同時concurrency本で取得し、完了した順に (key, バイト) をyield
+    own_session = session is None
+    if own_session:
+        session = create_http_session(concurrency)
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = {pool.submit(fetch_image_bytes, session, did, cid, base_url, fallback): key
+                       for key, did, cid in jobs}
+            for future in as_completed(futures):
+                data = future.result()
+                if data is not None:
+                    yield futures[future], data
+    finally:
+        if own_session:
+            session.close()
+
+def is_fluffy_by_color(features):
+    return features["fluffy_count"] >= 2 and features["food_ratio"] <= 0.2 and features["skin_ratio"] < 0.5
+
+def _init_image_worker(log_level):
+    # ワーカー内はプロセス並列なので、OpenCVのスレッドは1本で十分
+    cv2.setNumThreads(1)
+    setup_worker_logging(log_level)
+
+def analyze_image_bytes(data):
+    # ワーカーで実行: 生バイト → 特徴量レコード（失敗時None）
+    try:
+        features = extract_image_features(data)
+    except Exception as e:
+        logging.error(f"❌ 画像解析エラー: {type(e).__name__}: {e}")
+        return None
+    if is_fluffy_by_color(features):
+        features.pop("pixels")  # 色判定で確定 → 分類器入力は送り返さない
+    return features
+
+def analyze_images(items, workers=None):
+    # items: (key, 画像バイト) のイテラブル。届いた順にワーカーへ投げて {key: 特徴量} を返す
+    workers = IMAGE_WORKERS if workers is None else workers
+    results = {}
+    # 親プロセスは画像取得スレッドとログのリスナースレッドが動いているので、forkすると子がロックを
+    # 握られたまま固まることがある → スレッドの無いforkserverから起動する
+    # （__main__とこのモジュールはforkserverで1回だけimportし、ワーカーはそこからforkするので起動は軽い）
+    if workers <= 1 or "forkserver" not in multiprocessing.get_all_start_methods():
+        for key, data in items:
+            results[key] = analyze_image_bytes(data)
+        return results
+
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["__main__", __name__])
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_image_worker,
+                             initargs=(logging.getLogger().level,)) as pool:
+        futures = {pool.submit(analyze_image_bytes, data): key for key, data in items}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                logging.error(f"❌ 画像解析ワーカーエラー: {type(e).__name__}: {e}")
+                results[futures[future]] = None
+    return results
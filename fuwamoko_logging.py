@@ -0,0 +1,165 @@
+# 🔽 📜 ログ設定（ファイル書き込みは別スレッド、カテゴリ別レベル、大量DEBUGは間引き）
+# 呼び出し側はカテゴリロガー（fuwamoko.image / fuwamoko.uri / fuwamoko.filter / fuwamoko.history）に
+# %形式の引数で渡す → レベルで落ちるログは文字列を作らない、通ったログもフォーマットはリスナースレッドで行う
+import atexit
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+LOG_FILE = "debug.log"
+LOG_FORMAT = "%(asctime)s %(message)s"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG")
+# 例: LOG_LEVELS="fuwamoko.image=INFO,fuwamoko.uri=WARNING"
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+# 例: LOG_SAMPLING="fuwamoko.image=100" → DEBUGを100件に1件だけ残す（INFO以上は常に残す）
+LOG_SAMPLING = os.environ.get("LOG_SAMPLING", "fuwamoko.image=100,fuwamoko.uri=100")
+
+log_listener = None
+
+def parse_category_setting(value):
+    settings = {}
+    for item in value.split(","):
+        name, sep, setting = item.strip().partition("=")
+        if sep and name and setting:
+            settings[name.strip()] = setting.strip()
+    return settings
+
+class SamplingFilter(logging.Filter):
+    # DEBUGだけrate件に1件通す（カウンタのみ、乱数も文字列も作らない）
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = max(1, int(rate))
+        self._counter = itertools.count()
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or next(self._counter) % self.rate == 0
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # 標準のprepareは呼び出しスレッドでフォーマットしてしまうので、レコードをそのまま渡す
+    # （同一プロセス内のqueue.Queue専用。フォーマットはリスナー側のハンドラで行う）
+    def prepare(self, record):
+        return record
+
+def build_handlers(log_file, console=True):
+    handlers = [logging.FileHandler(log_file, encoding="utf-8")]
+    if console:
+        handlers.append(logging.StreamHandler())
+    formatter = logging.Formatter(LOG_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+def reset_root_handlers():
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+def configure_categories(levels=LOG_LEVELS, sampling=LOG_SAMPLING):
+    for name, level in parse_category_setting(levels).items():
+        logging.getLogger(name).setLevel(level.upper())
+    for name, rate in parse_category_setting(sampling).items():
+        logger = logging.getLogger(name)
+        for old in [f for f in logger.filters if isinstance(f, SamplingFilter)]:
+            logger.removeFilter(old)
+        logger.addFilter(SamplingFilter(rate))
+
+def setup_logging(log_file=LOG_FILE, level=LOG_LEVEL, asynchronous=True, console=True,
+                  levels=LOG_LEVELS, sampling=LOG_SAMPLING):
+    global log_listener
+    stop_logging()
+    reset_root_handlers()
+    root = logging.getLogger()
+    root.setLevel(level)
+    handlers = build_handlers(log_file, console)
+    if asynchronous:
+        log_queue = queue.SimpleQueue()
+        root.addHandler(DeferredQueueHandler(log_queue))
+        log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        log_listener.start()
+    else:
+        for handler in handlers:
+            root.addHandler(handler)
+    configure_categories(levels, sampling)
+    return log_listener
+
+def stop_logging():
+    # キューに残ったログを書き切ってからリスナーを止める
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.close()
+        log_listener = None
+
+def setup_worker_logging(level=LOG_LEVEL, log_file=LOG_FILE):
+    # ワーカープロセスにはリスナースレッドが無いので、キューではなくファイルへ直接書く
+    # （forkserverから起動するので親の設定は引き継がれない → レベル・カテゴリ別設定をここで入れ直す）
+    reset_root_handlers()
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in build_handlers(log_file):
+        root.addHandler(handler)
+    configure_categories()
+
+atexit.register(stop_logging)
+
+def benchmark_logging(n_images=200, size=(160, 120), repeats=5):
+    # 画像1枚あたりのログのオーバーヘッド（ログ無効との差）を、同期書き込み・全件と非同期・間引きで比較
+    import tempfile
+
+    import cv2
+    import numpy as np
+    from PIL import Image
+    from io import BytesIO
+
+    from fuwamoko_image import extract_image_features
+
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(8):
+        buffer = BytesIO()
+        pixels = rng.integers(150, 256, size=(size[1], size[0], 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(buffer, format="JPEG", quality=85)
+        images.append(buffer.getvalue())
+
+    def run():
+        start = time.perf_counter()
+        for i in range(n_images):
+            extract_image_features(images[i % len(images)])
+        return (time.perf_counter() - start) / n_images
+
+    configs = [
+        ("ログ無効", {"level": "CRITICAL", "levels": "", "sampling": ""}),
+        ("同期・全件DEBUG（従来）", {"asynchronous": False, "levels": "", "sampling": ""}),
+        ("非同期・全件DEBUG", {"levels": "", "sampling": ""}),
+        ("非同期・間引き（既定）", {}),
+        ("非同期・画像INFO", {"levels": "fuwamoko.image=INFO", "sampling": ""}),
+    ]
+    results = {}
+    cv2.setNumThreads(1)  # 計測の揺らぎを減らす（ワーカーと同じ条件）
+    with tempfile.TemporaryDirectory() as tmp:
+        log_file = os.path.join(tmp, "bench.log")
+        # 設定を交互に繰り返し、それぞれの最速値を使う（マシン負荷の揺らぎを均す）
+        for _ in range(repeats):
+            for name, kwargs in configs:
+                for category in ("fuwamoko.image", "fuwamoko.uri"):
+                    logger = logging.getLogger(category)
+                    logger.setLevel(logging.NOTSET)
+                    for f in logger.filters[:]:
+                        logger.removeFilter(f)
+                setup_logging(log_file, console=False, **{"level": "DEBUG", **kwargs})
+                run()  # ウォームアップ
+                seconds = run()
+                stop_logging()
+                results[name] = min(seconds, results.get(name, seconds))
+    reset_root_handlers()
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+
+    baseline = results["ログ無効"]
+    for name, seconds in results.items():
+        print(f"📊 {name}: {seconds * 1000:.3f}ms/枚（ログのオーバーヘッド {max(0.0, seconds - baseline) * 1000:.3f}ms/枚）")
+    return results
@@ -0,0 +1,222 @@
+# 🔽 🌊 Jetstreamストリーミング（ポーリングの代わりに投稿イベントを受け取り続ける）
+# ・app.bsky.feed.post の作成イベントを購読し、event_filterを通ったものだけ少しためてhandlerにまとめて渡す
+# ・handlerが処理し終えたイベントのtime_usをカーソルとして保存 → 切断・再起動しても続きから再開
+#   （再接続時は数秒巻き戻すので同じ投稿が2回来ることがある。両Botとも処理済みURIで弾くので問題なし）
+# ・handlerが失敗したバッチは捨てずに残して再試行し、カーソルもその手前で止める
+#   （受け直したイベントはURIで弾くので、失敗中に再接続しても同じ投稿を二重に渡さない）
+# ・ローカル確認用: python jetstream.py --record events.jsonl [件数] で本番の流れを保存、
+#   python jetstream.py --replay events.jsonl [ポート] で保存したイベントを流す代役サーバーを起動し、
+#   JETSTREAM_URL=ws://127.0.0.1:6008/subscribe でBotをつなぐ
+import json
+import logging
+import os
+import sys
+import time
+import urllib.parse
+
+from websockets.exceptions import ConnectionClosed
+from websockets.sync.client import connect
+
+JETSTREAM_URL = os.environ.get("JETSTREAM_URL", "wss://jetstream2.us-east.bsky.network/subscribe")
+POST_COLLECTION = "app.bsky.feed.post"
+CURSOR_REWIND_US = 5 * 1_000_000  # 再接続時に巻き戻す時間（取りこぼし防止）
+CURSOR_SAVE_INTERVAL = 10  # 秒
+STREAM_BATCH_SIZE = 25  # getPostsの上限に合わせる
+STREAM_BATCH_WAIT = 3.0  # 秒。これだけ待ってたまった分を処理する
+RECONNECT_MAX_WAIT = 60
+
+def subscribe_url(base_url=JETSTREAM_URL, collections=(POST_COLLECTION,), cursor=None):
+    params = [("wantedCollections", collection) for collection in collections]
+    if cursor:
+        params.append(("cursor", str(cursor)))
+    return f"{base_url}?{urllib.parse.urlencode(params)}"
+
+def load_cursor(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("cursor")
+    except Exception as e:
+        logging.error(f"❌ カーソル読み込みエラー: {type(e).__name__}: {e}")
+        return None
+
+def save_cursor(path, cursor):
+    temp_file = path + ".tmp"
+    try:
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump({"cursor": cursor, "saved_at": time.time()}, f)
+        os.replace(temp_file, path)
+    except Exception as e:
+        logging.error(f"❌ カーソル保存エラー: {type(e).__name__}: {e}")
+
+def is_post_create(event):
+    commit = event.get("commit") or {}
+    return (event.get("kind") == "commit" and commit.get("operation") == "create"
+            and commit.get("collection") == POST_COLLECTION and isinstance(commit.get("record"), dict))
+
+def event_uri(event):
+    return f"at://{event['did']}/{event['commit']['collection']}/{event['commit']['rkey']}"
+
+def event_record(event):
+    return event["commit"]["record"]
+
+def mentions_did(record, did):
+    # 本文のメンション（facet）か、自分の投稿へのリプライ
+    for facet in record.get("facets") or []:
+        for feature in facet.get("features") or []:
+            if feature.get("$type") == "app.bsky.richtext.facet#mention" and feature.get("did") == did:
+                return True
+    reply = record.get("reply") or {}
+    return any(str((reply.get(key) or {}).get("uri", "")).startswith(f"at://{did}/") for key in ("parent", "root"))
+
+def has_image_embed(record):
+    embed = record.get("embed") or {}
+    if embed.get("$type") == "app.bsky.embed.recordWithMedia":
+        embed = embed.get("media") or {}
+    return embed.get("$type") == "app.bsky.embed.images" and bool(embed.get("images"))
+
+def run_stream(handler, event_filter, cursor_path, url=JETSTREAM_URL, batch_size=STREAM_BATCH_SIZE,
+               batch_wait=STREAM_BATCH_WAIT, max_events=None, stop_when_idle=None):
+    # handler(events) にフィルタを通った投稿イベントをまとめて渡す。
+    # max_events: 受信したイベント数で止める（確認用）。stop_when_idle: この秒数イベントが来なければ止める（代役サーバー用）
+    cursor = load_cursor(cursor_path)
+    if cursor:
+        logging.info(f"🟢 ストリーム再開: カーソル {cursor}")
+    saved_cursor = cursor
+    last_saved_at = time.time()
+    received = 0
+    reconnect_wait = 1
+    pending = []
+    pending_cursor = cursor
+    failures = 0
+    retry_at = 0.0
+    queued = {}  # 処理待ち・処理済みのURI → time_us（再接続の巻き戻しで同じイベントが来ても二重に積まない）
+
+    def maybe_save():
+        nonlocal saved_cursor, last_saved_at
+        if cursor != saved_cursor and time.time() - last_saved_at >= CURSOR_SAVE_INTERVAL:
+            save_cursor(cursor_path, cursor)
+            saved_cursor, last_saved_at = cursor, time.time()
+
+    def flush(force=False):
+        # handlerが成功した分だけカーソルを進める。失敗したらそのバッチから後ろを残し、
+        # カーソルを残した最初のイベントの直前に戻す（落ちても再起動後に同じイベントから受け直す）
+        # 再試行は待ち時間が過ぎてからの次のバッチの区切りで行う（受信ループは止めない → 接続を保つ）
+        nonlocal cursor, pending, failures, retry_at, queued
+        if not force and time.time() < retry_at:
+            return
+        while pending:
+            batch = pending[:batch_size]
+            try:
+                handler(batch)
+            except Exception as e:
+                failures += 1
+                wait = min(2 ** failures, RECONNECT_MAX_WAIT)
+                retry_at = time.time() + wait
+                logging.error(f"❌ ストリーム処理エラー: {type(e).__name__}: {e}（{len(batch)}件）→ {wait}秒後に再試行")
+                cursor = batch[0]["time_us"] - 1
+                maybe_save()
+                return
+            failures = 0
+            pending = pending[len(batch):]
+        cursor = pending_cursor
+        maybe_save()
+        # 巻き戻しで届きうる範囲より古いURIは覚えておかなくてよい
+        if cursor:
+            queued = {uri: time_us for uri, time_us in queued.items() if time_us >= cursor - CURSOR_REWIND_US}
+
+    try:
+        while max_events is None or received < max_events:
+            resume_from = cursor - CURSOR_REWIND_US if cursor else None
+            try:
+                with connect(subscribe_url(url, cursor=resume_from), open_timeout=10, max_size=2 ** 22) as ws:
+                    logging.info(f"🟢 ストリーム接続: {url}（カーソル {resume_from}）")
+                    reconnect_wait = 1
+                    batch_started = None
+                    idle_since = time.time()
+                    while max_events is None or received < max_events:
+                        timeout = batch_wait if batch_started is None else max(0.0, batch_started + batch_wait - time.time())
+                        try:
+                            message = ws.recv(timeout=timeout)
+                        except TimeoutError:
+                            flush()
+                            batch_started = None
+                            if stop_when_idle is not None and time.time() - idle_since >= stop_when_idle:
+                                return cursor
+                            continue
+                        idle_since = time.time()
+                        received += 1
+                        event = json.loads(message)
+                        if is_post_create(event) and event_uri(event) not in queued and event_filter(event):
+                            queued[event_uri(event)] = event["time_us"]
+                            pending.append(event)
+                            if batch_started is None:
+                                batch_started = time.time()
+                        pending_cursor = event.get("time_us", pending_cursor)
+                        if not pending:
+                            # 待ちのイベントが無ければ、ここまでは処理済み
+                            cursor = pending_cursor
+                            maybe_save()
+                        elif len(pending) >= batch_size:
+                            flush()
+                            batch_started = None
+            except (ConnectionClosed, OSError, TimeoutError) as e:
+                flush()
+                logging.warning(f"⚠️ ストリーム切断: {type(e).__name__}: {e} → {reconnect_wait}秒後に再接続")
+                time.sleep(reconnect_wait)
+                reconnect_wait = min(reconnect_wait * 2, RECONNECT_MAX_WAIT)
+    except KeyboardInterrupt:
+        logging.info("🟢 ストリーム停止（Ctrl+C）")
+    finally:
+        flush(force=True)
+        if cursor and cursor != saved_cursor:
+            save_cursor(cursor_path, cursor)
+    return cursor
+
+def record_events(path, limit=1000, url=JETSTREAM_URL):
+    # 本番のイベントをそのままJSONLで保存（代役サーバー用）
+    with connect(subscribe_url(url), open_timeout=10, max_size=2 ** 22) as ws, open(path, "w", encoding="utf-8") as f:
+        for _ in range(limit):
+            f.write(ws.recv() + "\n")
+    print(f"💾 イベント保存: {limit}件 → {path}")
+
+def serve_replay(path, host="127.0.0.1", port=6008, close_after=None):
+    # 保存したイベントを流す代役Jetstream。cursorクエリ以降のイベントだけ送る
+    # close_after: その件数を送ったら切断する（再接続・再開の確認用）
+    from websockets.sync.server import serve
+
+    with open(path, "r", encoding="utf-8") as f:
+        events = [line.strip() for line in f if line.strip()]
+
+    def handle(ws):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(ws.request.path).query)
+        cursor = int(query.get("cursor", ["0"])[0])
+        sent = 0
+        for message in events:
+            if json.loads(message).get("time_us", 0) <= cursor:
+                continue
+            ws.send(message)
+            sent += 1
+            if close_after and sent >= close_after:
+                break
+        logging.info(f"🟢 代役ストリーム: {sent}件送信（カーソル {cursor}）")
+        if close_after and sent >= close_after:
+            return
+        try:
+            ws.recv()  # クライアントが切るまで待つ
+        except ConnectionClosed:
+            pass
+
+    server = serve(handle, host, port)
+    print(f"🌊 代役ストリーム起動: ws://{host}:{port}/subscribe（{len(events)}件）")
+    return server
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if len(sys.argv) >= 3 and sys.argv[1] == "--record":
+        record_events(sys.argv[2], int(sys.argv[3]) if len(sys.argv) >= 4 else 1000)
+    elif len(sys.argv) >= 3 and sys.argv[1] == "--replay":
+        serve_replay(sys.argv[2], port=int(sys.argv[3]) if len(sys.argv) >= 4 else 6008).serve_forever()
+    else:
+        print("使い方: python jetstream.py --record events.jsonl [件数] / --replay events.jsonl [ポート]")
@@ -0,0 +1,60 @@
+# 🔽 🌐 オフライン言語判定（投稿本文の文字種の割合）
+# ひらがな・カタカナ（または漢字が主）なら日本語、ラテン文字がほとんどなら英語（ローマ字っぽい単語ばかりなら判定しない）
+# 文字数が少ない・記号や絵文字だけ等で決めきれないときは None → 呼び出し側でプロフィール等にフォールバック
+import re
+
+import numpy as np
+
+# (開始コードポイント, 文字種)。次の開始までがその文字種
+SCRIPT_RANGES = [
+    (0x0000, "other"),
+    (0x0041, "latin"), (0x005B, "other"),
+    (0x0061, "latin"), (0x007B, "other"),
+    (0x00C0, "latin"), (0x0250, "other"),
+    (0x1100, "hangul"), (0x1200, "other"),
+    (0x3040, "kana"), (0x3100, "other"),
+    (0x3130, "hangul"), (0x3190, "other"),
+    (0x31F0, "kana"), (0x3200, "other"),
+    (0x3400, "kanji"), (0x4DC0, "other"),
+    (0x4E00, "kanji"), (0xA000, "other"),
+    (0xAC00, "hangul"), (0xD7B0, "other"),
+    (0xF900, "kanji"), (0xFB00, "other"),
+    (0xFF21, "latin"), (0xFF3B, "other"),
+    (0xFF41, "latin"), (0xFF5B, "other"),
+    (0xFF66, "kana"), (0xFFA0, "other"),
+]
+SCRIPTS = ["other", "latin", "kana", "kanji", "hangul"]
+SCRIPT_BOUNDS = np.array([start for start, _ in SCRIPT_RANGES], dtype=np.uint32)
+SCRIPT_LABELS = np.array([SCRIPTS.index(script) for _, script in SCRIPT_RANGES], dtype=np.intp)
+
+MIN_LETTERS = 3  # これ未満の文字数では判定しない
+LATIN_RATIO = 0.8  # 英語とみなすラテン文字の割合
+ROMAJI_RATIO = 0.6  # これ以上ローマ字っぽい単語なら英語とは言い切らない
+
+WORD_PATTERN = re.compile(r"[a-z]+")
+# ローマ字の音節だけでできた単語（kawaii, mofumofu, oyasumi …）
+ROMAJI_PATTERN = re.compile(r"(?:(?:[kgsztdnhbpmr]y?|sh|ch|ts|[jfwy])?[aiueo]|n)+")
+
+def script_counts(text):
+    # {文字種: 文字数}。コードポイント配列を区間表で一括分類する
+    codes = np.frombuffer((text or "").encode("utf-32-le"), dtype=np.uint32)
+    labels = SCRIPT_LABELS[np.searchsorted(SCRIPT_BOUNDS, codes, side="right") - 1]
+    return dict(zip(SCRIPTS, np.bincount(labels, minlength=len(SCRIPTS)).tolist()))
+
+def romaji_ratio(text):
+    words = [word for word in WORD_PATTERN.findall(text.lower()) if len(word) >= 3]
+    if not words:
+        return 0.0
+    return sum(1 for word in words if ROMAJI_PATTERN.fullmatch(word)) / len(words)
+
+def detect_text_language(text):
+    # "ja" / "en" / None（決めきれない）
+    counts = script_counts(text)
+    if counts["kana"] or (counts["kanji"] and counts["kanji"] >= counts["latin"] + counts["hangul"]):
+        return "ja"
+    letters = counts["latin"] + counts["kanji"] + counts["hangul"]
+    if letters < MIN_LETTERS:
+        return None
+    if counts["latin"] / letters >= LATIN_RATIO and romaji_ratio(text) < ROMAJI_RATIO:
+        return "en"
+    return None
@@ -0,0 +1,191 @@
+# 🔽 🤝 リース（作業の取り合い防止）と担当の振り分け
+# 複数のランナー（プロセス・マシン）で通知やタイムラインを分担する
+# ・担当: 生きているランナーのコンシステントハッシュ環で、著者DID（またはURI）ごとに1人に決める
+#   → ランナーが増減しても担当が変わるのは一部だけ
+# ・リース: 返信する直前にURIごとに期限付きで確保し、返信できたら完了にする
+#   → 担当の切り替わり中に2人が同じ投稿を担当と判断しても、返信するのは1人だけ
+# ストアは差し替え可能（LEASE_STOREのスキーム → LEASE_STORES）。同梱はSQLite（同じマシン・共有ディスク用、確認用）
+# LEASE_STOREが未設定なら1人で全部担当する（従来どおり）
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+LEASE_STORE = os.environ.get("LEASE_STORE", "")  # 例: sqlite:///leases.db
+RUNNER_ID = os.environ.get("RUNNER_ID", f"{socket.gethostname()}-{os.getpid()}")
+LEASE_TTL = int(os.environ.get("LEASE_TTL", "300"))  # 返信1件の確保時間（秒）
+MEMBER_TTL = int(os.environ.get("LEASE_MEMBER_TTL", "120"))  # ハートビートが途切れてから外れるまで（秒）
+DONE_RETENTION = int(os.environ.get("LEASE_DONE_RETENTION", str(7 * 24 * 3600)))  # 完了記録を残す期間（秒）
+RING_REFRESH = 10  # メンバー一覧を読み直す間隔（秒）
+RING_VNODES = 64
+
+class SQLiteLeaseStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, done INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS members (member TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def acquire(self, key, owner, ttl):
+        # 未完了で、期限切れか自分のリースなら取れる（1文なのでランナー間でも原子的）
+        now = time.time()
+        cursor = self._execute(
+            "INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.done = 0 AND (leases.expires_at < ? OR leases.owner = excluded.owner)",
+            (key, owner, now + ttl, now),
+        )
+        return cursor.rowcount == 1
+
+    def release(self, key, owner):
+        self._execute("DELETE FROM leases WHERE key = ? AND owner = ? AND done = 0", (key, owner))
+
+    def complete(self, key, owner, retention):
+        cursor = self._execute(
+            "UPDATE leases SET done = 1, expires_at = ? WHERE key = ? AND owner = ?",
+            (time.time() + retention, key, owner),
+        )
+        return cursor.rowcount == 1
+
+    def heartbeat(self, member, ttl):
+        self._execute(
+            "INSERT INTO members (member, expires_at) VALUES (?, ?) "
+            "ON CONFLICT(member) DO UPDATE SET expires_at = excluded.expires_at",
+            (member, time.time() + ttl),
+        )
+
+    def leave(self, member):
+        self._execute("DELETE FROM members WHERE member = ?", (member,))
+
+    def members(self):
+        rows = self._execute("SELECT member FROM members WHERE expires_at >= ? ORDER BY member", (time.time(),))
+        return [row[0] for row in rows.fetchall()]
+
+    def purge(self):
+        # 期限切れのリース・完了記録・メンバーを消す
+        now = time.time()
+        leases = self._execute("DELETE FROM leases WHERE expires_at < ?", (now,)).rowcount
+        self._execute("DELETE FROM members WHERE expires_at < ?", (now,))
+        return leases
+
+LEASE_STORES = {
+    "sqlite": lambda location: SQLiteLeaseStore(location),
+}
+
+def open_lease_store(url=LEASE_STORE):
+    if not url:
+        return None
+    scheme, sep, location = url.partition("://")
+    if not sep or scheme not in LEASE_STORES:
+        raise ValueError(f"未対応のLEASE_STORE: {url}（対応: {', '.join(LEASE_STORES)}）")
+    if location.startswith("/"):
+        # sqlite:///leases.db → leases.db、sqlite:////var/lib/bot/leases.db → /var/lib/bot/leases.db
+        location = location[1:]
+    return LEASE_STORES[scheme](location)
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.sha1(value.encode("utf-8")).digest()[:8], "big")
+
+class HashRing:
+    # コンシステントハッシュ環（仮想ノードで偏りをならす）
+    def __init__(self, members, vnodes=RING_VNODES):
+        self.members = list(members)
+        points = sorted((ring_hash(f"{member}#{i}"), member) for member in self.members for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, key):
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, ring_hash(key)) % len(self._hashes)
+        return self._owners[i]
+
+class WorkClaimer:
+    # ボットから使う窓口。store=Noneなら全部自分の担当
+    def __init__(self, store=None, runner_id=RUNNER_ID, lease_ttl=LEASE_TTL, member_ttl=MEMBER_TTL):
+        self.store = store
+        self.runner_id = runner_id
+        self.lease_ttl = lease_ttl
+        self.member_ttl = member_ttl
+        self._ring = None
+        self._ring_loaded_at = 0.0
+        self._heartbeat_at = 0.0
+        self.stats = {"owned": 0, "skipped": 0, "claimed": 0, "contended": 0}
+
+    def join(self):
+        if self.store is None:
+            return
+        self.heartbeat()
+        self.store.purge()
+        self._ring_loaded_at = 0.0
+        logging.info(f"🟢 ランナー参加: {self.runner_id}（稼働中 {len(self.ring().members)}台）")
+
+    def leave(self):
+        if self.store is None:
+            return
+        self.store.leave(self.runner_id)
+        logging.info(f"🟢 ランナー離脱: {self.runner_id} / 担当 {self.stats['owned']}件, 他の担当 {self.stats['skipped']}件, "
+                     f"リース取得 {self.stats['claimed']}件, 取り合い {self.stats['contended']}件")
+
+    def heartbeat(self):
+        self.store.heartbeat(self.runner_id, self.member_ttl)
+        self._heartbeat_at = time.time()
+
+    def ring(self):
+        now = time.time()
+        if now - self._heartbeat_at > self.member_ttl / 3:
+            self.heartbeat()
+        if self._ring is None or now - self._ring_loaded_at > RING_REFRESH:
+            members = self.store.members()
+            if self.runner_id not in members:
+                members.append(self.runner_id)
+            self._ring = HashRing(members)
+            self._ring_loaded_at = now
+        return self._ring
+
+    def owns(self, shard_key):
+        # 自分の担当か（ストアへの書き込みなし。重い処理の前に振り分ける用）
+        if self.store is None or not shard_key:
+            return True
+        mine = self.ring().owner(shard_key) == self.runner_id
+        self.stats["owned" if mine else "skipped"] += 1
+        return mine
+
+    def claim(self, key):
+        # 返信直前にURIを確保する。完了済み・他のランナーが確保中ならFalse
+        if self.store is None:
+            return True
+        if self.store.acquire(key, self.runner_id, self.lease_ttl):
+            self.stats["claimed"] += 1
+            return True
+        self.stats["contended"] += 1
+        return False
+
+    def done(self, key):
+        if self.store is not None:
+            self.store.complete(key, self.runner_id, DONE_RETENTION)
+
+    def release(self, key):
+        if self.store is not None:
+            self.store.release(key, self.runner_id)
+
+_claimer = None
+
+def get_work_claimer():
+    global _claimer
+    if _claimer is None:
+        _claimer = WorkClaimer(open_lease_store())
+    return _claimer
@@ -0,0 +1,49 @@
+# 🔽 🧠 共有モデルレジストリ
+# 同じプロセス内のBot・キャラ設定はすべてここから同じモデル/トークナイザを受け取る
+# （何体動かしてもメモリはモデル1つ分）
+import logging
+import threading
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from ng_decoding import NGVocabulary
+
+DEFAULT_MODEL_NAME = "cyberagent/open-calm-small"
+
+_models = {}
+_ng_vocabularies = {}
+_lock = threading.Lock()
+
+def get_model(model_name=DEFAULT_MODEL_NAME, cache_dir=None):
+    # (model, tokenizer) を返す。初回だけ読み込み、以降は同じインスタンス
+    with _lock:
+        if model_name not in _models:
+            logging.info(f"🟢 モデル読み込み中: {model_name}")
+            tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=cache_dir)
+            tokenizer.pad_token = tokenizer.eos_token
+            model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                cache_dir=cache_dir,
+                torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+                device_map="auto"
+            ).eval()
+            _models[model_name] = (model, tokenizer)
+            logging.info(f"🟢 モデル読み込み完了: {model_name}")
+        return _models[model_name]
+
+def get_ng_vocabulary(model_name, words):
+    # NG語彙はモデルとNGワードの組み合わせごとに1回だけ作る（同じ設定のキャラは共有）
+    key = (model_name, tuple(sorted(set(words))))
+    with _lock:
+        vocabulary = _ng_vocabularies.get(key)
+    if vocabulary is None:
+        _, tokenizer = get_model(model_name)
+        vocabulary = NGVocabulary(tokenizer, key[1])
+        with _lock:
+            vocabulary = _ng_vocabularies.setdefault(key, vocabulary)
+    return vocabulary
+
+def loaded_models():
+    with _lock:
+        return list(_models)
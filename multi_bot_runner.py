@@ -0,0 +1,120 @@
+# 🔽 🤖 複数Bot同居ランナー
+# ふわもこBotと返信Bot（キャラ設定ごと）を1つのプロセスで動かし、モデルは1つだけ読み込んで共有する
+# 使い方: python multi_bot_runner.py [--once]
+# 設定: MULTI_BOT_CONFIG（既定 bots.json）。無ければ ふわもこBot＋返信Bot（環境変数のアカウント）で動く
+# 例:
+# [
+#   {"type": "fuwamoko", "interval": 600},   ← ふわもこBotは1体まで（保存ファイルがアカウント共通のため）
+#   {"type": "reply", "interval": 300},
+#   {"type": "reply", "interval": 300,
+#    "persona": {"env_prefix": "MIRIN_", "bot_name": "みりん", "first_person": "みりんてゃ"}}
+# ]
+import json
+import logging
+import os
+import sys
+import time
+
+import psutil
+from dotenv import load_dotenv
+
+from fuwamoko_logging import setup_logging
+from model_registry import get_model, loaded_models
+
+MULTI_BOT_CONFIG = os.environ.get("MULTI_BOT_CONFIG", "bots.json")
+MODEL_NAME = os.environ.get("MODEL_NAME", "cyberagent/open-calm-small")
+DEFAULT_BOTS = [
+    {"type": "fuwamoko", "interval": 600},
+    {"type": "reply", "interval": 300},
+]
+
+def load_bot_config(path=MULTI_BOT_CONFIG):
+    if not os.path.exists(path):
+        logging.info(f"🟢 {path} が無いので既定の構成で起動: ふわもこBot＋返信Bot")
+        return DEFAULT_BOTS
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            bots = json.load(f)
+        logging.info(f"🟢 Bot構成読み込み: {path}（{len(bots)}体）")
+    except Exception as e:
+        logging.error(f"❌ Bot構成読み込みエラー: {type(e).__name__}: {e}")
+        sys.exit(1)
+    # ふわもこBotはセッション・履歴・既読位置などのファイルがアカウント共通なので、1プロセスに1体だけ
+    fuwamoko_bots = [bot for bot in bots if bot.get("type") == "fuwamoko"]
+    if len(fuwamoko_bots) > 1:
+        logging.error(f"❌ ふわもこBotは1体までです（設定 {len(fuwamoko_bots)}体）: {path}")
+        sys.exit(1)
+    return bots
+
+def bot_label(bot):
+    persona = bot.get("persona") or {}
+    return f"{bot['type']}:{persona.get('bot_name') or persona.get('env_prefix') or 'default'}"
+
+def run_fuwamoko(bot):
+    import fuwamoko_empathy_bot
+    prefix = (bot.get("persona") or {}).get("env_prefix", "")
+    if prefix:
+        fuwamoko_empathy_bot.HANDLE = os.environ.get(f"{prefix}HANDLE")
+        fuwamoko_empathy_bot.APP_PASSWORD = os.environ.get(f"{prefix}APP_PASSWORD")
+    fuwamoko_empathy_bot.run_once()
+
+def run_reply(bot):
+    import reply_bot
+    config = bot.get("persona") or {}
+    persona = reply_bot.load_persona_from_env(config.get("env_prefix", ""))
+    persona.update({key: config[key] for key in ("bot_name", "first_person", "reply_table") if key in config})
+    # 1体ずつ順番に動かすので、実行直前にモジュール変数を差し替えれば他のキャラと混ざらない
+    reply_bot.use_persona(persona)
+    reply_bot.run_reply_bot()
+
+BOT_RUNNERS = {
+    "fuwamoko": run_fuwamoko,
+    "reply": run_reply,
+}
+
+def log_memory(label):
+    rss = psutil.Process().memory_info().rss / 1024**2
+    logging.info(f"📊 メモリ使用量（{label}）: {rss:.1f}MB / 読み込み済みモデル: {loaded_models()}")
+
+def run_bot(bot):
+    label = bot_label(bot)
+    runner = BOT_RUNNERS.get(bot["type"])
+    if runner is None:
+        logging.error(f"❌ 未対応のBot種別: {bot['type']}")
+        return
+    start = time.time()
+    try:
+        runner(bot)
+        logging.info(f"🟢 {label} 完了: {time.time() - start:.1f}秒")
+    except SystemExit as e:
+        # 単体起動用のexit()で他のBotまで止めない
+        logging.error(f"❌ {label} 終了要求: {e}")
+    except Exception as e:
+        logging.error(f"❌ {label} 実行エラー: {type(e).__name__}: {e}")
+    log_memory(label)
+
+def run_forever(bots, once=False):
+    # 締め切りが一番早いBotから順に動かす（1スレッドで順番に実行するのでモデルもモジュール変数も取り合わない）
+    next_run = {i: time.time() for i in range(len(bots))}
+    while next_run:
+        i = min(next_run, key=next_run.get)
+        wait = next_run[i] - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        run_bot(bots[i])
+        if once:
+            del next_run[i]
+        else:
+            next_run[i] = time.time() + bots[i].get("interval", 600)
+
+if __name__ == "__main__":
+    load_dotenv()
+    setup_logging()
+    bots = load_bot_config()
+    if any(bot.get("type") == "fuwamoko" for bot in bots):
+        from fuwamoko_empathy_bot import check_template_integrity
+        check_template_integrity()
+    log_memory("起動直後")
+    get_model(MODEL_NAME)
+    log_memory("モデル読み込み後")
+    run_forever(bots, once="--once" in sys.argv)
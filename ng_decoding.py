@@ -0,0 +1,102 @@
+# 🔽 🚫 NGワード制約付きデコード
+# 生成後にNGワードで弾くのではなく、生成中にNGワードを完成させるトークンを選べなくする
+# ・1トークンの中にNGワードが丸ごと入っているトークン → 常に禁止（bad_words_ids相当）
+# ・複数トークンにまたがるNGワード → 直前の出力の末尾がNGワードの前半と一致したら、残りを始めるトークンを禁止
+# 比較はバイト単位（日本語の1文字が複数トークンに分かれる場合も拾える）、英字は大文字小文字を区別しない
+import re
+import logging
+
+import torch
+from transformers import LogitsProcessor
+
+def _bytes_to_unicode():
+    # GPT-2系バイトレベルBPEのバイト→文字対応表
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return dict(zip(bs, (chr(c) for c in cs)))
+
+BYTE_DECODER = {char: byte for byte, char in _bytes_to_unicode().items()}
+BYTE_TOKEN_PATTERN = re.compile(r"^<0x([0-9A-Fa-f]{2})>$")
+
+def token_to_bytes(token):
+    # バイトレベルBPE（Ġ等）とSentencePiece（▁, <0xE3>）の両方に対応
+    if token is None:
+        return b""
+    match = BYTE_TOKEN_PATTERN.match(token)
+    if match:
+        return bytes([int(match.group(1), 16)])
+    if all(char in BYTE_DECODER for char in token):
+        return bytes(BYTE_DECODER[char] for char in token)
+    return token.replace("▁", " ").encode("utf-8")
+
+class NGVocabulary:
+    # トークナイザとNGワードから1回だけ作る禁止表
+    def __init__(self, tokenizer, words):
+        self.words = sorted({word.lower().encode("utf-8") for word in words if word})
+        special_ids = set(tokenizer.all_special_ids)
+        vocab_size = len(tokenizer)
+        self.token_bytes = [
+            b"" if token_id in special_ids else token_to_bytes(token).lower()
+            for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(vocab_size))))
+        ]
+
+        # NGワードを丸ごと含むトークン
+        pattern = re.compile(b"|".join(re.escape(word) for word in self.words)) if self.words else None
+        self.static_ids = [i for i, data in enumerate(self.token_bytes) if pattern and data and pattern.search(data)]
+
+        # NGワードの後半（残り） → その直前に来るべき前半
+        prefixes_by_rest = {}
+        for word in self.words:
+            for i in range(1, len(word)):
+                prefixes_by_rest.setdefault(word[i:], []).append(word[:i])
+        max_rest = max((len(rest) for rest in prefixes_by_rest), default=0)
+
+        # 前半（出力の末尾） → 禁止するトークン（残りで始まるトークン）
+        banned = {}
+        for token_id, data in enumerate(self.token_bytes):
+            for length in range(1, min(len(data), max_rest) + 1):
+                for prefix in prefixes_by_rest.get(data[:length], ()):
+                    banned.setdefault(prefix, set()).add(token_id)
+        self.prefix_bans = {prefix: torch.tensor(sorted(ids), dtype=torch.long) for prefix, ids in banned.items()}
+        self.max_prefix = max((len(prefix) for prefix in self.prefix_bans), default=0)
+        self.static_tensor = torch.tensor(self.static_ids, dtype=torch.long)
+        logging.info(f"🟢 NG語彙: {len(self.words)}語, 常時禁止 {len(self.static_ids)}トークン, 連結チェック {len(self.prefix_bans)}パターン")
+
+    def tail_bytes(self, token_ids):
+        # 末尾max_prefixバイトぶんの出力（特殊トークンは0バイト）
+        tail = b""
+        for token_id in reversed(token_ids):
+            if len(tail) >= self.max_prefix:
+                break
+            if token_id < len(self.token_bytes):
+                tail = self.token_bytes[token_id] + tail
+        return tail[-self.max_prefix:] if self.max_prefix else b""
+
+    def banned_after(self, token_ids):
+        tail = self.tail_bytes(token_ids)
+        for length in range(1, len(tail) + 1):
+            ids = self.prefix_bans.get(tail[-length:])
+            if ids is not None:
+                yield ids
+
+class NGWordsLogitsProcessor(LogitsProcessor):
+    # prompt_length以降（生成部分）だけを見て判定する
+    def __init__(self, vocabulary, prompt_length=0):
+        self.vocabulary = vocabulary
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores):
+        vocabulary = self.vocabulary
+        if len(vocabulary.static_ids):
+            scores[:, vocabulary.static_tensor.to(scores.device)] = -float("inf")
+        if vocabulary.max_prefix:
+            for row, ids in enumerate(input_ids[:, self.prompt_length:].tolist()):
+                for banned in vocabulary.banned_after(ids):
+                    scores[row, banned.to(scores.device)] = -float("inf")
+        return scores
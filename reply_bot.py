@@ -2,6 +2,7 @@
 #🌐 基本ライブラリ・API
 # ------------------------------
 import os
+import sys
 import json
 import subprocess
 import traceback
@@ -11,8 +12,6 @@ import re
 import requests
 import psutil
 from datetime import datetime, timezone, timedelta
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from transformers import AutoModelForCausalLM, GPTNeoXTokenizerFast
 import torch
 from atproto import Client, models
 from atproto_client.models.com.atproto.repo.strong_ref import Main as StrongRef
@@ -20,28 +19,31 @@ from atproto_client.models.app.bsky.feed.post import ReplyRef
 from dotenv import load_dotenv
 import urllib.parse
 from transformers import BitsAndBytesConfig
+from transformers import LogitsProcessorList
+from ng_decoding import NGWordsLogitsProcessor
+from model_registry import DEFAULT_MODEL_NAME, get_model, get_ng_vocabulary, loaded_models
+from reply_retrieval import get_reply_index, pool_entries
+from reply_cache import get_reply_cache
+from jetstream import run_stream, event_uri, event_record, mentions_did
+from lease_store import get_work_claimer
+from batch_poster import BatchPoster, new_tid, reply_record, reply_ref_from_dict, reply_ref_to_dict
+from work_queue import get_work_queue
+from deadline_scheduler import DeadlineScheduler, PRIORITY_MENTION, PRIORITY_TIMELINE
 
 # ------------------------------
 # 🔐 環境変数
 # ------------------------------
+# アカウント情報はuse_persona()で設定する（単体起動時は環境変数から、multi_bot_runnerからはキャラ設定ごと）
 load_dotenv()
-HANDLE = os.getenv("HANDLE") or exit("❌ HANDLEが設定されていません")
-APP_PASSWORD = os.getenv("APP_PASSWORD") or exit("❌ APP_PASSWORDが設定されていません")
-GIST_TOKEN_REPLY = os.getenv("GIST_TOKEN_REPLY") or exit("❌ GIST_TOKEN_REPLYが設定されていません")
-GIST_ID = os.getenv("GIST_ID") or exit("❌ GIST_IDが設定されていません")
-
-print(f"✅ 環境変数読み込み完了: HANDLE={HANDLE[:8]}..., GIST_ID={GIST_ID[:8]}...")
-print(f"🧪 GIST_TOKEN_REPLY: {repr(GIST_TOKEN_REPLY)[:8]}...")
-print(f"🔑 トークンの長さ: {len(GIST_TOKEN_REPLY)}")
+HANDLE = None
+APP_PASSWORD = None
+GIST_TOKEN_REPLY = None
+GIST_ID = None
 
 # --- 固定値 ---
 REPLIED_GIST_FILENAME = "replied.json"
-GIST_API_URL = f"https://api.github.com/gists/{GIST_ID}"
-HEADERS = {
-    "Authorization": f"token {GIST_TOKEN_REPLY}",
-    "Accept": "application/vnd.github+json",
-    "Content-Type": "application/json"
-}
+GIST_API_URL = None
+HEADERS = {}
 LOCK_FILE = "bot.lock"
 
 # ------------------------------
@@ -168,13 +170,16 @@ HF_API_URL = "https://api-inference.huggingface.co/"
 # ------------------------------
 # 📬 Blueskyログイン
 # ------------------------------
-try:
-    client = Client()
-    client.login(HANDLE, APP_PASSWORD)
-    print("✅ Blueskyログイン成功！")
-except Exception as e:
-    print(f"❌ Blueskyログインに失敗しました: {e}")
-    exit(1)
+client = None
+clients = {}  # ハンドルごとのログイン済みクライアント（同じプロセスで何度もログインしない）
+
+def login(handle, app_password):
+    if handle not in clients:
+        new_client = Client()
+        new_client.login(handle, app_password)
+        clients[handle] = new_client
+        print(f"✅ Blueskyログイン成功！ @{handle}")
+    return clients[handle]
 
 # ------------------------------
 # ★ カスタマイズポイント1: キーワード返信（REPLY_TABLE）
@@ -198,6 +203,13 @@ REPLY_TABLE = {
 SAFE_WORDS = ["すりすり", "なでなで", "もふもふ", "うとうと", "きゅん", "おさんぽ"]
 DANGER_ZONE = ["ちゅぱ", "ペロペロ", "ぐちゅ", "ぬぷ", "ビクビク", "スケベ", "えっち"]
 # ヒント: SAFE_WORDSはOKな表現、DANGER_ZONEはNGワード。キャラの雰囲気に合わせて！
+BUSINESS_NG_WORDS = [
+    "ご利用", "誠に", "お詫び", "貴重なご意見", "申し上げます", "ございます", "お客様", "発表", "パートナーシップ",
+    "ポケモン", "アソビズム", "企業", "世界中", "映画", "興行", "収入", "ドル", "億", "国", "イギリス", "フランス",
+    "スペイン", "イタリア", "ドイツ", "ロシア", "中国", "インド", "Governor", "Cross", "営業", "臨時", "オペラ",
+    "初演", "作曲家", "ヴェネツィア", "コルテス", "政府", "協定", "軍事", "情報", "外交", "外相", "自動更新"
+]
+# ヒント: BUSINESS_NG_WORDSは返信に出てほしくない堅い話題。生成中にも出せないようにする
 
 # ------------------------------
 # ★ カスタマイズポイント3: キャラ設定
@@ -206,6 +218,48 @@ BOT_NAME = "桃花"  # キャラ名（例: "クマちゃん", "ツンデレ姫"
 FIRST_PERSON = "桃花"  # 一人称（例: "私", "君", "あたし", "ボク"）
 # ヒント: BOT_NAMEは返信や正規表現で使用。FIRST_PERSONはプロンプトで固定。
 
+# ------------------------------
+# 🎭 キャラ設定の切り替え
+# ------------------------------
+DEFAULT_PERSONA = {"bot_name": BOT_NAME, "first_person": FIRST_PERSON, "reply_table": REPLY_TABLE}
+
+def load_persona_from_env(prefix=""):
+    # 例: prefix="MOMOKA_" → MOMOKA_HANDLE, MOMOKA_APP_PASSWORD, MOMOKA_GIST_TOKEN_REPLY, MOMOKA_GIST_ID
+    return {
+        "handle": os.getenv(f"{prefix}HANDLE"),
+        "app_password": os.getenv(f"{prefix}APP_PASSWORD"),
+        "gist_token": os.getenv(f"{prefix}GIST_TOKEN_REPLY"),
+        "gist_id": os.getenv(f"{prefix}GIST_ID"),
+    }
+
+def use_persona(persona):
+    # multi_bot_runnerは1体ずつ順番に動かすので、モジュール変数を差し替えるだけで切り替えられる
+    global HANDLE, APP_PASSWORD, GIST_TOKEN_REPLY, GIST_ID, GIST_API_URL, HEADERS
+    global BOT_NAME, FIRST_PERSON, REPLY_TABLE, client
+    for key, label in [("handle", "HANDLE"), ("app_password", "APP_PASSWORD"),
+                       ("gist_token", "GIST_TOKEN_REPLY"), ("gist_id", "GIST_ID")]:
+        if not persona.get(key):
+            raise ValueError(f"❌ {label}が設定されていません")
+    HANDLE = persona["handle"]
+    APP_PASSWORD = persona["app_password"]
+    GIST_TOKEN_REPLY = persona["gist_token"]
+    GIST_ID = persona["gist_id"]
+    GIST_API_URL = f"https://api.github.com/gists/{GIST_ID}"
+    HEADERS = {
+        "Authorization": f"token {GIST_TOKEN_REPLY}",
+        "Accept": "application/vnd.github+json",
+        "Content-Type": "application/json"
+    }
+    BOT_NAME = persona.get("bot_name", DEFAULT_PERSONA["bot_name"])
+    FIRST_PERSON = persona.get("first_person", DEFAULT_PERSONA["first_person"])
+    REPLY_TABLE = persona.get("reply_table", DEFAULT_PERSONA["reply_table"])
+    retrieval_indexes.clear()
+    print(f"✅ 環境変数読み込み完了: HANDLE={HANDLE[:8]}..., GIST_ID={GIST_ID[:8]}..., キャラ={BOT_NAME}")
+    print(f"🧪 GIST_TOKEN_REPLY: {repr(GIST_TOKEN_REPLY)[:8]}...")
+    print(f"🔑 トークンの長さ: {len(GIST_TOKEN_REPLY)}")
+    client = login(HANDLE, APP_PASSWORD)
+    return client
+
 # ------------------------------
 # 🧹 テキスト処理
 # ------------------------------
@@ -218,6 +272,15 @@ def clean_output(text):
     text = re.sub(r'[。、！？]{2,}', lambda m: m.group(0)[0], text)
     return text.strip()
 
+BUSINESS_NG_PATTERN = re.compile("(" + "|".join(BUSINESS_NG_WORDS) + r"|\d+(時|分))", re.IGNORECASE)
+
+# 生成の統計（NG制約デコードの効果確認用）
+generation_stats = {"replies": 0, "attempts": 0, "rejected": 0, "retrieved": 0}
+
+def count_rejection(reason, reply):
+    generation_stats["rejected"] += 1
+    print(f"⚠️ {reason}: {reply}")
+
 def is_output_safe(text):
     return not any(word in text.lower() for word in DANGER_ZONE)
 
@@ -231,7 +294,7 @@ def clean_sentence_ending(reply):
 
     # 一人称チェック
     if FIRST_PERSON != "俺" and "俺" in reply:
-        print(f"⚠️ 意図しない一人称『俺』検知: {reply}")
+        count_rejection("意図しない一人称『俺』検知", reply)
         return random.choice([
             f"……今の、ちょっとキャラじゃなかったかも。忘れて。",
             f"あら、つい変な口調になっちゃったみたい。見なかったことにして？",
@@ -239,8 +302,8 @@ def clean_sentence_ending(reply):
         ])
 
     # NGワードチェック
-    if re.search(r"(ご利用|誠に|お詫び|貴重なご意見|申し上げます|ございます|お客様|発表|パートナーシップ|ポケモン|アソビズム|企業|世界中|映画|興行|収入|ドル|億|国|イギリス|フランス|スペイン|イタリア|ドイツ|ロシア|中国|インド|Governor|Cross|営業|臨時|オペラ|初演|作曲家|ヴェネツィア|コルテス|政府|協定|軍事|情報|外交|外相|自動更新|\d+(時|分))", reply, re.IGNORECASE):
-        print(f"⚠️ NGワード検知: {reply}")
+    if BUSINESS_NG_PATTERN.search(reply):
+        count_rejection("NGワード検知", reply)
         return random.choice([
             f"ふぅ……なんだかおカタいこと言っちゃったわね。反省中。",
             f"いまの話、ちょっと真面目すぎた？えっと……そういう気分だったのよ。",
@@ -249,7 +312,7 @@ def clean_sentence_ending(reply):
 
     # 危険ワードチェック
     if not is_output_safe(reply):
-        print(f"⚠️ 危険ワード検知: {reply}")
+        count_rejection("危険ワード検知", reply)
         return random.choice([
             f"ちょっと今の、桃花じゃない誰かが言ったってことで……お願い。",
             f"……なに言ってるの桃花！忘れて忘れて！！",
@@ -258,6 +321,7 @@ def clean_sentence_ending(reply):
 
     # 意味不明な返信 or 長さ不足の防止
     if not re.search(r"[ぁ-んァ-ン一-龥ー]", reply) or len(reply) < 8:
+        count_rejection("意味不明または短すぎ", reply)
         return random.choice([
             f"……えっと、何を言いたかったんだっけ？桃花、寝ぼけてたかも。",
             f"う〜ん、うまく言葉にできなかったみたい。やり直し！",
@@ -274,27 +338,77 @@ def clean_sentence_ending(reply):
 # ------------------------------
 # 🤖 モデル初期化
 # ------------------------------
-model = None
-tokenizer = None
+# モデルはmodel_registryで共有（同じプロセスの他のBot・キャラと同じインスタンス）
+# 生成中にNGワードを出させない（NG_DECODING=0で従来どおり生成後チェックのみ）
+NG_DECODING = os.getenv("NG_DECODING", "1") == "1"
 
 def initialize_model_and_tokenizer(model_name="cyberagent/open-calm-small"):
-    global model, tokenizer
-    if model is None or tokenizer is None:
-        print(f"📤 {datetime.now(timezone.utc).isoformat()} ｜ トークナイザ読み込み中…")
-        tokenizer = GPTNeoXTokenizerFast.from_pretrained(model_name, use_fast=True)
-        print(f"📤 {datetime.now(timezone.utc).isoformat()} ｜ トークナイザ読み込み完了")
-        print(f"📤 {datetime.now(timezone.utc).isoformat()} ｜ モデル読み込み中…")
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype=torch.float32,  # float32にも変更可能
-            device_map="auto"  # ← 明示的に！
-        ).eval()
-        print(f"📤 {datetime.now(timezone.utc).isoformat()} ｜ モデル読み込み完了")
-    return model, tokenizer
+    if model_name not in loaded_models():
+        print(f"📤 {datetime.now(timezone.utc).isoformat()} ｜ モデル・トークナイザ読み込み中…")
+        model, tokenizer = get_model(model_name)
+        print(f"📤 {datetime.now(timezone.utc).isoformat()} ｜ モデル・トークナイザ読み込み完了")
+        return model, tokenizer
+    return get_model(model_name)
+
+def get_reply_ng_vocabulary(model_name):
+    # キャラ（一人称）ごとにNGワードが変わる → 組み合わせごとにレジストリでキャッシュ
+    ng_words = DANGER_ZONE + BUSINESS_NG_WORDS + (["俺"] if FIRST_PERSON != "俺" else [])
+    return get_ng_vocabulary(model_name, ng_words)
     
 # ------------------------------
 # ★ カスタマイズポイント4: 返信生成（generate_reply_via_local_model）
 # ------------------------------
+# フォールバック返信
+FALLBACK_CUTE_LINES = [
+    "……ふん、べ、別にあなたのこと考えてたわけじゃ……ないけど……。",
+    "ちょっと……構ってほしいだけよ。べ、別にヒマだったわけじゃないの！",
+    "……あの、少しだけ……そばにいてくれると嬉しい、かも。"
+]
+# 特定パターン返信
+LOVE_REPLIES = [
+    "そ、そんなこと急に言わないでよ……心臓が変になっちゃうじゃない……。",
+    "……も、もう……そういうの、もっとこっそり言いなさいよ……バカ……。",
+    "……あの、ちょっとだけなら……ぎゅってしてもいいわよ。"
+]
+HEALING_REPLIES = [
+    "……無理しなくていいのよ。休む時は、ちゃんと休むこと。",
+    "……つらいなら、少しだけ桃花に甘えてみてもいいわよ。",
+    "……大丈夫。あなたが元気になるまで、そばにいるから。"
+]
+# 定型文で十分な投稿は生成せずに返す（REPLY_RETRIEVAL=0で常に生成）
+REPLY_RETRIEVAL = os.getenv("REPLY_RETRIEVAL", "1") == "1"
+
+def retrieval_entries():
+    # REPLY_TABLEはキーワードと照合する（キャラ設定ごとに別インデックスになる）
+    entries = [(keyword, reply.replace("{BOT_NAME}", BOT_NAME), "table") for keyword, reply in REPLY_TABLE.items()]
+    entries += pool_entries("love", LOVE_REPLIES)
+    entries += pool_entries("healing", HEALING_REPLIES)
+    entries += pool_entries("fallback", FALLBACK_CUTE_LINES)
+    return entries
+
+# キャラ名 → 今のキャラの返信インデックス（キャラを切り替えたら作り直す → use_persona）
+retrieval_indexes = {}
+
+def retrieval_index():
+    if BOT_NAME not in retrieval_indexes:
+        retrieval_indexes[BOT_NAME] = get_reply_index(f"reply_{BOT_NAME}", retrieval_entries())
+    return retrieval_indexes[BOT_NAME]
+
+def retrieve_reply(user_input):
+    if not REPLY_RETRIEVAL:
+        return None
+    try:
+        match = retrieval_index().best_match(user_input)
+    except Exception as e:
+        print(f"⚠️ 定型文検索エラー: {e}")
+        return None
+    if match is None:
+        return None
+    reply, score, group = match
+    print(f"🔎 定型文で返信（{group}, 類似度 {score:.2f}）: {reply}")
+    generation_stats["retrieved"] += 1
+    return reply
+
 def generate_reply_via_local_model(user_input):
     model_name = "cyberagent/open-calm-small"
     # 失敗時のメッセージ
@@ -303,34 +417,33 @@ def generate_reply_via_local_model(user_input):
         "あら、うまく言葉が出てこなかったわ。後でもう一度話しましょう？",
         "うぅ、桃花、うっかりしちゃったかも……ごめんなさいね。"
     ]
-    # フォールバック返信
-    fallback_cute_lines = [
-        "……ふん、べ、別にあなたのこと考えてたわけじゃ……ないけど……。",
-        "ちょっと……構ってほしいだけよ。べ、別にヒマだったわけじゃないの！",
-        "……あの、少しだけ……そばにいてくれると嬉しい、かも。"
-    ]
+    fallback_cute_lines = FALLBACK_CUTE_LINES
     # 特定パターン返信
     if re.search(r"(大好き|ぎゅー|ちゅー|愛してる|キス|添い寝)", user_input, re.IGNORECASE):
         print(f"⚠️ ラブラブ入力検知: {user_input}")
-        return random.choice([
-            "そ、そんなこと急に言わないでよ……心臓が変になっちゃうじゃない……。",
-            "……も、もう……そういうの、もっとこっそり言いなさいよ……バカ……。",
-            "……あの、ちょっとだけなら……ぎゅってしてもいいわよ。"
-        ])
+        return random.choice(LOVE_REPLIES)
 
     if re.search(r"(疲れた|しんどい|つらい|泣きたい|ごめん|寝れない)", user_input, re.IGNORECASE):
         print(f"⚠️ 癒し系入力検知: {user_input}")
-        return random.choice([
-            "……無理しなくていいのよ。休む時は、ちゃんと休むこと。",
-            "……つらいなら、少しだけ桃花に甘えてみてもいいわよ。",
-            "……大丈夫。あなたが元気になるまで、そばにいるから。"
-        ])
+        return random.choice(HEALING_REPLIES)
+
+    # 定型文に十分近ければモデルを呼ばない
+    retrieved = retrieve_reply(user_input)
+    if retrieved:
+        return retrieved
 
     if re.search(r"(映画|興行|収入|ドル|億|国|イギリス|フランス|スペイン|イタリア|ドイツ|ロシア|中国|インド|Governor|Cross|ポケモン|企業|発表|営業|臨時|オペラ|初演|作曲家|ヴェネツィア|コルテス|政府|協定|軍事|情報|外交|外相|自動更新)", user_input, re.IGNORECASE) or re.search(r"\d+(時|分)", user_input):
         print(f"⚠️ 入力にビジネス・学術系ワード検知: {user_input}")
         user_input = "みりんてゃ、君と甘々トークしたいなのっ♡"
         print(f"🔄 入力置き換え: {user_input}")
 
+    # 同じような入力には、前に生成して検査を通った返信を順番に使い回す
+    reply_cache = get_reply_cache()
+    cached = reply_cache.get(user_input, BOT_NAME)
+    if cached:
+        print(f"🗃️ キャッシュから返信: {cached}")
+        return cached
+
     try:
         print(f"📊 メモリ使用量（開始時）: {psutil.virtual_memory().percent}%")
         if torch.cuda.is_available():
@@ -350,29 +463,34 @@ def generate_reply_via_local_model(user_input):
         ])
         prompt = (
             f"{intro_lines}\n"
-            "あなたは「桃花」、元気で賢くてちょっとツンデレな女の子。品のあるお嬢様っぽさがあるけど、パパやママには甘えん坊になることも。\n"
+            f"あなたは「{BOT_NAME}」、元気で賢くてちょっとツンデレな女の子。品のあるお嬢様っぽさがあるけど、パパやママには甘えん坊になることも。\n"
             "性格：ENTJで基本は冷静だけど、時々感情が溢れて照れたり素直になれない。ちょっとだけワガママで可愛い一面も。\n"
             "口調：『〜よ』『〜わ』『……ふん』『……まったくもう』のような上品さとツンを感じる言葉を使いながら、たまに「甘えるとき」は素直になる。\n"
             "禁止：政治や経済、現実的なビジネス話題、学術用語は禁止。過激・下品な擬音語もダメ。\n"
             "役割：ユーザーとの日常的でちょっとドキドキするおしゃべりを楽しむこと。優しく、でも自分らしく反応する。\n"
             "注意：以下のワードは絶対禁止→「政府」「協定」「軍事」「情報」「契約」「ビクビク」「ちゅぱ」「ぬぷ」などの不適切な表現\n"
-            "例1: ユーザー: 桃花、なにしてたの？\n"
-            "桃花: ……別に、あなたのこと考えてたわけじゃ……ないわよ？……ほんの少しだけ、よ。\n"
-            "例2: ユーザー: 桃花、好きだよ！\n"
-            "桃花: ……なっ！？あ、あなたって……ほんと、調子狂うわね……でも……ありがと。\n\n"
+            f"例1: ユーザー: {BOT_NAME}、なにしてたの？\n"
+            f"{BOT_NAME}: ……別に、あなたのこと考えてたわけじゃ……ないわよ？……ほんの少しだけ、よ。\n"
+            f"例2: ユーザー: {BOT_NAME}、好きだよ！\n"
+            f"{BOT_NAME}: ……なっ！？あ、あなたって……ほんと、調子狂うわね……でも……ありがと。\n\n"
             f"ユーザー: {user_input}\n"
-            f"桃花: "
+            f"{BOT_NAME}: "
         )
 
         print("📎 使用プロンプト:", repr(prompt))
         print(f"📤 {datetime.now().isoformat()} ｜ トークン化開始…")
-        input_ids = tokenizer.encode(prompt, return_tensors="pt").to("cuda" if torch.cuda.is_available() else "cpu")
+        input_ids = tokenizer.encode(prompt, return_tensors="pt").to(model.device)
         print(f"📏 入力トークン数: {input_ids.shape[1]}")
         print(f"📝 デコードされた入力: {tokenizer.decode(input_ids[0], skip_special_tokens=True)}")
         print(f"📤 {datetime.now().isoformat()} ｜ トークン化完了")
 
+        logits_processor = LogitsProcessorList(
+            [NGWordsLogitsProcessor(get_reply_ng_vocabulary(model_name), input_ids.shape[1])] if NG_DECODING else []
+        )
+
         for attempt in range(3):
             print(f"📤 {datetime.now().isoformat()} ｜ テキスト生成中…（試行 {attempt + 1}）")
+            generation_stats["attempts"] += 1
             print(f"📊 メモリ使用量（生成前）: {psutil.virtual_memory().percent}%")
             try:
                 with torch.no_grad():
@@ -383,12 +501,14 @@ def generate_reply_via_local_model(user_input):
                         top_p=0.9,
                         do_sample=True,
                         pad_token_id=tokenizer.eos_token_id,
-                        no_repeat_ngram_size=2
+                        no_repeat_ngram_size=2,
+                        logits_processor=logits_processor
                     )
 
                 new_tokens = output_ids[0][input_ids.shape[1]:]
                 raw_reply = tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
                 print(f"📝 生の生成テキスト: {repr(raw_reply)}")
+                rejected_before = generation_stats["rejected"]
                 reply_text = clean_sentence_ending(raw_reply)
 
                 if any(re.search(rf"\b{re.escape(msg)}\b", reply_text) for msg in failure_messages + fallback_cute_lines):
@@ -396,6 +516,9 @@ def generate_reply_via_local_model(user_input):
                     continue
 
                 print("📝 最終抽出されたreply:", repr(reply_text))
+                generation_stats["replies"] += 1
+                if generation_stats["rejected"] == rejected_before:
+                    reply_cache.put(user_input, reply_text, BOT_NAME)
                 return reply_text
 
             except Exception as gen_error:
@@ -412,8 +535,7 @@ def generate_reply_via_local_model(user_input):
         return random.choice(failure_messages)
 
 def fetch_bluesky_posts():
-    client = Client()
-    client.login(HANDLE, APP_PASSWORD)
+    client = login(HANDLE, APP_PASSWORD)
     posts = client.get_timeline(limit=50).feed
     unreplied = []
     for post in posts:
@@ -426,8 +548,7 @@ def fetch_bluesky_posts():
 
 def post_replies_to_bluesky():
     unreplied = fetch_bluesky_posts()
-    client = Client()
-    client.login(HANDLE, APP_PASSWORD)
+    client = login(HANDLE, APP_PASSWORD)
     for post in unreplied:
         try:
             reply = generate_reply_via_local_model(post["text"])
@@ -451,8 +572,7 @@ def handle_post(record, notification):
 
     return None, normalize_uri(post_uri)
 
-def run_reply_bot():
-    self_did = client.me.did
+def prepare_replied():
     replied = load_gist_data()  # load_replied()をやめてGist APIに統一
     print(f"📘 replied の型: {type(replied)} / 件数: {len(replied)}")
 
@@ -468,29 +588,86 @@ def run_reply_bot():
         print(f"💾 ゴミデータ削除後にrepliedを保存します")
         if not save_replied(replied):
             print("❌ ゴミデータ削除後の保存に失敗しました")
-            return
+            return None
 
     # --- ⛑️ 空じゃなければ初期保存 ---
     if replied:
         print("💾 初期状態のrepliedを保存します")
         if not save_replied(replied):
             print("❌ 初期保存に失敗しました")
-            return
+            return None
     else:
         print("⚠️ replied が空なので初期保存はスキップ")
+    return replied
+
+MAX_REPLIES = 5
+
+def notification_priority(notification):
+    # 直接のメンション → スレッドへのリプの順
+    text = getattr(getattr(notification, "record", None), "text", None) or ""
+    return PRIORITY_MENTION if f"@{HANDLE}" in text else PRIORITY_TIMELINE
+
+def reply_to_notifications(notifications, replied, self_did, max_replies=MAX_REPLIES, scheduler=None):
+    # 通知（またはストリームで受け取ってgetPostsした投稿）に順番に返信する
+    # 複数ランナーのとき（LEASE_STORE設定時）は著者DIDで担当を分け、URIのリースを取れた分だけ返信する
+    # 返信はBatchPosterでためてapplyWritesでまとめて投稿し、repliedの保存も書き込み1回につき1回
+    # schedulerがあれば、ジョブの残り時間で生成が終わらない通知は始めずに次回へ回す（repliedに入らないので次回拾われる）
+    # 途中経過は作業キューに残す: 取得 → 生成（返信文とrkey）→ 投稿 → repliedに保存。止まったら次回その続きから
+    claimer = get_work_claimer()
+    queue = get_work_queue()
+    queue_name = f"reply:{HANDLE}"
+    reply_count = 0
+    queued = set()
 
-    try:
-        notifications = client.app.bsky.notification.list_notifications(params={"limit": 25}).notifications
-        print(f"🔔 通知総数: {len(notifications)} 件")
-    except Exception as e:
-        print(f"❌ 通知の取得に失敗しました: {e}")
-        return
+    def on_result(key, reply_uri, context, error):
+        if error is not None:
+            print(f"⚠️ 投稿失敗: {error} → {key}")
+            claimer.release(key)
+            return
+        claimer.done(key)
+        queue.advance(queue_name, key, "posted", reply_uri=reply_uri)
+        normalized_uri = normalize_uri(key)
+        if normalized_uri:
+            replied.add(normalized_uri)
+            print(f"✅ @{context['author_handle']} に返信完了！ → {normalized_uri}（{reply_uri}）")
+        else:
+            print(f"⚠️ 正規化されたURIが無効 → {key}")
 
-    MAX_REPLIES = 5
-    REPLY_INTERVAL = 5
-    reply_count = 0
+    def on_flush(results):
+        if not any(error is None for _, _, _, error in results):
+            return
+        if save_replied(replied):
+            print(f"💾 URI保存成功 → 合計: {len(replied)} 件")
+            print(f"📁 最新URI一覧（正規化済み）: {list(replied)[-5:]}")
+            for key, _, _, error in results:
+                if error is None:
+                    queue.advance(queue_name, key, "persisted")
+        else:
+            print(f"❌ URI保存失敗 → {[key for key, _, _, _ in results]}")
+
+    poster = BatchPoster(client, on_result, on_flush)
+
+    # 前回の続き: 投稿済みでrepliedに保存できていない分を保存し、生成済みで未投稿の分を同じrkeyで投稿する
+    posted = queue.items(queue_name, "posted")
+    for key, _ in posted:
+        replied.add(key)
+        queue.stats["resumed"] += 1
+    if posted and save_replied(replied):
+        for key, _ in posted:
+            queue.advance(queue_name, key, "persisted")
+    for key, payload in queue.items(queue_name, "generated"):
+        if key in replied:
+            queue.advance(queue_name, key, "persisted")
+            continue
+        if not claimer.claim(key):
+            continue
+        print(f"📒 前回の続きから返信: @{payload['author_handle']}: {payload['text']}")
+        poster.add(key, reply_record(payload["text"], reply_ref_from_dict(payload["reply"])),
+                   {"author_handle": payload["author_handle"]}, rkey=payload["reply_rkey"])
+        queued.add(key)
+        queue.stats["resumed"] += 1
 
-    for notification in notifications:
+    for index, notification in enumerate(notifications):
         notification_uri = normalize_uri(getattr(notification, "uri", None) or getattr(notification, "reasonSubject", None))
         if not notification_uri:
             record = getattr(notification, "record", None)
@@ -505,8 +682,8 @@ def run_reply_bot():
         print(f"📌 チェック中 notification_uri（正規化済み）: {notification_uri}")
         print(f"📂 保存済み replied（全件）: {list(replied)}")
 
-        if reply_count >= MAX_REPLIES:
-            print(f"⏹️ 最大返信数（{MAX_REPLIES}）に達したので終了します")
+        if reply_count >= max_replies:
+            print(f"⏹️ 最大返信数（{max_replies}）に達したので終了します")
             break
 
         record = getattr(notification, "record", None)
@@ -534,7 +711,7 @@ def run_reply_bot():
             print("🛑 自分自身の投稿、スキップ")
             continue
 
-        if notification_uri in replied:
+        if notification_uri in replied or notification_uri in queued:
             print(f"⏭️ すでに replied 済み → {notification_uri}")
             continue
 
@@ -542,50 +719,129 @@ def run_reply_bot():
             print(f"⚠️ テキストが空 → @{author_handle}")
             continue
 
+        if not claimer.owns(author_did) or not claimer.claim(notification_uri):
+            print(f"⏭️ 他のランナーの担当・返信中 → {notification_uri}")
+            continue
+
+        queue.advance(queue_name, notification_uri, "fetched", text=text, author_handle=author_handle)
+        model_loaded = DEFAULT_MODEL_NAME in loaded_models()
+        if scheduler is not None:
+            extra = 0.0 if model_loaded else scheduler.estimate("model_load")
+            if not scheduler.fits("mention_reply", extra=extra):
+                claimer.release(notification_uri)
+                scheduler.defer(notifications[index:], f"返信生成の見積もり {scheduler.estimate('mention_reply') + extra:.0f}秒")
+                break
+
         reply_ref, post_uri = handle_post(record, notification)
         print("🔗 reply_ref:", reply_ref)
         print("🧾 post_uri（正規化済み）:", post_uri)
 
+        started = time.time()
         reply_text = generate_reply_via_local_model(text)
+        if scheduler is not None:
+            # 初回の生成でモデルを読み込んだら、その分はモデル読み込みの実測にする
+            loaded_now = not model_loaded and DEFAULT_MODEL_NAME in loaded_models()
+            scheduler.record("model_load" if loaded_now else "mention_reply", time.time() - started)
         print("🤖 生成された返信:", reply_text)
 
         if not reply_text:
             print("⚠️ 返信テキストが生成されていません")
+            claimer.release(notification_uri)
             continue
 
         try:
-            post_data = {
-                "text": reply_text,
-                "createdAt": datetime.now(timezone.utc).isoformat(),
-            }
-            if reply_ref:
-                post_data["reply"] = reply_ref
-
-            client.app.bsky.feed.post.create(
-                record=post_data,
-                repo=client.me.did
-            )
-
-            normalized_uri = normalize_uri(notification_uri)
-            if normalized_uri:
-                replied.add(normalized_uri)
-                if not save_replied(replied):
-                    print(f"❌ URI保存失敗 → {normalized_uri}")
-                    continue
-
-                print(f"✅ @{author_handle} に返信完了！ → {normalized_uri}")
-                print(f"💾 URI保存成功 → 合計: {len(replied)} 件")
-                print(f"📁 最新URI一覧（正規化済み）: {list(replied)[-5:]}")
-            else:
-                print(f"⚠️ 正規化されたURIが無効 → {notification_uri}")
-
+            reply_rkey = new_tid()
+            queue.advance(queue_name, notification_uri, "generated", text=reply_text, reply_rkey=reply_rkey,
+                          reply=reply_ref_to_dict(reply_ref))
+            poster.add(notification_uri, reply_record(reply_text, reply_ref), {"author_handle": author_handle},
+                       rkey=reply_rkey)
+            queued.add(notification_uri)
             reply_count += 1
-            time.sleep(REPLY_INTERVAL)
-
         except Exception as e:
             print(f"⚠️ 投稿失敗: {e}")
             traceback.print_exc()
+            claimer.release(notification_uri)
+
+    poster.flush()
+    if poster.stats["posts"]:
+        print(poster.stats_message())
+    print(queue.stats_message(queue_name))
+    return reply_count
+
+def print_reply_stats():
+    reply_cache = get_reply_cache()
+    reply_cache.save()
+    print(reply_cache.stats_message())
+    if generation_stats["retrieved"]:
+        print(f"📊 定型文返信: {generation_stats['retrieved']}件（モデル生成なし）")
+    if generation_stats["replies"]:
+        print(f"📊 生成統計: 採用 {generation_stats['replies']}件, 試行 {generation_stats['attempts']}回"
+              f"（平均 {generation_stats['attempts'] / generation_stats['replies']:.2f}回）, 不採用 {generation_stats['rejected']}件,"
+              f" NG制約デコード: {'有効' if NG_DECODING else '無効'}")
+
+def run_reply_bot():
+    # 同じプロセスで何度も実行する（multi_bot_runner）ので、統計は実行ごとに数え直す
+    generation_stats.update(dict.fromkeys(generation_stats, 0))
+    self_did = client.me.did
+    replied = prepare_replied()
+    if replied is None:
+        return
+
+    try:
+        notifications = client.app.bsky.notification.list_notifications(params={"limit": 25}).notifications
+        print(f"🔔 通知総数: {len(notifications)} 件")
+    except Exception as e:
+        print(f"❌ 通知の取得に失敗しました: {e}")
+        return
+
+    scheduler = DeadlineScheduler()
+    notifications = sorted(notifications, key=notification_priority)
+    claimer = get_work_claimer()
+    claimer.join()
+    try:
+        reply_to_notifications(notifications, replied, self_did, scheduler=scheduler)
+    finally:
+        claimer.leave()
+        scheduler.save()
+    print(scheduler.summary())
+    print_reply_stats()
+
+# ------------------------------
+# 🌊 ストリーミング（--stream で通知のポーリングの代わりにJetstreamからメンション・リプを受け取る）
+# ------------------------------
+def run_reply_stream(**stream_options):
+    self_did = client.me.did
+    replied = prepare_replied()
+    if replied is None:
+        return
+
+    def is_mention(event):
+        return event["did"] != self_did and mentions_did(event_record(event), self_did)
+
+    def handle(events):
+        print(f"🌊 ストリーム: メンション・リプ {len(events)}件受信")
+        # 通知と同じ形（uri, cid, author, record）の投稿ビューにして同じ返信処理に通す
+        posts = client.get_posts(uris=[event_uri(event) for event in events]).posts
+        reply_to_notifications(posts, replied, self_did, max_replies=len(posts))
+
+    claimer = get_work_claimer()
+    claimer.join()
+    try:
+        run_stream(handle, is_mention, f"reply_stream_cursor_{HANDLE}.json", **stream_options)
+    finally:
+        claimer.leave()
+    print_reply_stats()
 
 if __name__ == "__main__":
     print("🤖 Reply Bot 起動中…")
-    run_reply_bot()
\ No newline at end of file
+    try:
+        use_persona(load_persona_from_env())
+    except ValueError as e:
+        exit(str(e))
+    except Exception as e:
+        print(f"❌ Blueskyログインに失敗しました: {e}")
+        exit(1)
+    if "--stream" in sys.argv:
+        run_reply_stream()
+    else:
+        run_reply_bot()
\ No newline at end of file
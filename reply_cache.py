@@ -0,0 +1,150 @@
+# 🔽 🗃️ 返信メモキャッシュ（LRU + TTL）
+# 同じような入力（「おはよう」「かわいい」、同じスタンプ文）には、前に生成して検査を通った返信を使い回す
+# キー = キャラ名 + 言語 + 正規化した入力。1キーにつき最大pool_size件の返信をためて、順番に返す（同じ文の連続を避ける）
+# プールが埋まるまではミス扱い → 呼び出し側で生成して追加する
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+REPLY_CACHE_FILE = os.environ.get("REPLY_CACHE_FILE", "reply_cache.json")
+REPLY_CACHE_SIZE = int(os.environ.get("REPLY_CACHE_SIZE", "512"))
+REPLY_CACHE_TTL = int(os.environ.get("REPLY_CACHE_TTL", str(7 * 24 * 3600)))
+REPLY_CACHE_POOL = int(os.environ.get("REPLY_CACHE_POOL", "3"))
+
+NON_WORD_PATTERN = re.compile(r"[\W_]+")
+REPEAT_PATTERN = re.compile(r"(.)\1{2,}")
+
+def normalize_input(text):
+    # 全角/半角・大文字小文字・記号・絵文字・空白の違いを無視し、「おはよーーーー」→「おはよーー」のように伸ばしを揃える
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = NON_WORD_PATTERN.sub("", text)
+    return REPEAT_PATTERN.sub(r"\1\1", text)
+
+class ReplyCache:
+    def __init__(self, path=REPLY_CACHE_FILE, max_entries=REPLY_CACHE_SIZE, ttl=REPLY_CACHE_TTL, pool_size=REPLY_CACHE_POOL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.pool_size = pool_size
+        self.entries = OrderedDict()  # キー → {"replies": [...], "next": 次に返す位置, "created_at": 作成時刻}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self._lock = threading.Lock()
+        self.load()
+
+    def key(self, text, persona="", lang="ja"):
+        normalized = normalize_input(text)
+        return f"{persona}|{lang}|{normalized}" if normalized else None
+
+    def _expired(self, entry, now):
+        return now - entry["created_at"] >= self.ttl
+
+    def get(self, text, persona="", lang="ja"):
+        key = self.key(text, persona, lang)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._expired(entry, time.time()):
+                del self.entries[key]
+                self.dirty = True
+                entry = None
+            if entry is None or len(entry["replies"]) < self.pool_size:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            reply = entry["replies"][entry["next"] % len(entry["replies"])]
+            entry["next"] = (entry["next"] + 1) % len(entry["replies"])
+            self.hits += 1
+            self.dirty = True
+            return reply
+
+    def put(self, text, reply, persona="", lang="ja"):
+        # 検査を通った返信だけ渡すこと
+        key = self.key(text, persona, lang)
+        if key is None or not reply:
+            return
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or self._expired(entry, time.time()):
+                entry = {"replies": [], "next": 0, "created_at": time.time()}
+                self.entries[key] = entry
+            if reply not in entry["replies"] and len(entry["replies"]) < self.pool_size:
+                entry["replies"].append(reply)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            now = time.time()
+            # ファイルには古い順に並んでいる → そのまま入れればLRUの順番も戻る
+            for key, entry in snapshot:
+                if not self._expired(entry, now):
+                    self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            logging.info(f"🟢 返信キャッシュ読み込み: {len(self.entries)}/{len(snapshot)}件（期限内）")
+        except Exception as e:
+            logging.error(f"❌ 返信キャッシュ読み込みエラー: {type(e).__name__}: {e}")
+            self.entries = OrderedDict()
+
+    def save(self):
+        if not self.dirty:
+            return
+        with self._lock:
+            snapshot = list(self.entries.items())
+            self.dirty = False
+        temp_file = self.path + ".tmp"
+        try:
+            with open(temp_file, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(temp_file, self.path)
+        except Exception as e:
+            logging.error(f"❌ 返信キャッシュ保存エラー: {type(e).__name__}: {e}")
+
+    def memory_bytes(self):
+        # キー・返信文・入れ物のおおよそのサイズ
+        with self._lock:
+            total = sys.getsizeof(self.entries)
+            for key, entry in self.entries.items():
+                total += sys.getsizeof(key) + sys.getsizeof(entry) + sys.getsizeof(entry["replies"])
+                total += sum(sys.getsizeof(reply) for reply in entry["replies"])
+            return total
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "memory_bytes": self.memory_bytes(),
+        }
+
+    def stats_message(self):
+        stats = self.stats()
+        return (f"📊 返信キャッシュ: ヒット {stats['hits']}/{stats['hits'] + stats['misses']}件（{stats['hit_ratio']:.0%}）, "
+                f"{stats['entries']}/{self.max_entries}キー, 約{stats['memory_bytes'] / 1024:.1f}KB")
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_reply_cache(path=REPLY_CACHE_FILE):
+    # 同じプロセスの両Botで同じファイルのキャッシュを共有する（キャラ名でキーは分かれる）
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = ReplyCache(path)
+        return _caches[path]
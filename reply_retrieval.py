@@ -0,0 +1,141 @@
+# 🔽 🔎 検索型返信（定型文の文字n-gramインデックス）
+# 定型文（テンプレ・REPLY_TABLE・フォールバック）を1回だけ文字n-gramのTF-IDFベクトルにし、
+# 投稿文のベクトルとのコサイン類似度で一番近い定型文を返す。しきい値未満なら None → 呼び出し側で生成する
+# 言語モデルは使わない（検索のためにモデルを読み込まない → 定型文で返せる投稿はモデルなしで返る）
+# しきい値は python reply_retrieval.py の確認用の投稿で決めた（ヒット率・誤ヒット・1件あたりの時間を表示）
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+RETRIEVAL_THRESHOLD = float(os.environ.get("REPLY_RETRIEVAL_THRESHOLD", "0.4"))
+RETRIEVAL_TOP_K = int(os.environ.get("REPLY_RETRIEVAL_TOP_K", "3"))
+NGRAM_SIZES = (2, 3)
+
+_indexes = {}
+_lock = threading.Lock()
+
+def normalize_text(text):
+    # 全角/半角・大文字小文字をそろえ、記号・絵文字・空白は落とす（文字の並びだけで比べる）
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] in "LN")
+
+def char_ngrams(text):
+    text = normalize_text(text)
+    if len(text) < min(NGRAM_SIZES):
+        return Counter(text)
+    return Counter(text[i:i + n] for n in NGRAM_SIZES for i in range(len(text) - n + 1))
+
+class ReplyIndex:
+    # entries: [(照合する文, 返信文, グループ名), ...]
+    def __init__(self, entries):
+        self.entries = entries
+        counts = [char_ngrams(entry[0]) for entry in entries]
+        document_frequency = Counter(gram for count in counts for gram in count)
+        self.vocabulary = {gram: i for i, gram in enumerate(document_frequency)}
+        # 候補に無いn-gramは一番珍しい扱い（投稿側のノルムに入れて、関係ない文が多い投稿ほど類似度を下げる）
+        self.unknown_idf = math.log(len(entries) + 1) + 1
+        self.idf = np.array([math.log((len(entries) + 1) / (document_frequency[gram] + 1)) + 1
+                             for gram in self.vocabulary], dtype=np.float32)
+        self.matrix = np.zeros((len(entries), len(self.vocabulary)), dtype=np.float32)
+        for row, count in enumerate(counts):
+            for gram, n in count.items():
+                self.matrix[row, self.vocabulary[gram]] = 1 + math.log(n)
+        self.matrix *= self.idf
+        self.matrix /= np.maximum(np.linalg.norm(self.matrix, axis=1, keepdims=True), 1e-8)
+
+    def vectorize(self, text):
+        vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+        unknown = 0.0
+        for gram, n in char_ngrams(text).items():
+            weight = 1 + math.log(n)
+            if gram in self.vocabulary:
+                vector[self.vocabulary[gram]] = weight * self.idf[self.vocabulary[gram]]
+            else:
+                unknown += (weight * self.unknown_idf) ** 2
+        norm = math.sqrt(float(vector @ vector) + unknown)
+        return vector / max(norm, 1e-8)
+
+    def scores(self, texts):
+        # (投稿数, 候補数) のコサイン類似度。投稿をまとめて1回の行列積で計算する
+        queries = np.stack([self.vectorize(text) for text in texts])
+        return queries @ self.matrix.T
+
+    def best_matches(self, texts, threshold=RETRIEVAL_THRESHOLD, top_k=RETRIEVAL_TOP_K, groups=None):
+        # 投稿ごとに (返信文, 類似度, グループ名) か None。上位top_k件（しきい値以上）からランダムに選ぶ
+        if not texts or not self.entries:
+            return [None] * len(texts)
+        all_scores = self.scores(texts)
+        if groups is not None:
+            allowed = np.array([entry[2] in groups for entry in self.entries])
+            all_scores = np.where(allowed, all_scores, -1.0)
+        results = []
+        for scores in all_scores:
+            order = np.argsort(scores)[::-1][:max(1, top_k)]
+            picks = [i for i in order if scores[i] >= threshold]
+            if not picks:
+                results.append(None)
+                continue
+            i = random.choice(picks)
+            results.append((self.entries[i][1], float(scores[i]), self.entries[i][2]))
+        return results
+
+    def best_match(self, text, threshold=RETRIEVAL_THRESHOLD, top_k=RETRIEVAL_TOP_K, groups=None):
+        return self.best_matches([text], threshold, top_k, groups)[0]
+
+def index_key(entries):
+    encoded = json.dumps(entries, ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()[:16]
+
+def get_reply_index(name, entries):
+    # 候補の内容が同じなら作ったインデックスを再利用。変わったら作り直す（数百件でも数ミリ秒）
+    entries = [tuple(entry) for entry in entries]
+    key = index_key(entries)
+    with _lock:
+        if (name, key) not in _indexes:
+            _indexes[(name, key)] = ReplyIndex(entries)
+        return _indexes[(name, key)]
+
+def pool_entries(group, lines):
+    # 定型文そのものと照合する
+    return [(line, line, group) for line in lines]
+
+def evaluate(index, should_hit, should_miss, thresholds=(0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5, 0.55)):
+    # しきい値ごとに、定型文で返したい投稿のヒット率と、生成に回したい投稿の誤ヒット率を出す
+    start = time.perf_counter()
+    hit_scores = index.scores(should_hit).max(axis=1)
+    miss_scores = index.scores(should_miss).max(axis=1)
+    per_post_ms = (time.perf_counter() - start) * 1000 / (len(should_hit) + len(should_miss))
+    for threshold in thresholds:
+        print(f"しきい値 {threshold:.2f}: ヒット {np.mean(hit_scores >= threshold):.0%}（{len(should_hit)}件中）, "
+              f"誤ヒット {np.mean(miss_scores >= threshold):.0%}（{len(should_miss)}件中）")
+    print(f"1件あたり {per_post_ms:.2f}ms（候補 {len(index.entries)}件）")
+
+# 確認用の投稿（REPLY_TABLE・定型文に近い言い回し / 定型文では返したくない投稿）
+SAMPLE_SHOULD_HIT = [
+    "おはよう〜", "おはようございます！", "みんなおはよう", "桃花おはよ〜", "かわいいね", "今日もかわいい！",
+    "なでなでしていい？", "なでなで〜", "ねむい……", "ねむいよぉ", "きたよー！", "また来たよ", "フォローしたよ！",
+    "フォローしました", "新しいBot作ったよ", "使い方教えて", "これの使い方がわからない",
+]
+SAMPLE_SHOULD_MISS = [
+    "今日のお昼はラーメンにした", "明日の天気どうなるかな", "電車が遅れてて最悪", "新しいゲーム買った！",
+    "レポートの締め切りがやばい", "猫が膝の上で寝てる", "週末どこ行こうかな", "推しのライブ当たった！！",
+    "お腹すいた", "部屋の掃除しなきゃ", "この本すごく面白かった", "雨の日は頭が痛くなる",
+    "Pythonのエラーが取れない", "コンビニの新作スイーツおいしい", "髪切りに行ってきた", "今夜は月がきれい",
+    # 定型文と言葉がかぶるけど、話の中身は別の投稿
+    "かわいい服を見つけたけど高すぎて買えなかった", "昨日作ったカレーが思ったより辛かった",
+    "会議中ずっとねむいのを我慢してた", "新しいスマホの使い方にまだ慣れない", "おはようって言う前に二度寝した",
+    "やっと家に帰ってきたよ、今日は長かった",
+]
+
+if __name__ == "__main__":
+    from reply_bot import retrieval_entries
+
+    evaluate(get_reply_index("sample", retrieval_entries()), SAMPLE_SHOULD_HIT, SAMPLE_SHOULD_MISS)
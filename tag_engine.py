@@ -0,0 +1,58 @@
+# 🔽 🏷️ タグエンジン（Aho-Corasick）
+# 複数のキーワード辞書を1つのオートマトンにまとめ、テキストを1回走査するだけで
+# 一致した全タグと位置を返す（部分一致・重なりあり・大文字小文字を区別しない）
+from collections import deque
+
+class TagEngine:
+    def __init__(self, tag_words):
+        # tag_words: {タグ名: [キーワード, ...]}
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        outputs = [set()]
+        for tag, words in tag_words.items():
+            for word in words:
+                word = word.lower()
+                if not word:
+                    continue
+                node = 0
+                for ch in word:
+                    nxt = self._goto[node].get(ch)
+                    if nxt is None:
+                        nxt = len(self._goto)
+                        self._goto[node][ch] = nxt
+                        self._goto.append({})
+                        self._fail.append(0)
+                        outputs.append(set())
+                    node = nxt
+                outputs[node].add((len(word), tag))
+
+        # 失敗リンク（幅優先）。出力は失敗先の分もまとめておく
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                outputs[nxt] |= outputs[self._fail[nxt]]
+        self._out = [tuple(sorted(o)) for o in outputs]
+
+    def scan(self, text, lowered=False):
+        # {タグ: [(開始位置, 一致した語), ...]}（出現順）。lowered=Trueなら小文字化済みとして扱う
+        text = text or ""
+        if not lowered:
+            text = text.lower()
+        goto, fail, out = self._goto, self._fail, self._out
+        found = {}
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length, tag in out[node]:
+                start = i - length + 1
+                found.setdefault(tag, []).append((start, text[start:i + 1]))
+        return found
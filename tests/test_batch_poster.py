@@ -0,0 +1,134 @@
+from types import SimpleNamespace
+
+import pytest
+
+from batch_poster import BatchPoster, new_tid, reply_record, reply_ref_from_dict, reply_ref_to_dict
+from atproto import models
+
+MY_DID = "did:plc:bot"
+
+
+class FakePDS:
+    # applyWrites / createRecord / getRecord だけのPDS。同じrkeyの作成は失敗する
+    def __init__(self):
+        self.records = {}
+        self.apply_calls = 0
+        self.create_calls = 0
+
+    def _create(self, rkey):
+        if rkey in self.records:
+            raise RuntimeError(f"RecordAlreadyExists: {rkey}")
+        rkey = rkey or new_tid()
+        self.records[rkey] = True
+        return f"at://{MY_DID}/app.bsky.feed.post/{rkey}"
+
+    def apply_writes(self, data):
+        self.apply_calls += 1
+        rkeys = [write.rkey for write in data.writes]
+        if any(rkey in self.records for rkey in rkeys) or len(set(rkeys)) != len(rkeys):
+            raise RuntimeError("InvalidRequest: record already exists")
+        return SimpleNamespace(results=[SimpleNamespace(uri=self._create(rkey)) for rkey in rkeys])
+
+    def create(self, repo, record, rkey=None):
+        self.create_calls += 1
+        return SimpleNamespace(uri=self._create(rkey))
+
+    def get(self, repo, rkey):
+        if rkey not in self.records:
+            raise RuntimeError("RecordNotFound")
+        return SimpleNamespace(uri=f"at://{MY_DID}/app.bsky.feed.post/{rkey}")
+
+
+@pytest.fixture
+def pds():
+    return FakePDS()
+
+
+@pytest.fixture
+def client(pds):
+    return SimpleNamespace(
+        me=SimpleNamespace(did=MY_DID),
+        com=SimpleNamespace(atproto=SimpleNamespace(repo=pds)),
+        app=SimpleNamespace(bsky=SimpleNamespace(feed=SimpleNamespace(post=pds))),
+    )
+
+
+def collect(client, **kwargs):
+    results, flushes = [], []
+    poster = BatchPoster(client, lambda *result: results.append(result), flushes.append, linger=3600, **kwargs)
+    return poster, results, flushes
+
+
+def test_batches_until_max_size(client, pds):
+    poster, results, flushes = collect(client, max_batch=3)
+    for i in range(7):
+        poster.add(f"at://post/{i}", reply_record(f"reply {i}"), rkey=new_tid())
+    poster.flush()
+    assert pds.apply_calls == 3
+    assert len(flushes) == 3
+    assert [key for key, _, _, _ in results] == [f"at://post/{i}" for i in range(7)]
+    assert all(error is None and uri for _, uri, _, error in results)
+
+
+def test_already_posted_rkey_falls_back_and_counts_as_posted(client, pds):
+    poster, results, _ = collect(client)
+    rkey = new_tid()
+    poster.add("at://post/1", reply_record("hi"), rkey=rkey)
+    poster.flush()
+    # 前回の実行が投稿後に落ちた → 同じrkeyで再投稿
+    poster.add("at://post/1", reply_record("hi"), rkey=rkey)
+    poster.add("at://post/2", reply_record("hello"), rkey=new_tid())
+    poster.flush()
+    assert poster.stats["fallbacks"] == 1
+    assert poster.stats["existing"] == 1
+    assert poster.stats["failed"] == 0
+    assert [error for _, _, _, error in results] == [None, None, None]
+    assert results[1][1] == f"at://{MY_DID}/app.bsky.feed.post/{rkey}"
+    assert len(pds.records) == 2
+
+
+def test_duplicate_rkeys_in_one_batch_are_written_once(client, pds):
+    poster, results, _ = collect(client)
+    rkey = new_tid()
+    poster.add("at://post/1", reply_record("hi"), "first", rkey=rkey)
+    poster.add("at://post/1", reply_record("hi"), "second", rkey=rkey)
+    poster.add("at://post/2", reply_record("hello"), rkey=new_tid())
+    poster.flush()
+    assert pds.apply_calls == 1
+    assert poster.stats["fallbacks"] == 0
+    assert len(pds.records) == 2
+    by_context = {context: uri for _, uri, context, _ in results}
+    assert by_context["first"] == by_context["second"]
+
+
+def test_real_failure_is_reported(client, pds, monkeypatch):
+    poster, results, _ = collect(client)
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("network down")
+
+    monkeypatch.setattr(pds, "apply_writes", broken)
+    monkeypatch.setattr(pds, "create", broken)
+    poster.add("at://post/1", reply_record("hi"), rkey=new_tid())
+    poster.flush()
+    assert poster.stats["failed"] == 1
+    assert isinstance(results[0][3], RuntimeError)
+
+
+def test_new_tid_format():
+    tids = {new_tid() for _ in range(100)}
+    assert len(tids) == 100
+    for tid in tids:
+        assert len(tid) == 13
+        assert tid[0] in "234567abcdefghij"
+        assert set(tid) <= set("234567abcdefghijklmnopqrstuvwxyz")
+
+
+def test_reply_ref_round_trip():
+    ref = models.AppBskyFeedPost.ReplyRef(
+        root=models.ComAtprotoRepoStrongRef.Main(uri="at://did:plc:a/app.bsky.feed.post/1", cid="bafyroot"),
+        parent=models.ComAtprotoRepoStrongRef.Main(uri="at://did:plc:a/app.bsky.feed.post/2", cid="bafyparent"),
+    )
+    assert reply_ref_from_dict(reply_ref_to_dict(ref)) == ref
+    assert reply_ref_to_dict(None) is None
+    assert reply_ref_from_dict(None) is None
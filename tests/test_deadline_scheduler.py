@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+from deadline_scheduler import DEFAULT_COSTS, PRIORITY_MENTION, PRIORITY_TIMELINE, PRIORITY_URGENT, DeadlineScheduler
+
+
+@pytest.fixture
+def metrics_file(tmp_path):
+    return str(tmp_path / "run_metrics.json")
+
+
+def scheduler(metrics_file, remaining=None, margin=0):
+    deadline = None if remaining is None else time.time() + remaining
+    return DeadlineScheduler(deadline=deadline, metrics_file=metrics_file, margin=margin)
+
+
+def test_default_estimate_without_metrics(metrics_file):
+    s = scheduler(metrics_file)
+    assert s.estimate("image", 3) == DEFAULT_COSTS["image"] * 3
+    assert s.estimate("unknown") == 10.0
+
+
+def test_record_updates_moving_average(metrics_file):
+    s = scheduler(metrics_file)
+    s.record("image", 4.0, count=2)
+    assert s.metrics["image"] == {"mean": 2.0, "dev": 1.0, "count": 2}
+    s.record("image", 3.0)
+    assert s.metrics["image"]["mean"] == pytest.approx(2.0 + 0.3 * 1.0)
+    assert s.metrics["image"]["count"] == 3
+    # 見積もりは平均＋ばらつき2つ分
+    assert s.estimate("image") == pytest.approx(s.metrics["image"]["mean"] + 2 * s.metrics["image"]["dev"])
+
+
+def test_select_keeps_priority_order_and_defers_rest(metrics_file):
+    s = scheduler(metrics_file, remaining=100, margin=20)
+    s.metrics = {"fuwamoko_reply": {"mean": 10.0, "dev": 0.0, "count": 1}}
+    items = [("tl1", PRIORITY_TIMELINE), ("urgent", PRIORITY_URGENT), ("mention", PRIORITY_MENTION),
+             ("tl2", PRIORITY_TIMELINE), ("tl3", PRIORITY_TIMELINE)]
+    selected = s.select(items, ("fuwamoko_reply",), priority=lambda item: item[1], extra=45)
+    # 残り100 - 後片付け20 - モデル読み込み45 = 35秒 → 10秒/件なら3件
+    assert [name for name, _ in selected] == ["urgent", "mention", "tl1"]
+    assert [name for name, _ in s.deferred] == ["tl2", "tl3"]
+
+
+def test_select_without_deadline_takes_everything(metrics_file):
+    s = scheduler(metrics_file)
+    items = list(range(50))
+    assert s.select(items, ("mention_reply",)) == items
+    assert s.deferred == []
+
+
+def test_run_stops_when_next_item_does_not_fit(metrics_file):
+    s = scheduler(metrics_file, remaining=5)
+    s.metrics = {"mention_reply": {"mean": 0.0, "dev": 0.0, "count": 1}}
+    done = []
+    for item in s.run(["a", "b", "c"], "mention_reply"):
+        done.append(item)
+        # 1件目の実測をわざと大きくして、2件目以降は間に合わない見積もりにする
+        s.metrics["mention_reply"]["mean"] = 60.0
+    assert done == ["a"]
+    assert s.deferred == ["b", "c"]
+
+
+def test_metrics_persist_between_runs(metrics_file):
+    s = scheduler(metrics_file)
+    with s.measure("image", count=4):
+        pass
+    s.save()
+    assert scheduler(metrics_file).metrics["image"]["count"] == 4
+
+
+def test_broken_metrics_file_falls_back_to_defaults(metrics_file):
+    with open(metrics_file, "w", encoding="utf-8") as f:
+        f.write("{broken")
+    s = scheduler(metrics_file)
+    assert s.metrics == {}
+    assert s.estimate("image") == DEFAULT_COSTS["image"]
@@ -0,0 +1,134 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from fuwamoko_history import BinaryHistoryCodec, FuwamokoHistory, TextHistoryCodec
+
+NOW = datetime(2026, 10, 1, 12, 0, 0, 123456, tzinfo=timezone.utc)
+URIS = [f"at://did:plc:user{i % 2}/app.bsky.feed.post/3kabcdefghi{i:02d}" for i in range(6)]
+
+
+def open_history(tmp_path, fmt, **kwargs):
+    suffix = "bin" if fmt == "binary" else "txt"
+    history = FuwamokoHistory(str(tmp_path / f"history.{suffix}"), str(tmp_path / "history.lock"), fmt=fmt, **kwargs)
+    history.load()
+    return history
+
+
+def write_records(tmp_path, fmt, uris=URIS, indexed_at=NOW):
+    history = open_history(tmp_path, fmt)
+    for uri in uris:
+        history.add(uri, indexed_at)
+    history.close()
+    return history.path
+
+
+@pytest.mark.parametrize("codec_class", [TextHistoryCodec, BinaryHistoryCodec])
+def test_codec_round_trip(codec_class):
+    codec = codec_class()
+    uris = URIS + ["at://did:plc:user0/app.bsky.feed.like/notapostrkey"]
+    data = b"".join(codec.encode(uri, NOW) for uri in uris)
+    records, end = codec_class().decode(data)
+    assert records == [(uri, NOW) for uri in uris]
+    assert end == len(data)
+
+
+def test_binary_interns_dids():
+    codec = BinaryHistoryCodec()
+    first = codec.encode(URIS[0], NOW)
+    second = codec.encode(URIS[2], NOW)  # 同じDID → DID定義なし
+    assert first.startswith(b"D")
+    assert second.startswith(b"E")
+    assert len(second) == 1 + BinaryHistoryCodec.ENTRY.size
+
+
+@pytest.mark.parametrize("fmt", ["text", "binary"])
+def test_load_after_reopen(tmp_path, fmt):
+    write_records(tmp_path, fmt)
+    history = open_history(tmp_path, fmt)
+    assert len(history) == len(URIS)
+    assert all(uri in history for uri in URIS)
+    assert history.get(URIS[0]) == NOW
+
+
+@pytest.mark.parametrize("fmt", ["text", "binary"])
+def test_partial_last_record_is_truncated(tmp_path, fmt):
+    path = write_records(tmp_path, fmt)
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:-5])
+    history = open_history(tmp_path, fmt)
+    assert len(history) == len(URIS) - 1
+    assert URIS[-1] not in history
+    with open(path, "rb") as f:
+        assert len(f.read()) < len(data) - 5  # 書きかけの末尾だけ削除
+
+
+def test_binary_mid_file_corruption_keeps_later_records(tmp_path):
+    path = write_records(tmp_path, "binary")
+    with open(path, "rb") as f:
+        data = bytearray(f.read())
+    entries = [i for i, byte in enumerate(data) if byte == ord("E")]
+    data[entries[2]] = ord("X")  # 3件目のタグを壊す
+    with open(path, "wb") as f:
+        f.write(data)
+
+    history = open_history(tmp_path, "binary")
+    assert len(history) == len(URIS) - 1
+    assert URIS[2] not in history
+    assert all(uri in history for uri in URIS[:2] + URIS[3:])
+
+    # 書き直したファイルに追記しても、読み直して同じ内容になる
+    history.add("at://did:plc:user9/app.bsky.feed.post/3kabcdefghi99", NOW)
+    history.close()
+    reloaded = open_history(tmp_path, "binary")
+    assert set(reloaded.index) == set(history.index)
+
+
+def test_binary_bad_did_id_is_skipped(tmp_path):
+    path = write_records(tmp_path, "binary")
+    with open(path, "rb") as f:
+        data = bytearray(f.read())
+    entries = [i for i, byte in enumerate(data) if byte == ord("E")]
+    data[entries[1] + 1:entries[1] + 5] = (999).to_bytes(4, "little")
+    with open(path, "wb") as f:
+        f.write(data)
+    history = open_history(tmp_path, "binary")
+    assert len(history) == len(URIS) - 1
+    assert URIS[1] not in history
+
+
+def test_expired_entries_are_dropped(tmp_path):
+    old = NOW - timedelta(days=30)
+    history = FuwamokoHistory(str(tmp_path / "history.txt"), str(tmp_path / "history.lock"),
+                              retention=timedelta(days=7), compact_min_lines=1)
+    history.load()
+    fresh = datetime.now(timezone.utc)
+    history.add(URIS[0], old)
+    history.add(URIS[1], fresh)
+    history.maybe_compact()
+    assert URIS[0] not in history
+    assert URIS[1] in history
+    history.close()
+
+    reloaded = FuwamokoHistory(str(tmp_path / "history.txt"), str(tmp_path / "history.lock"),
+                               retention=timedelta(days=7))
+    reloaded.load()
+    assert list(reloaded.index) == [URIS[1]]
+
+
+def test_dead_records_counted_once(tmp_path):
+    history = FuwamokoHistory(str(tmp_path / "history.txt"), str(tmp_path / "history.lock"),
+                              retention=timedelta(days=7), compact_min_lines=1000)
+    history.load()
+    fresh = datetime.now(timezone.utc)
+    history.add(URIS[0], fresh)
+    history.add(URIS[0], fresh - timedelta(days=30))  # 重複かつ期限切れ
+    history.add(URIS[1], fresh)
+    history.close()
+    reloaded = FuwamokoHistory(str(tmp_path / "history.txt"), str(tmp_path / "history.lock"),
+                               retention=timedelta(days=7), compact_min_lines=1000)
+    reloaded.load()
+    assert reloaded._lines == 3
+    assert reloaded._dead == reloaded._lines - len(reloaded)
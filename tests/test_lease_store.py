@@ -0,0 +1,95 @@
+import pytest
+
+import lease_store
+from lease_store import HashRing, SQLiteLeaseStore, WorkClaimer, open_lease_store
+
+
+@pytest.fixture
+def store():
+    return SQLiteLeaseStore(":memory:")
+
+
+def test_acquire_is_exclusive(store):
+    assert store.acquire("at://post/1", "runner-a", ttl=60)
+    assert not store.acquire("at://post/1", "runner-b", ttl=60)
+    # 自分のリースは延長できる
+    assert store.acquire("at://post/1", "runner-a", ttl=60)
+
+
+def test_expired_lease_can_be_stolen(store):
+    assert store.acquire("at://post/1", "runner-a", ttl=-1)  # すでに期限切れ
+    assert store.acquire("at://post/1", "runner-b", ttl=60)
+    assert not store.acquire("at://post/1", "runner-a", ttl=60)
+
+
+def test_release_lets_others_acquire(store):
+    store.acquire("at://post/1", "runner-a", ttl=60)
+    store.release("at://post/1", "runner-b")  # 他人のリースは解放できない
+    assert not store.acquire("at://post/1", "runner-b", ttl=60)
+    store.release("at://post/1", "runner-a")
+    assert store.acquire("at://post/1", "runner-b", ttl=60)
+
+
+def test_completed_lease_is_never_reacquired(store):
+    store.acquire("at://post/1", "runner-a", ttl=-1)
+    assert store.complete("at://post/1", "runner-a", retention=3600)
+    assert not store.acquire("at://post/1", "runner-a", ttl=60)
+    assert not store.acquire("at://post/1", "runner-b", ttl=60)
+
+
+def test_purge_removes_expired_rows(store):
+    store.acquire("at://post/1", "runner-a", ttl=-1)
+    store.acquire("at://post/2", "runner-a", ttl=60)
+    assert store.purge() == 1
+
+
+def test_members_expire(store):
+    store.heartbeat("runner-a", ttl=60)
+    store.heartbeat("runner-b", ttl=-1)
+    assert store.members() == ["runner-a"]
+    store.leave("runner-a")
+    assert store.members() == []
+
+
+def test_claimers_split_keys_without_overlap(tmp_path, monkeypatch):
+    monkeypatch.setattr(lease_store, "RING_REFRESH", -1)  # 参加直後のメンバー一覧をすぐ読み直す
+    path = str(tmp_path / "leases.db")
+    claimers = [WorkClaimer(SQLiteLeaseStore(path), runner_id=f"runner-{i}") for i in range(3)]
+    for claimer in claimers:
+        claimer.join()
+    keys = [f"did:plc:user{i}" for i in range(300)]
+    owners = [[claimer.runner_id for claimer in claimers if claimer.owns(key)] for key in keys]
+    assert all(len(owner) == 1 for owner in owners)
+    assert all(sum(1 for owner in owners if owner == [claimer.runner_id]) > 30 for claimer in claimers)
+
+
+def test_only_one_claimer_wins(tmp_path):
+    path = str(tmp_path / "leases.db")
+    a = WorkClaimer(SQLiteLeaseStore(path), runner_id="runner-a")
+    b = WorkClaimer(SQLiteLeaseStore(path), runner_id="runner-b")
+    assert a.claim("at://post/1")
+    assert not b.claim("at://post/1")
+    a.done("at://post/1")
+    assert not b.claim("at://post/1")
+    assert b.stats["contended"] == 2
+
+
+def test_claimer_without_store_owns_everything():
+    claimer = WorkClaimer(None)
+    assert claimer.owns("did:plc:anyone")
+    assert claimer.claim("at://post/1")
+
+
+def test_hash_ring_moves_few_keys_when_member_leaves():
+    keys = [f"did:plc:user{i}" for i in range(1000)]
+    before = HashRing(["a", "b", "c", "d"])
+    after = HashRing(["a", "b", "c"])
+    moved = sum(1 for key in keys if before.owner(key) != after.owner(key) and before.owner(key) != "d")
+    assert moved == 0
+
+
+def test_open_lease_store_urls(tmp_path):
+    assert open_lease_store("") is None
+    assert isinstance(open_lease_store(f"sqlite:///{tmp_path}/leases.db"), SQLiteLeaseStore)
+    with pytest.raises(ValueError):
+        open_lease_store("redis://localhost")
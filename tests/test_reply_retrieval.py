@@ -0,0 +1,43 @@
+from reply_retrieval import (RETRIEVAL_THRESHOLD, SAMPLE_SHOULD_HIT, SAMPLE_SHOULD_MISS, char_ngrams, get_reply_index,
+                             pool_entries)
+
+ENTRIES = [("おはよう", "おはよう！今日もいい日になるといいね", "table"),
+           ("ねむい", "お昼寝するなら毛布かけてね", "table"),
+           ("なでなで", "…いきなり触らないでよね", "table")] + pool_entries("fallback", ["ふふっ、ありがと♡"])
+
+
+def test_close_posts_hit_and_unrelated_posts_miss():
+    index = get_reply_index("test", ENTRIES)
+    assert index.best_match("みんなおはよう〜")[0] == "おはよう！今日もいい日になるといいね"
+    assert index.best_match("ねむいよぉ")[2] == "table"
+    assert index.best_match("今日のお昼はラーメンにした") is None
+    assert index.best_match("会議中ずっとねむいのを我慢してた") is None
+
+
+def test_normalization_ignores_width_case_and_symbols():
+    assert char_ngrams("ＯＫ！！ おはよう✨") == char_ngrams("ok おはよう")
+
+
+def test_group_filter():
+    index = get_reply_index("test", ENTRIES)
+    assert index.best_match("おはよう", groups={"fallback"}) is None
+
+
+def test_index_is_reused_for_same_entries():
+    assert get_reply_index("test", ENTRIES) is get_reply_index("test", list(ENTRIES))
+
+
+def test_sample_posts_at_default_threshold():
+    # 確認用の投稿で決めたしきい値（python reply_retrieval.py）: 誤ヒットなし、近い投稿はほぼ拾う
+    from reply_bot import retrieval_entries
+
+    index = get_reply_index("sample", retrieval_entries())
+    assert (index.scores(SAMPLE_SHOULD_MISS).max(axis=1) < RETRIEVAL_THRESHOLD).all()
+    assert (index.scores(SAMPLE_SHOULD_HIT).max(axis=1) >= RETRIEVAL_THRESHOLD).mean() >= 0.8
+
+
+def test_retrieval_does_not_need_the_language_model():
+    import model_registry
+
+    get_reply_index("test", ENTRIES).best_match("おはよう")
+    assert model_registry.loaded_models() == []
@@ -0,0 +1,66 @@
+import random
+import re
+
+from tag_engine import TagEngine
+
+TAG_WORDS = {
+    "fuwamoko": ["もふもふ", "ふわふわ", "もふ", "fluffy"],
+    "food_ng": ["焼肉", "肉", "ラーメン"],
+    "nsfw_ng": ["NSFW", "Hカップ", "#DMで"],
+    "priority": ["@mirinchuuu"],
+    "overlap": ["abc", "bc", "c", "abcd"],
+}
+
+TEXTS = [
+    "",
+    "今日のうさぎ、もふもふでふわふわ！",
+    "焼肉とラーメン食べた",
+    "nsfw注意 hカップ #dmで",
+    "@MirinChuuu みてみて fluffy cat",
+    "xabcdx abc bc c",
+    "もふもふもふ",
+]
+
+
+def regex_scan(text):
+    # 従来の「小文字化して部分一致」を正規表現（先読みで重なりも拾う）で再現した参照実装
+    text = text.lower()
+    found = {}
+    for tag, words in TAG_WORDS.items():
+        for word in words:
+            for match in re.finditer(f"(?={re.escape(word.lower())})", text):
+                found.setdefault(tag, []).append((match.start(), word.lower()))
+    return {tag: sorted(matches) for tag, matches in found.items()}
+
+
+def engine_scan(engine, text):
+    return {tag: sorted(matches) for tag, matches in engine.scan(text).items()}
+
+
+def test_matches_regex_reference():
+    engine = TagEngine(TAG_WORDS)
+    for text in TEXTS:
+        assert engine_scan(engine, text) == regex_scan(text), text
+
+
+def test_matches_regex_on_random_text():
+    engine = TagEngine(TAG_WORDS)
+    alphabet = "abcdもふわ肉焼ラーメン@ #NSFWHカップdm"
+    rng = random.Random(0)
+    for _ in range(500):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+        assert engine_scan(engine, text) == regex_scan(text), text
+
+
+def test_same_tags_as_substring_check():
+    # 旧コードの any(word in text.lower() for word in words) と同じタグ集合になる
+    engine = TagEngine(TAG_WORDS)
+    for text in TEXTS:
+        expected = {tag for tag, words in TAG_WORDS.items() if any(word.lower() in text.lower() for word in words)}
+        assert set(engine.scan(text)) == expected
+
+
+def test_lowered_flag_skips_lowercasing():
+    engine = TagEngine(TAG_WORDS)
+    assert engine.scan("FLUFFY", lowered=True) == {}
+    assert "fuwamoko" in engine.scan("fluffy", lowered=True)
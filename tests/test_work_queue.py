@@ -0,0 +1,59 @@
+import time
+
+import pytest
+
+from work_queue import WorkQueue
+
+BOT = "fuwamoko"
+URI = "at://did:plc:user/app.bsky.feed.post/3kpost"
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return WorkQueue(str(tmp_path / "work_queue.db"), retention=3600)
+
+
+def test_unknown_item(queue):
+    assert queue.get(BOT, URI) == (None, {})
+
+
+def test_advance_merges_payload(queue):
+    queue.advance(BOT, URI, "filtered", fluffy=True)
+    queue.advance(BOT, URI, "generated", reply="ふわふわ〜", rkey="3kreply")
+    assert queue.get(BOT, URI) == ("generated", {"fluffy": True, "reply": "ふわふわ〜", "rkey": "3kreply"})
+
+
+def test_advance_never_goes_back(queue):
+    queue.advance(BOT, URI, "posted", rkey="3kreply")
+    assert queue.advance(BOT, URI, "filtered", fluffy=False) == "posted"
+    assert queue.get(BOT, URI) == ("posted", {"rkey": "3kreply"})
+
+
+def test_unknown_stage_is_rejected(queue):
+    with pytest.raises(ValueError):
+        queue.advance(BOT, URI, "done")
+
+
+def test_items_and_counts_are_per_bot(queue):
+    queue.advance(BOT, URI + "1", "generated", reply="a")
+    queue.advance(BOT, URI + "2", "generated", reply="b")
+    queue.advance(BOT, URI + "3", "persisted")
+    queue.advance("reply", URI + "1", "generated", reply="c")
+    assert [key for key, _ in queue.items(BOT, "generated")] == [URI + "1", URI + "2"]
+    assert queue.counts(BOT) == {"generated": 2, "persisted": 1}
+    assert queue.counts("reply") == {"generated": 1}
+
+
+def test_progress_survives_reopen(tmp_path):
+    path = str(tmp_path / "work_queue.db")
+    WorkQueue(path).advance(BOT, URI, "generated", reply="もふもふ")
+    assert WorkQueue(path).get(BOT, URI) == ("generated", {"reply": "もふもふ"})
+
+
+def test_purge_removes_old_items(queue):
+    queue.advance(BOT, URI + "old", "filtered")
+    queue.advance(BOT, URI + "new", "filtered")
+    queue._execute("UPDATE items SET updated_at = ? WHERE key = ?", (time.time() - 7200, URI + "old"))
+    assert queue.purge() == 1
+    assert queue.get(BOT, URI + "old") == (None, {})
+    assert queue.get(BOT, URI + "new")[0] == "filtered"
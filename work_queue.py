@@ -0,0 +1,94 @@
+# 🔽 📒 作業キュー（途中経過の保存と、次の実行での再開）
+# 実行がキャンセル・タイムアウトしても、そこまでの作業（画像の判定結果・生成した返信・投稿済みの返信）を失わない
+# ・投稿/通知のURIごとに、いまどの段階まで終わったかと、その段階で作ったもの（payload）をSQLiteに記録する
+#   fetched（取得）→ filtered（判定済み）→ generated（返信生成済み）→ posted（投稿済み）→ persisted（replied・履歴に保存済み）
+# ・次の実行では、終わった段階の続きから始める（判定・生成をやり直さない）
+# ・返信の投稿は、生成時に決めたrkeyで行う → 投稿後に落ちて再投稿しても同じレコードなので二重投稿にならない
+# ・1文ごとにコミットするので、どこで止まっても直前の段階までは残る
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+WORK_QUEUE_FILE = os.environ.get("WORK_QUEUE_FILE", "work_queue.db")
+WORK_QUEUE_RETENTION = int(os.environ.get("WORK_QUEUE_RETENTION", str(3 * 24 * 3600)))  # 秒
+
+STAGES = ("fetched", "filtered", "generated", "posted", "persisted")
+
+class WorkQueue:
+    def __init__(self, path=WORK_QUEUE_FILE, retention=WORK_QUEUE_RETENTION):
+        self.path = path
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        # ワークフローのキャッシュにはdbファイルだけを載せるので、WALではなく通常のジャーナルで毎回書き切る
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS items (key TEXT NOT NULL, bot TEXT NOT NULL, stage TEXT NOT NULL, "
+            "payload TEXT NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (bot, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS items_stage ON items (bot, stage)")
+        self.stats = {"resumed": 0, "advanced": 0}
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def get(self, bot, key):
+        # (段階, payload) / 記録なしなら (None, {})
+        row = self._execute("SELECT stage, payload FROM items WHERE bot = ? AND key = ?", (bot, key)).fetchone()
+        if row is None:
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    def advance(self, bot, key, stage, **payload):
+        # 段階を進めてpayloadを足す（前の段階のpayloadは残す）。後戻りはしない
+        if stage not in STAGES:
+            raise ValueError(f"未知の段階: {stage}")
+        with self._lock:
+            row = self._conn.execute("SELECT stage, payload FROM items WHERE bot = ? AND key = ?", (bot, key)).fetchone()
+            if row is not None:
+                if STAGES.index(row[0]) > STAGES.index(stage):
+                    return row[0]
+                payload = {**json.loads(row[1]), **payload}
+            self._conn.execute(
+                "INSERT INTO items (key, bot, stage, payload, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(bot, key) DO UPDATE SET stage = excluded.stage, payload = excluded.payload, "
+                "updated_at = excluded.updated_at",
+                (key, bot, stage, json.dumps(payload, ensure_ascii=False), time.time()),
+            )
+        self.stats["advanced"] += 1
+        return stage
+
+    def items(self, bot, stage):
+        # その段階で止まっている作業（古い順）
+        rows = self._execute(
+            "SELECT key, payload FROM items WHERE bot = ? AND stage = ? ORDER BY updated_at", (bot, stage)
+        ).fetchall()
+        return [(key, json.loads(payload)) for key, payload in rows]
+
+    def purge(self):
+        # 保持期間を過ぎた記録を消す（終わったものも、途中で止まったままのものも）
+        return self._execute("DELETE FROM items WHERE updated_at < ?", (time.time() - self.retention,)).rowcount
+
+    def counts(self, bot):
+        rows = self._execute("SELECT stage, COUNT(*) FROM items WHERE bot = ? GROUP BY stage", (bot,)).fetchall()
+        return dict(rows)
+
+    def stats_message(self, bot):
+        counts = self.counts(bot)
+        stages = ", ".join(f"{stage} {counts.get(stage, 0)}件" for stage in STAGES)
+        return f"📒 作業キュー（{bot}）: {stages} / 今回の再開 {self.stats['resumed']}件"
+
+_work_queues = {}
+
+def get_work_queue(path=WORK_QUEUE_FILE):
+    if path not in _work_queues:
+        queue = WorkQueue(path)
+        purged = queue.purge()
+        if purged:
+            logging.info(f"🧹 作業キュー: 古い記録 {purged}件を削除")
+        _work_queues[path] = queue
+    return _work_queues[path]